@@ -0,0 +1,170 @@
+'''
+Approximate maximum inner product search over the item embeddings, for serving
+recommendations from large catalogues without scoring every item per request.
+
+IVFIndex is an inverted file index: the item embeddings are clustered with
+k-means and a query (the last-position sequence representation of a model,
+model.query_emb) only scores the items of the :nprobe: clusters whose
+centroids have the highest inner product with it. The index is stored as a
+single .npz file and has no dependencies besides NumPy.
+'''
+
+import os
+
+import numpy as np
+
+# the item embedding table of every model (CAST1..CAST9, SASRec)
+ITEM_EMBEDDINGS = 'SASRec/input_embeddings/lookup_table'
+
+
+def load_item_embeddings(checkpoint):
+    '''
+    Reads the trained item embedding table from a checkpoint, either a
+    checkpoint prefix or a directory containing checkpoints (the latest is
+    used). Row i is the embedding of item i; row 0 (padding) is zero.
+    '''
+    import tensorflow as tf
+
+    if os.path.isdir(checkpoint):
+        checkpoint = tf.train.latest_checkpoint(checkpoint)
+    table = tf.train.load_checkpoint(checkpoint).get_tensor(ITEM_EMBEDDINGS)
+    # the models zero-pad the lookup table, the stored row 0 is never used
+    table[0] = 0
+    return table
+
+
+def exact_top_k(item_emb, queries, k=10):
+    '''
+    Exact top-:k: items (ids, scores) of every query by inner product with
+    all rows of :item_emb: except the padding item 0.
+    '''
+    scores = np.dot(queries, item_emb[1:].T)
+    k = min(k, scores.shape[1])
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    return np.take_along_axis(top, order, axis=1) + 1, np.take_along_axis(top_scores, order, axis=1)
+
+
+def nearest_centroid(vectors, centroids, chunk_size=4096):
+    '''
+    Index of the nearest (L2) centroid of every vector.
+    '''
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    centroid_norms = np.sum(centroids ** 2, axis=1)
+    for start in range(0, len(vectors), chunk_size):
+        chunk = vectors[start:start + chunk_size]
+        assignment[start:start + chunk_size] = np.argmin(centroid_norms - 2 * np.dot(chunk, centroids.T), axis=1)
+    return assignment
+
+
+def kmeans(vectors, nlist, n_iter=10, max_train_size=256, seed=42):
+    '''
+    Lloyd's k-means with :nlist: clusters, trained on at most :max_train_size:
+    vectors per cluster. Empty clusters keep their previous centroid.
+    '''
+    rng = np.random.RandomState(seed)
+    if len(vectors) > nlist * max_train_size:
+        vectors = vectors[rng.choice(len(vectors), nlist * max_train_size, replace=False)]
+    centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].astype(np.float32)
+
+    for _ in range(n_iter):
+        assignment = nearest_centroid(vectors, centroids)
+        order = np.argsort(assignment, kind='stable')
+        counts = np.bincount(assignment, minlength=nlist)
+        non_empty = counts > 0
+        starts = (np.cumsum(counts) - counts)[non_empty]
+        sums = np.add.reduceat(vectors[order].astype(np.float64), starts, axis=0)
+        centroids[non_empty] = sums / counts[non_empty, None]
+    return centroids
+
+
+class IVFIndex():
+    '''
+    Inverted file index over item embeddings for maximum inner product search.
+
+    The items of cluster c are item_ids[list_offsets[c]:list_offsets[c + 1]]
+    with their embeddings in the same rows of :vectors:, so a probed cluster
+    is scored with one contiguous matmul.
+
+    Arguments
+    ---------
+
+    centroids : np.ndarray
+        [nlist, dim] cluster centroids.
+    list_offsets : np.ndarray
+        [nlist + 1] start of every cluster in :item_ids: and :vectors:.
+    item_ids : np.ndarray
+        Item ids, grouped by cluster.
+    vectors : np.ndarray
+        Embeddings of :item_ids:.
+    '''
+
+    FIELDS = ['centroids', 'list_offsets', 'item_ids', 'vectors']
+
+    def __init__(self, centroids, list_offsets, item_ids, vectors):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.item_ids = item_ids
+        self.vectors = vectors
+
+    def __len__(self):
+        return len(self.item_ids)
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, item_emb, nlist=None, n_iter=10, seed=42):
+        '''
+        Clusters the rows of the item embedding table :item_emb: (except the
+        padding item 0) into :nlist: lists, 4 * sqrt(items) by default.
+        '''
+        vectors = np.ascontiguousarray(item_emb[1:], dtype=np.float32)
+        if nlist is None:
+            nlist = int(4 * np.sqrt(len(vectors)))
+        nlist = max(1, min(nlist, len(vectors)))
+
+        centroids = kmeans(vectors, nlist, n_iter=n_iter, seed=seed)
+        assignment = nearest_centroid(vectors, centroids)
+        order = np.argsort(assignment, kind='stable')
+        list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=nlist), out=list_offsets[1:])
+        return cls(centroids, list_offsets, (order + 1).astype(np.int32), vectors[order])
+
+    def search(self, queries, k=10, nprobe=8):
+        '''
+        Returns the ids and scores ([queries, k] each) of the :k: items with the
+        highest inner product among the items of the :nprobe: best clusters of
+        every query. Rows with fewer than :k: candidates are padded with id 0
+        and score -inf.
+        '''
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        nprobe = min(nprobe, self.nlist)
+        probes = np.argpartition(-np.dot(queries, self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+
+        ids = np.zeros((len(queries), k), dtype=np.int32)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for row, (query, probe) in enumerate(zip(queries, probes)):
+            starts, ends = self.list_offsets[probe], self.list_offsets[probe + 1]
+            lengths = ends - starts
+            candidates = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths - starts, lengths)
+
+            candidate_scores = np.dot(self.vectors[candidates], query)
+            n = min(k, len(candidates))
+            if n == 0:
+                continue
+            top = np.argpartition(-candidate_scores, n - 1)[:n]
+            top = top[np.argsort(-candidate_scores[top])]
+            ids[row, :n] = self.item_ids[candidates[top]]
+            scores[row, :n] = candidate_scores[top]
+        return ids, scores
+
+    def save(self, fpath):
+        np.savez(fpath, **{name: getattr(self, name) for name in self.FIELDS})
+
+    @classmethod
+    def load(cls, fpath):
+        with np.load(fpath) as arrays:
+            return cls(**{name: arrays[name] for name in cls.FIELDS})
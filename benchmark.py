@@ -0,0 +1,533 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import http.client
+
+import numpy as np
+import tensorflow as tf
+
+from util import data_partition, get_delta_range, get_timedelta_bin
+from sampler import BatchSampler, WarpSampler, batch_sampler
+from main import TRAIN_INPUTS, build_model, build_parser, train_feed_dict, train_inputs
+from modules import multihead_attention
+from ann import IVFIndex, exact_top_k, load_item_embeddings
+from serve import Recommender, MicroBatcher, make_server
+
+
+def random_neq(l, r, s):
+    t = np.random.randint(l, r)
+    while t in s:
+        t = np.random.randint(l, r)
+    return t
+
+
+def legacy_sample_batch(user_train, usernum, itemnum, batch_size, maxlen, bin_in_hours, max_bins):
+    '''
+    Per-row sampler as it was before BatchSampler, kept as the baseline for the
+    sampler benchmark (linear time bins only).
+    '''
+    starts, ends = user_train.starts, user_train.ends
+    lengths = user_train.lengths()
+    items = user_train.columns['item']
+    ratings = user_train.columns['rating']
+    hours = user_train.columns['hour']
+    days = user_train.columns['day']
+    timestamps = user_train.columns['timestamp']
+
+    def sample():
+        user = np.random.randint(1, usernum + 1)
+        while lengths[user] <= 1:
+            user = np.random.randint(1, usernum + 1)
+
+        seq = np.zeros([maxlen], dtype=np.int32)
+        pos = np.zeros([maxlen], dtype=np.int32)
+        neg = np.zeros([maxlen], dtype=np.int32)
+        timeseq = np.zeros([maxlen], dtype=np.int32)
+        ratings_seq = np.zeros([maxlen], dtype=np.int32)
+        hours_seq = np.zeros([maxlen], dtype=np.int32)
+        days_seq = np.zeros([maxlen], dtype=np.int32)
+
+        start, end = starts[user], ends[user]
+        ts = set(items[start:end].tolist())
+        n = min(end - start - 1, maxlen)
+        first = end - 1 - n
+        seq[-n:] = items[first:end - 1]
+        pos[-n:] = items[first + 1:end]
+        ratings_seq[-n:] = ratings[first:end - 1]
+        hours_seq[-n:] = hours[first:end - 1]
+        days_seq[-n:] = days[first:end - 1]
+        for idx in range(maxlen - n, maxlen):
+            neg[idx] = random_neq(1, itemnum + 1, ts)
+
+        most_recent_timestamp = timestamps[end - 2]
+        for idx, timestamp in enumerate(timestamps[first:end - 1], maxlen - n):
+            timeseq[idx] = get_timedelta_bin(float(most_recent_timestamp - timestamp), bin_in_hours=bin_in_hours,
+                                             max_bins=max_bins, log_scale=False)
+        return (user, seq, pos, neg, timeseq, ratings_seq, hours_seq, days_seq)
+
+    return list(zip(*[sample() for _ in range(batch_size)]))
+
+
+def legacy_multihead_attention(queries, keys, num_units, num_heads, dropout_rate, is_training, causality, scope):
+    '''
+    modules.multihead_attention as it was before the masks became additive biases,
+    with tiled (h*N, T_q, T_k) masks, kept as the baseline of the attention benchmark.
+    '''
+    with tf.variable_scope(scope):
+        Q = tf.layers.dense(queries, num_units, activation=None)  # (N, T_q, C)
+        K = tf.layers.dense(keys, num_units, activation=None)  # (N, T_k, C)
+        V = tf.layers.dense(keys, num_units, activation=None)  # (N, T_k, C)
+        Q_ = tf.concat(tf.split(Q, num_heads, axis=2), axis=0)  # (h*N, T_q, C/h)
+        K_ = tf.concat(tf.split(K, num_heads, axis=2), axis=0)  # (h*N, T_k, C/h)
+        V_ = tf.concat(tf.split(V, num_heads, axis=2), axis=0)  # (h*N, T_k, C/h)
+
+        outputs = tf.matmul(Q_, tf.transpose(K_, [0, 2, 1]))  # (h*N, T_q, T_k)
+        outputs = outputs / (K_.get_shape().as_list()[-1] ** 0.5)
+
+        key_masks = tf.sign(tf.abs(tf.reduce_sum(keys, axis=-1)))  # (N, T_k)
+        key_masks = tf.tile(key_masks, [num_heads, 1])  # (h*N, T_k)
+        key_masks = tf.tile(tf.expand_dims(key_masks, 1), [1, tf.shape(queries)[1], 1])  # (h*N, T_q, T_k)
+        paddings = tf.ones_like(outputs) * (-2**32+1)
+        outputs = tf.where(tf.equal(key_masks, 0), paddings, outputs)  # (h*N, T_q, T_k)
+
+        if causality:
+            diag_vals = tf.ones_like(outputs[0, :, :])  # (T_q, T_k)
+            tril = tf.linalg.LinearOperatorLowerTriangular(diag_vals).to_dense()  # (T_q, T_k)
+            masks = tf.tile(tf.expand_dims(tril, 0), [tf.shape(outputs)[0], 1, 1])  # (h*N, T_q, T_k)
+            paddings = tf.ones_like(masks) * (-2**32+1)
+            outputs = tf.where(tf.equal(masks, 0), paddings, outputs)  # (h*N, T_q, T_k)
+
+        outputs = tf.nn.softmax(outputs)  # (h*N, T_q, T_k)
+
+        query_masks = tf.sign(tf.abs(tf.reduce_sum(queries, axis=-1)))  # (N, T_q)
+        query_masks = tf.tile(query_masks, [num_heads, 1])  # (h*N, T_q)
+        query_masks = tf.tile(tf.expand_dims(query_masks, -1), [1, 1, tf.shape(keys)[1]])  # (h*N, T_q, T_k)
+        outputs *= query_masks
+
+        outputs = tf.layers.dropout(outputs, rate=dropout_rate, training=tf.convert_to_tensor(is_training))
+        attention_weights = outputs
+        outputs = tf.matmul(outputs, V_)  # (h*N, T_q, C/h)
+        outputs = tf.concat(tf.split(outputs, num_heads, axis=0), axis=2)  # (N, T_q, C)
+        outputs += queries
+    return outputs, attention_weights
+
+
+def peak_memory(sess, fetches):
+    '''
+    Returns the peak of the live tensor bytes, replayed from the allocation records,
+    and the total bytes of all tensors allocated while running :fetches: once.
+    '''
+    run_metadata = tf.RunMetadata()
+    sess.run(fetches, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), run_metadata=run_metadata)
+    nodes = [node for device in run_metadata.step_stats.dev_stats for node in device.node_stats]
+    records = sorted((r.alloc_micros, r.alloc_bytes) for node in nodes for m in node.memory
+                     for r in m.allocation_records)
+    peak = np.cumsum([alloc_bytes for _, alloc_bytes in records]).max() if records else 0
+    allocated = sum(o.tensor_description.allocation_description.requested_bytes for node in nodes for o in node.output)
+    return peak, allocated
+
+
+def timed(fn, repeats):
+    fn()
+    t0 = time.time()
+    for _ in range(repeats):
+        fn()
+    return (time.time() - t0) / repeats
+
+
+def benchmark_sampler(args):
+    [train, _, _, usernum, itemnum, _] = data_partition(args.dataset)
+    min_timedelta, max_timedelta = get_delta_range(train)
+    np.random.seed(args.seed)
+
+    sampler = BatchSampler(train, usernum, itemnum, args.maxlen, args.bin_in_hours, args.max_bins,
+                           False, min_timedelta, max_timedelta)
+    legacy = timed(lambda: legacy_sample_batch(train, usernum, itemnum, args.batch_size, args.maxlen,
+                                               args.bin_in_hours, args.max_bins), args.repeats)
+    batched = timed(lambda: sampler.sample(args.batch_size), args.repeats)
+
+    print('sampler (maxlen={}, batch_size={}, {} batches)'.format(args.maxlen, args.batch_size, args.repeats))
+    print('  per-row     : {:8.2f} ms/batch  {:8.1f} batches/s'.format(legacy * 1e3, 1 / legacy))
+    print('  BatchSampler: {:8.2f} ms/batch  {:8.1f} batches/s'.format(batched * 1e3, 1 / batched))
+    print('  speedup     : {:8.1f}x'.format(legacy / batched))
+
+
+def benchmark_input_pipeline(args):
+    train_args = build_parser().parse_args(args.train_args)
+    [train, _, _, usernum, itemnum, ratingnum] = data_partition(train_args.dataset)
+
+    print('input pipeline ({}, maxlen={}, batch_size={}, {} sampler workers, {} steps)'.format(
+        train_args.model, train_args.maxlen, train_args.batch_size, train_args.sampler_workers, args.steps))
+    results = {}
+    for pipeline in ['feed_dict', 'tf_data']:
+        tf.reset_default_graph()
+        if pipeline == 'tf_data':
+            sampler = None
+            inputs = train_inputs(batch_sampler(train_args, train, usernum, itemnum), train_args.batch_size,
+                                  train_args.seed)
+        else:
+            sampler = WarpSampler(train_args, train, usernum, itemnum, batch_size=train_args.batch_size,
+                                  maxlen=train_args.maxlen, n_workers=train_args.sampler_workers)
+            inputs = None
+        try:
+            model = build_model(train_args, usernum, itemnum, ratingnum, inputs)
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                for _ in range(args.warmup):
+                    sess.run(model.train_op, train_feed_dict(model, sampler, inputs))
+                results[pipeline] = timed(lambda: sess.run([model.loss, model.train_op],
+                                                           train_feed_dict(model, sampler, inputs)), args.steps)
+        finally:
+            if sampler is not None:
+                sampler.close()
+        print('  {:<9}: {:8.2f} ms/step  {:8.1f} batches/s'.format(pipeline, results[pipeline] * 1e3,
+                                                                   1 / results[pipeline]))
+    print('  speedup  : {:8.2f}x'.format(results['feed_dict'] / results['tf_data']))
+
+
+def padded_sequences(rng, batch_size, maxlen, hidden_units):
+    # left-padded sequences, as built by the sampler
+    lengths = rng.randint(1, maxlen + 1, size=batch_size)
+    x = rng.randn(batch_size, maxlen, hidden_units).astype(np.float32)
+    x[np.arange(maxlen)[None, :] < (maxlen - lengths)[:, None]] = 0
+    return x
+
+
+def attention_train_step(x, attend, num_blocks):
+    '''
+    Stacks :num_blocks: causal self-attention blocks :attend:(seq, scope) on the
+    constant sequences :x: and returns their output and a training step.
+    '''
+    seq = tf.constant(x)
+    for i in range(num_blocks):
+        seq, _ = attend(seq, 'block_{}'.format(i))
+    loss = tf.reduce_mean(tf.square(seq))
+    return seq, tf.train.GradientDescentOptimizer(1e-6).minimize(loss)
+
+
+def benchmark_attention(args):
+    x = padded_sequences(np.random.RandomState(args.seed), args.batch_size, args.maxlen, args.hidden_units)
+
+    print('attention ({} blocks, batch_size={}, maxlen={}, hidden_units={}, num_heads={}, {} steps)'.format(
+        args.num_blocks, args.batch_size, args.maxlen, args.hidden_units, args.num_heads, args.repeats))
+    variables, outputs = None, {}
+    for name in ['tiled masks', 'additive bias']:
+        tf.reset_default_graph()
+
+        def attend(seq, scope):
+            kwargs = dict(queries=seq, keys=seq, num_units=args.hidden_units, num_heads=args.num_heads,
+                          dropout_rate=0.0, is_training=True, causality=True, scope=scope)
+            if name == 'tiled masks':
+                return legacy_multihead_attention(**kwargs)
+            return multihead_attention(None, **kwargs)
+        seq, train_op = attention_train_step(x, attend, args.num_blocks)
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            # the same weights for both, to compare the outputs
+            if variables is None:
+                variables = sess.run({v.name: v for v in tf.global_variables()})
+            else:
+                for v in tf.global_variables():
+                    v.load(variables[v.name], sess)
+            outputs[name] = sess.run(seq)
+            forward = timed(lambda: sess.run(seq), args.repeats)
+            step = timed(lambda: sess.run(train_op), args.repeats)
+            peak, allocated = peak_memory(sess, train_op)
+        print('  {:<13}: forward {:8.2f} ms  train step {:8.2f} ms  peak {:8.1f} MB  allocated {:8.1f} MB'.format(
+            name, forward * 1e3, step * 1e3, peak / 2 ** 20, allocated / 2 ** 20))
+    print('  max abs difference of the outputs: {:.3g}'.format(
+        np.abs(outputs['tiled masks'] - outputs['additive bias']).max()))
+
+
+def benchmark_long_attention(args):
+    print('long attention ({} blocks, batch_size={}, hidden_units={}, num_heads={}, window={}, {} steps)'.format(
+        args.num_blocks, args.batch_size, args.hidden_units, args.num_heads, args.attention_window, args.repeats))
+    for maxlen in args.maxlen:
+        x = padded_sequences(np.random.RandomState(args.seed), args.batch_size, maxlen, args.hidden_units)
+        for mode in ['full', 'local']:
+            tf.reset_default_graph()
+            # multihead_attention reads the mode from the model
+            model = argparse.Namespace(attention_mode=mode, attention_window=args.attention_window)
+            _, train_op = attention_train_step(x, lambda seq, scope: multihead_attention(
+                model, seq, seq, num_units=args.hidden_units, num_heads=args.num_heads, dropout_rate=0.0,
+                is_training=True, causality=True, scope=scope), args.num_blocks)
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                step = timed(lambda: sess.run(train_op), args.repeats)
+                peak, allocated = peak_memory(sess, train_op)
+            print('  maxlen={:<5d} {:<5}: train step {:9.2f} ms  peak {:8.1f} MB  allocated {:9.1f} MB'.format(
+                maxlen, mode, step * 1e3, peak / 2 ** 20, allocated / 2 ** 20))
+
+
+def benchmark_context_towers(args):
+    train_args = build_parser().parse_args(args.train_args)
+    [train, _, _, usernum, itemnum, ratingnum] = data_partition(train_args.dataset)
+    sampler = WarpSampler(train_args, train, usernum, itemnum, batch_size=train_args.batch_size,
+                          maxlen=train_args.maxlen, n_workers=1)
+    try:
+        batch = sampler.next_batch()
+    finally:
+        sampler.close()
+
+    print('context towers ({}, maxlen={}, batch_size={}, hidden_units={}, num_heads={}, {} steps)'.format(
+        train_args.model, train_args.maxlen, train_args.batch_size, train_args.hidden_units,
+        train_args.num_heads, args.steps))
+    variables, outputs, results = None, {}, {}
+    for name in ['separate', 'batched']:
+        tf.reset_default_graph()
+        train_args.batched_context_towers = name == 'batched'
+        model = build_model(train_args, usernum, itemnum, ratingnum)
+        feed_dict = {getattr(model, input): value for input, value in zip(TRAIN_INPUTS, batch) if hasattr(model, input)}
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            # the same weights (and variable names) for both, to compare the outputs
+            if variables is None:
+                variables = sess.run({v.name: v for v in tf.global_variables()})
+            else:
+                for v in tf.global_variables():
+                    v.load(variables[v.name], sess)
+            feed_dict[model.is_training] = False
+            outputs[name] = sess.run(model.seq, feed_dict)
+            feed_dict[model.is_training] = True
+            for _ in range(args.warmup):
+                sess.run(model.train_op, feed_dict)
+            results[name] = timed(lambda: sess.run([model.loss, model.train_op], feed_dict), args.steps)
+        print('  {:<8}: train step {:8.2f} ms'.format(name, results[name] * 1e3))
+    print('  speedup : {:8.2f}x'.format(results['separate'] / results['batched']))
+    print('  max abs difference of the outputs: {:.3g}'.format(np.abs(outputs['separate'] - outputs['batched']).max()))
+
+
+def benchmark_ann(args):
+    rng = np.random.RandomState(args.seed)
+    if args.checkpoint:
+        item_emb = load_item_embeddings(args.checkpoint)
+        # queries close to the item embeddings, the scale of real sequence representations is unknown here
+        queries = item_emb[rng.randint(1, len(item_emb), size=args.queries)]
+        queries = queries + 0.1 * queries.std() * rng.randn(*queries.shape)
+    else:
+        # clustered synthetic embeddings
+        centers = rng.randn(args.num_items // 200 + 1, args.dim)
+        item_emb = centers[rng.randint(len(centers), size=args.num_items + 1)] + 0.5 * rng.randn(args.num_items + 1, args.dim)
+        item_emb[0] = 0
+        queries = centers[rng.randint(len(centers), size=args.queries)] + 0.5 * rng.randn(args.queries, args.dim)
+    item_emb = item_emb.astype(np.float32)
+    queries = queries.astype(np.float32)
+
+    t0 = time.time()
+    index = IVFIndex.build(item_emb, nlist=args.nlist, seed=args.seed)
+    build_time = time.time() - t0
+
+    exact_ids, _ = exact_top_k(item_emb, queries, args.k)
+    exact = timed(lambda: exact_top_k(item_emb, queries, args.k), args.repeats) / len(queries)
+
+    print('ann ({} items, dim={}, nlist={}, {} queries, k={}, build {:.1f}s)'.format(
+        len(item_emb) - 1, item_emb.shape[1], index.nlist, len(queries), args.k, build_time))
+    print('  exact       : {:8.4f} ms/query  recall@{} 1.000'.format(exact * 1e3, args.k))
+    for nprobe in args.nprobe:
+        ids, _ = index.search(queries, args.k, nprobe)
+        recall = np.mean([len(set(a) & set(b)) for a, b in zip(ids, exact_ids)]) / args.k
+        latency = timed(lambda: index.search(queries, args.k, nprobe), args.repeats) / len(queries)
+        print('  nprobe={:<5d}: {:8.4f} ms/query  recall@{} {:.3f}  {:6.1f}x'.format(
+            nprobe, latency * 1e3, args.k, recall, exact / latency))
+
+
+def benchmark_serve(args):
+    recommender = Recommender(args.train_dir)
+    rng = np.random.RandomState(args.seed)
+
+    # request the recommendations of real users if the dataset is available
+    requests = []
+    if os.path.exists(recommender.args.dataset):
+        train = data_partition(recommender.args.dataset)[0]
+        users = rng.choice(np.flatnonzero(train.lengths() > 0), size=args.requests)
+        for u in users:
+            history = train[u]
+            requests.append({'items': history.item[-args.history:].tolist(),
+                             'timestamps': history.timestamp[-args.history:].tolist(), 'k': args.k})
+    else:
+        now = int(time.time())
+        for _ in range(args.requests):
+            items = rng.randint(1, recommender.itemnum + 1, size=args.history)
+            timestamps = np.sort(rng.randint(now - 365 * 86400, now, size=args.history))
+            requests.append({'items': items.tolist(), 'timestamps': timestamps.tolist(), 'k': args.k})
+    payloads = [json.dumps(r) for r in requests]
+
+    def run(max_batch_size):
+        batcher = MicroBatcher(recommender, max_batch_size, args.max_wait_ms)
+        server = make_server(batcher, port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        port = server.server_address[1]
+
+        latencies = [[] for _ in range(args.concurrency)]
+
+        def client(c):
+            conn = http.client.HTTPConnection('127.0.0.1', port)
+            for payload in payloads[c::args.concurrency]:
+                t0 = time.time()
+                conn.request('POST', '/recommend', payload, {'Content-Type': 'application/json'})
+                response = conn.getresponse()
+                response.read()
+                latencies[c].append(time.time() - t0)
+                assert response.status == 200
+            conn.close()
+
+        t0 = time.time()
+        clients = [threading.Thread(target=client, args=(c,)) for c in range(args.concurrency)]
+        for c in clients:
+            c.start()
+        for c in clients:
+            c.join()
+        elapsed = time.time() - t0
+        server.shutdown()
+        server.server_close()
+
+        latencies = np.concatenate(latencies) * 1e3
+        print('  max_batch_size={:<4d}: p50 {:7.2f} ms  p99 {:7.2f} ms  {:8.1f} requests/s'.format(
+            max_batch_size, np.percentile(latencies, 50), np.percentile(latencies, 99), len(latencies) / elapsed))
+
+    print('serve ({}, maxlen={}, {} items, {} requests, concurrency={}, k={})'.format(
+        recommender.args.model, recommender.maxlen, recommender.itemnum, args.requests, args.concurrency, args.k))
+    # warm up
+    recommender.recommend(requests[:args.max_batch_size])
+    run(1)
+    run(args.max_batch_size)
+
+
+def benchmark_stream(args):
+    recommender = Recommender(args.train_dir, state_cache_bytes=args.state_cache_mb << 20)
+    rng = np.random.RandomState(args.seed)
+
+    # a clickstream of single events, each followed by :recommendations: requests of the same user
+    now = int(time.time())
+    histories = {u: ([], []) for u in range(args.users)}
+    stream = []
+    for step in range(args.events):
+        u = rng.randint(args.users)
+        stream.append((u, int(rng.randint(1, recommender.itemnum + 1)), now + step))
+
+    # the first recommendation after an event encodes the whole window, as a stateless one does
+    stateless, cached, after_event = [], [], []
+    for u, item, timestamp in stream:
+        items, timestamps = histories[u]
+        items.append(item)
+        timestamps.append(timestamp)
+        recommender.cache.add_events(u, [item], [timestamp])
+        for r in range(args.recommendations):
+            t0 = time.time()
+            recommender.recommend([{'items': items[-recommender.maxlen:], 'timestamps': timestamps[-recommender.maxlen:],
+                                    'k': args.k}])
+            stateless.append(time.time() - t0)
+
+            t0 = time.time()
+            recommender.recommend([{'user': u, 'k': args.k}])
+            (cached if r else after_event).append(time.time() - t0)
+
+    print('stream ({}, maxlen={}, {} users, {} events, {} recommendations per event, k={})'.format(
+        recommender.args.model, recommender.maxlen, args.users, args.events, args.recommendations, args.k))
+    for name, latencies in (('stateless', stateless), ('new events', after_event), ('cache hit', cached)):
+        if not latencies:
+            continue
+        latencies = np.array(latencies) * 1e3
+        print('  {:<12}: mean {:7.2f} ms  p50 {:7.2f} ms  p99 {:7.2f} ms'.format(
+            name, latencies.mean(), np.percentile(latencies, 50), np.percentile(latencies, 99)))
+    print('  cached users: {} ({:.2f} MB)'.format(len(recommender.cache), recommender.cache.nbytes / 2 ** 20))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the data and model pipeline')
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    sampler_parser = subparsers.add_parser('sampler', help='Training batch sampling throughput')
+    sampler_parser.add_argument('--dataset', required=True, help='Location of pre-processed dataset')
+    sampler_parser.add_argument('--maxlen', default=200, type=int)
+    sampler_parser.add_argument('--batch_size', default=128, type=int)
+    sampler_parser.add_argument('--bin_in_hours', default=48, type=int)
+    sampler_parser.add_argument('--max_bins', default=200, type=int)
+    sampler_parser.add_argument('--repeats', default=20, type=int)
+    sampler_parser.add_argument('--seed', default=42, type=int)
+    sampler_parser.set_defaults(run=benchmark_sampler)
+
+    input_parser = subparsers.add_parser('input_pipeline', help='Training steps per second with feed_dict and tf.data inputs; '
+                                         'all other arguments are passed to the training parser of main.py')
+    input_parser.add_argument('--steps', default=100, type=int)
+    input_parser.add_argument('--warmup', default=10, type=int)
+    input_parser.set_defaults(run=benchmark_input_pipeline)
+
+    attention_parser = subparsers.add_parser('attention', help='Step time and memory of the causal self-attention blocks')
+    attention_parser.add_argument('--maxlen', default=200, type=int)
+    attention_parser.add_argument('--batch_size', default=128, type=int)
+    attention_parser.add_argument('--hidden_units', default=50, type=int)
+    attention_parser.add_argument('--num_heads', default=1, type=int)
+    attention_parser.add_argument('--num_blocks', default=2, type=int)
+    attention_parser.add_argument('--repeats', default=10, type=int)
+    attention_parser.add_argument('--seed', default=42, type=int)
+    attention_parser.set_defaults(run=benchmark_attention)
+
+    long_parser = subparsers.add_parser('long_attention', help='Step time and memory of full and local attention '
+                                        'at increasing sequence lengths')
+    long_parser.add_argument('--maxlen', default=[200, 500, 1000], type=int, nargs='+')
+    long_parser.add_argument('--attention_window', default=50, type=int)
+    long_parser.add_argument('--batch_size', default=128, type=int)
+    long_parser.add_argument('--hidden_units', default=50, type=int)
+    long_parser.add_argument('--num_heads', default=1, type=int)
+    long_parser.add_argument('--num_blocks', default=2, type=int)
+    long_parser.add_argument('--repeats', default=3, type=int)
+    long_parser.add_argument('--seed', default=42, type=int)
+    long_parser.set_defaults(run=benchmark_long_attention)
+
+    towers_parser = subparsers.add_parser('context_towers', help='Train step time of cast_8 or cast_9 with separate '
+                                          'and batched context towers; all other arguments are passed to the '
+                                          'training parser of main.py')
+    towers_parser.add_argument('--steps', default=20, type=int)
+    towers_parser.add_argument('--warmup', default=3, type=int)
+    towers_parser.set_defaults(run=benchmark_context_towers)
+
+    ann_parser = subparsers.add_parser('ann', help='Recall and latency of the IVF index against exact search')
+    ann_parser.add_argument('--checkpoint', default=None,
+                            help='Checkpoint (directory) to take the item embeddings from, synthetic if not given')
+    ann_parser.add_argument('--num_items', default=500000, type=int, help='Number of synthetic items')
+    ann_parser.add_argument('--dim', default=50, type=int, help='Dimension of the synthetic embeddings')
+    ann_parser.add_argument('--queries', default=1000, type=int)
+    ann_parser.add_argument('--k', default=10, type=int)
+    ann_parser.add_argument('--nlist', default=None, type=int, help='Number of clusters, 4 * sqrt(items) by default')
+    ann_parser.add_argument('--nprobe', default=[1, 2, 4, 8, 16, 32], type=int, nargs='+')
+    ann_parser.add_argument('--repeats', default=3, type=int)
+    ann_parser.add_argument('--seed', default=42, type=int)
+    ann_parser.set_defaults(run=benchmark_ann)
+
+    serve_parser = subparsers.add_parser('serve', help='Latency of the inference server under concurrent requests')
+    serve_parser.add_argument('--train_dir', required=True,
+                              help='Training run directory (saved_models/<dataset>/<run>) with params.txt')
+    serve_parser.add_argument('--requests', default=2000, type=int)
+    serve_parser.add_argument('--concurrency', default=8, type=int, help='Number of concurrent clients')
+    serve_parser.add_argument('--history', default=200, type=int, help='Length of the requested histories')
+    serve_parser.add_argument('--k', default=10, type=int)
+    serve_parser.add_argument('--max_batch_size', default=64, type=int)
+    serve_parser.add_argument('--max_wait_ms', default=0.0, type=float)
+    serve_parser.add_argument('--seed', default=42, type=int)
+    serve_parser.set_defaults(run=benchmark_serve)
+
+    stream_parser = subparsers.add_parser('stream', help='Recommendations in a clickstream, with and without the user state cache')
+    stream_parser.add_argument('--train_dir', required=True,
+                               help='Training run directory (saved_models/<dataset>/<run>) with params.txt')
+    stream_parser.add_argument('--users', default=50, type=int)
+    stream_parser.add_argument('--events', default=2000, type=int)
+    stream_parser.add_argument('--recommendations', default=3, type=int,
+                               help='Number of recommendation requests after every event')
+    stream_parser.add_argument('--k', default=10, type=int)
+    stream_parser.add_argument('--state_cache_mb', default=256, type=int)
+    stream_parser.add_argument('--seed', default=42, type=int)
+    stream_parser.set_defaults(run=benchmark_stream)
+
+    args, train_args = parser.parse_known_args()
+    args.train_args = train_args
+    if train_args and args.benchmark not in ('input_pipeline', 'context_towers'):
+        parser.error('unrecognized arguments: {}'.format(' '.join(args.train_args)))
+    if args.benchmark is None:
+        parser.print_help()
+        sys.exit(1)
+    args.run(args)
@@ -1,12 +1,273 @@
+import ast
 import gzip
 import json
+import heapq
+import itertools
 import os
+import tempfile
 from tqdm import tqdm
 import datetime
-from collections import defaultdict
+from collections import deque
+import multiprocessing
+
+import numpy as np
 
 import logging
 
+
+def parse_amazon_line(line):
+    '''
+    Parses one review of the Amazon Product Review data. The newer dumps are
+    strict JSON, the older ones Python dict literals (single quotes), which are
+    read with ast.literal_eval instead of eval.
+    '''
+    try:
+        return json.loads(line)
+    except ValueError:
+        return ast.literal_eval(line.decode('utf-8') if isinstance(line, bytes) else line)
+
+
+def parse_amazon_chunk(lines):
+    '''
+    Parses a chunk of raw review lines into the four fields used by the
+    pre-processing, so that only these (not the review texts) are sent back
+    from a worker process.
+
+    Returns
+    -------
+
+    reviewers, asins, ratings, times : list
+        reviewerID, asin, str(overall) and unixReviewTime of every line.
+    '''
+    reviewers, asins, ratings, times = [], [], [], []
+    for line in lines:
+        l = parse_amazon_line(line)
+        reviewers.append(l['reviewerID'])
+        asins.append(l['asin'])
+        ratings.append(str(l['overall']))
+        times.append(l['unixReviewTime'])
+    return reviewers, asins, ratings, times
+
+
+def encode(keys, codes):
+    '''
+    Maps hashable :keys: (e.g. reviewer ids) to integer codes, adding unseen
+    keys to the :codes: dict in order of first appearance.
+    '''
+    return np.array([codes.setdefault(k, len(codes)) for k in keys], dtype=np.int64)
+
+
+def first_appearance_ids(codes):
+    '''
+    Maps the non-negative integer :codes: to dense ids 1..n in order of their
+    first appearance.
+
+    Returns
+    -------
+
+    ids : np.ndarray
+        The new id of every entry of :codes:.
+    order : np.ndarray
+        The codes in id order, i.e. order[id - 1] is the code of id.
+    '''
+    unique, first = np.unique(codes, return_index=True)
+    order = unique[np.argsort(first, kind='stable')]
+    mapping = np.zeros(int(codes.max()) + 1 if codes.size else 0, dtype=np.int64)
+    mapping[order] = np.arange(1, len(order) + 1)
+    return mapping[codes], order
+
+
+def k_core(users, items, k=5):
+    '''
+    Returns a mask of the interactions in the :k:-core, the largest subset in
+    which every user and every item has at least :k: interactions. Users and
+    items are removed repeatedly until no count drops below :k: anymore.
+    '''
+    keep = np.ones(len(users), dtype=bool)
+    rows = np.arange(len(users))
+    while True:
+        u, i = users[rows], items[rows]
+        valid = (np.bincount(u)[u] >= k) & (np.bincount(i)[i] >= k)
+        if valid.all():
+            return keep
+        keep[rows[~valid]] = False
+        rows = rows[valid]
+
+
+def k_core_sequences(users, items, times, k=5):
+    '''
+    Reduces the interactions (integer user/item codes, one entry per line of
+    the source) to their :k:-core, assigns dense user and item ids in order of
+    first appearance and sorts the interactions on (user, time). The sort is
+    stable, so interactions with the same time keep their source order.
+
+    Returns
+    -------
+
+    rows : np.ndarray
+        Source index of every kept interaction, in output order.
+    users, items : np.ndarray
+        Dense user and item id of every output interaction.
+    item_codes : np.ndarray
+        Source code of every item id, i.e. item_codes[id - 1].
+    '''
+    rows = np.flatnonzero(k_core(users, items, k))
+    users, _ = first_appearance_ids(users[rows])
+    items, item_codes = first_appearance_ids(items[rows])
+    order = np.lexsort((times[rows], users))
+    return rows[order], users[order], items[order], item_codes
+
+
+def format_interactions(users, items, ratings, times):
+    return ''.join('{} {} {} {}\n'.format(*l) for l in zip(users, items, ratings, times))
+
+
+def write_interactions(fpath, users, items, ratings, times, rating_values=None, chunk_size=1 << 20):
+    '''
+    Writes "user item rating time" lines. If :rating_values: is given, :ratings:
+    are indices into it (e.g. the original rating strings).
+    '''
+    with open(fpath, 'w') as f:
+        for start in tqdm(range(0, len(users), chunk_size)):
+            end = start + chunk_size
+            chunk_ratings = ratings[start:end]
+            if rating_values is not None:
+                chunk_ratings = rating_values[chunk_ratings]
+            f.write(format_interactions(users[start:end].tolist(), items[start:end].tolist(),
+                                        chunk_ratings.tolist(), times[start:end].tolist()))
+
+
+# memory per interaction of a spilled chunk: four int64 columns plus the
+# temporaries of filtering and sorting it
+SPILL_ROW_BYTES = 128
+
+SPILL_COLUMNS = ['users', 'items', 'ratings', 'times']
+
+
+class SpilledInteractions():
+    '''
+    Interaction codes spilled to disk in chunks of about :chunk_rows: rows, for
+    sources whose interactions do not fit in memory. Only per-user and per-item
+    arrays are kept in memory: the k-core filter and the id assignment stream
+    over the chunks, every chunk is then sorted on (user, time) on its own and
+    the sorted runs are merged with heapq.merge.
+
+    Arguments
+    ---------
+
+    chunks : iterable
+        (users, items, ratings, times) arrays of integer codes, in source order.
+    directory : str
+        Scratch directory for the chunk files.
+    chunk_rows : int
+        Number of interactions held in memory at once.
+    '''
+
+    def __init__(self, chunks, directory, chunk_rows):
+        self.directory = directory
+        self.chunk_rows = chunk_rows
+        self.num_chunks = 0
+        self.num_users = 0
+        self.num_items = 0
+
+        buffered, rows = [], 0
+        for chunk in chunks:
+            buffered.append(chunk)
+            rows += len(chunk[0])
+            if rows >= chunk_rows:
+                self.spill([np.concatenate(c) for c in zip(*buffered)])
+                buffered, rows = [], 0
+        if buffered:
+            self.spill([np.concatenate(c) for c in zip(*buffered)])
+
+    def path(self, index, column):
+        return os.path.join(self.directory, '{}_{}.npy'.format(index, column))
+
+    def spill(self, columns, index=None):
+        if index is None:
+            index = self.num_chunks
+            self.num_chunks += 1
+            if len(columns[0]):
+                self.num_users = max(self.num_users, int(columns[0].max()) + 1)
+                self.num_items = max(self.num_items, int(columns[1].max()) + 1)
+        for name, values in zip(SPILL_COLUMNS, columns):
+            np.save(self.path(index, name), values)
+
+    def chunks(self, mmap_mode=None):
+        for index in range(self.num_chunks):
+            yield [np.load(self.path(index, name), mmap_mode=mmap_mode) for name in SPILL_COLUMNS]
+
+    def k_core(self, k=5):
+        '''
+        Same filter as k_core(), with one pass over the chunks per round.
+        Sets the :valid_users: and :valid_items: masks of the k-core.
+        '''
+        self.valid_users = np.ones(self.num_users, dtype=bool)
+        self.valid_items = np.ones(self.num_items, dtype=bool)
+        while True:
+            user_counts = np.zeros(self.num_users, dtype=np.int64)
+            item_counts = np.zeros(self.num_items, dtype=np.int64)
+            for users, items, _, _ in self.chunks():
+                keep = self.valid_users[users] & self.valid_items[items]
+                user_counts += np.bincount(users[keep], minlength=self.num_users)
+                item_counts += np.bincount(items[keep], minlength=self.num_items)
+            valid_users, valid_items = user_counts >= k, item_counts >= k
+            if (valid_users == self.valid_users).all() and (valid_items == self.valid_items).all():
+                return
+            self.valid_users, self.valid_items = valid_users, valid_items
+
+    def sort(self):
+        '''
+        Assigns dense ids in order of first appearance and replaces every chunk
+        by its k-core interactions, sorted on (user, time).
+
+        Returns
+        -------
+
+        item_codes : np.ndarray
+            Source code of every item id, i.e. item_codes[id - 1].
+        '''
+        user_ids = np.zeros(self.num_users, dtype=np.int64)
+        item_ids = np.zeros(self.num_items, dtype=np.int64)
+        item_codes = []
+        for index, (users, items, ratings, times) in enumerate(self.chunks()):
+            keep = self.valid_users[users] & self.valid_items[items]
+            users, items, ratings, times = users[keep], items[keep], ratings[keep], times[keep]
+
+            # codes first seen in this chunk continue the ids of the chunks before
+            for codes, ids, order in ((users, user_ids, None), (items, item_ids, item_codes)):
+                _, new = first_appearance_ids(codes)
+                new = new[ids[new] == 0]
+                start = ids.max() if ids.size else 0
+                ids[new] = np.arange(start + 1, start + len(new) + 1)
+                if order is not None:
+                    order.append(new)
+
+            users, items = user_ids[users], item_ids[items]
+            order = np.lexsort((times, users))
+            self.spill([users[order], items[order], ratings[order], times[order]], index)
+        return np.concatenate(item_codes) if item_codes else np.zeros(0, dtype=np.int64)
+
+    def merge(self):
+        '''
+        Yields the (user, item, rating, time) rows of all sorted chunks merged
+        on (user, time). heapq.merge is stable, so equal keys keep their source
+        order.
+        '''
+        block_rows = max(1024, self.chunk_rows // max(self.num_chunks, 1))
+
+        def rows(columns):
+            users, items, ratings, times = columns
+            for start in range(0, len(users), block_rows):
+                end = start + block_rows
+                for row in zip(users[start:end].tolist(), items[start:end].tolist(),
+                               ratings[start:end].tolist(), times[start:end].tolist()):
+                    yield row
+
+        runs = [rows(columns) for columns in self.chunks(mmap_mode='r')]
+        return heapq.merge(*runs, key=lambda row: (row[0], row[3]))
+
+
 class DataReader():
 
     """
@@ -24,13 +285,18 @@ class DataReader():
     }
     """
 
-    def __init__(self, path, dataset_fp, type, limit=None, maxlen=None):
+    def __init__(self, path, dataset_fp, type, limit=None, maxlen=None, workers=None, chunk_lines=20000, min_count=5,
+                 memory_limit=None):
         self.path = path
         self.limit = limit
         self.dataset_fp = dataset_fp
         self.type = type
         self.logger = logging.getLogger('ir2')
         self.maxlen = maxlen
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.chunk_lines = chunk_lines
+        self.min_count = min_count
+        self.memory_limit = memory_limit
 
     def preprocess(self):
         assert type(self.type) == str
@@ -41,90 +307,109 @@ class DataReader():
         elif self.type == 'amazon_ratings':
             self.preprocess_amazon_ratings()
 
+    def read_lines(self):
+        '''
+        Reads the raw dataset (plain or gzip) once, yielding lists of at most
+        :chunk_lines: lines.
+        '''
+        # as before, a limit of n reads the first n + 1 lines
+        remaining = self.limit + 1 if self.limit else None
+        opener = gzip.open if self.path.endswith('.gz') else open
+        with opener(self.path, 'rb') as g:
+            chunk = []
+            for l in g:
+                if remaining is not None:
+                    if remaining == 0:
+                        break
+                    remaining -= 1
+                chunk.append(l)
+                if len(chunk) == self.chunk_lines:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
     def parse_amazon(self):
-        g = gzip.open(self.path, 'rb')
-        for i, l in enumerate(g):
-            if self.limit and i > self.limit:
-                break
-            yield eval(l)
+        for lines in self.read_lines():
+            for l in lines:
+                yield parse_amazon_line(l)
+
+    def parse_amazon_chunks(self):
+        '''
+        Yields the parsed chunks (see parse_amazon_chunk) in file order. Chunks
+        are parsed by :workers: processes, with at most two chunks per worker in
+        flight so that memory stays bounded however fast the gzip is read.
+        '''
+        if self.workers <= 1:
+            for lines in self.read_lines():
+                yield parse_amazon_chunk(lines)
+            return
+
+        with multiprocessing.Pool(self.workers) as pool:
+            pending = deque()
+            for lines in self.read_lines():
+                if len(pending) >= 2 * self.workers:
+                    yield pending.popleft().get()
+                pending.append(pool.apply_async(parse_amazon_chunk, (lines,)))
+            while pending:
+                yield pending.popleft().get()
 
     def parse_movielens(self):
-        f = open(self.path, 'r')
-        for i, l in enumerate(f):
-            if self.limit and i > self.limit:
-                break
-            yield l.rstrip()
-        f.close()
+        for lines in self.read_lines():
+            for l in lines:
+                yield l.decode('utf-8').rstrip()
+
+    def movielens_interactions(self):
+        '''
+        Yields (users, items, ratings, times) chunks of the MovieLens ratings.
+        User and movie ids are used as codes as they are.
+        '''
+        total = 1000000 if not self.limit else self.limit
+        with tqdm(total=total) as progress:
+            for lines in self.read_lines():
+                data = np.array(b''.join(lines).replace(b',', b' ').split(), dtype=np.float64).reshape(-1, 4)
+                ratings = (data[:, 2] * 10).astype(np.int64)  # Ratings * 10 for half-division star ratings (e.g. 3.5)
+                yield data[:, 0].astype(np.int64), data[:, 1].astype(np.int64), ratings, data[:, 3].astype(np.int64)
+                progress.update(len(lines))
+
+    def amazon_ratings_interactions(self, item_codes, rating_codes):
+        '''
+        Yields (users, items, ratings, times) chunks of an Amazon ratings csv,
+        adding the item keys and rating strings to :item_codes: and
+        :rating_codes:.
+        '''
+        total = 8898041 if not self.limit else self.limit
+        user_codes = {}
+        with tqdm(total=total) as progress:
+            for lines in self.read_lines():
+                fields = [l.decode('utf-8').rstrip().split(',') for l in lines]
+                yield (encode([l[0] for l in fields], user_codes), encode([l[1] for l in fields], item_codes),
+                       encode([l[2] for l in fields], rating_codes), np.array([int(l[3]) for l in fields], dtype=np.int64))
+                progress.update(len(lines))
+
+    def amazon_interactions(self, item_codes, rating_codes):
+        '''
+        Yields (users, items, ratings, times) chunks of the Amazon reviews,
+        adding the asins and rating strings to :item_codes: and :rating_codes:.
+        '''
+        total = 8898041 if not self.limit else self.limit
+        reviewer_codes = {}
+        with tqdm(total=total) as progress:
+            for reviewers, asins, ratings, times in self.parse_amazon_chunks():
+                yield (encode(reviewers, reviewer_codes), encode(asins, item_codes),
+                       encode(ratings, rating_codes), np.array(times, dtype=np.int64))
+                progress.update(len(times))
 
     def preprocess_movielens(self):
         logging.info('Reading and processing {}'.format(self.path))
-
-        countU = defaultdict(lambda: 0)
-        countP = defaultdict(lambda: 0)
-        total = 1000000 if not self.limit else self.limit
-
-        delim = ','
-        f = open(self.dataset_fp, 'w')
-        for l in tqdm(self.parse_movielens(), total=total):
-            user, item, rating, timestamp = l.split(delim)
-            f.write('{} {} {} {}\n'.format(user, item, rating, timestamp))
-
-
-            asin = int(item)
-            rev = int(user)
-            countU[rev] += 1
-            countP[asin] += 1
-        f.close()
-
-        logging.info('Creating user map dictionary')
-        usermap = dict()
-        usernum = 0
-        itemmap = dict()
-        itemnum = 0
-        User = dict()
-        for l in tqdm(self.parse_movielens(), total=total):
-            rev, asin, rating, time = l.split(delim)
-            rev = int(rev)
-            asin = int(asin)
-            rating = int(float(rating)*10) # Ratings * 10 for half-division star ratings (e.g. 3.5)
-            time = int(time)
-
-            # Minimum of 5:
-            if countU[rev] < 5 or countP[asin] < 5:
-                continue
-
-            if rev in usermap:
-                userid = usermap[rev]
-            else:
-                usernum += 1
-                userid = usernum
-                usermap[rev] = userid
-                User[userid] = []
-            if asin in itemmap:
-                itemid = itemmap[asin]
-            else:
-                itemnum += 1
-                itemid = itemnum
-                itemmap[asin] = itemid
-            User[userid].append([itemid, rating, time])
-
-        logging.info('Sorting reviews for every user on time')
-        # sort reviews in User according to time
-        for userid in User.keys():
-            User[userid].sort(key=lambda x: x[2])
-            
-        # Original data writer
-        f = open(self.dataset_fp, 'w')
-        for user in User.keys():
-            for i in User[user]:
-                f.write('{} {} {} {}\n'.format(user, i[0], i[1], i[2]))
-        f.close()
+        item_order = self.write_k_core(self.movielens_interactions())
 
         # tsv metadata file (index/label)
         logging.info('Writing tsv metadata file (index/label)')
         d = os.path.dirname(self.dataset_fp)
         bn = os.path.basename(self.dataset_fp)
 
+        delim = ','
         movies_dict = {}
         movies_labels_path = os.path.join(os.path.dirname(self.path), 'movies.csv')
         with open(movies_labels_path, 'r', encoding='ISO-8859-1') as f:
@@ -135,148 +420,86 @@ class DataReader():
         metadata_fp = os.path.join(d, bn + '_metadata.tsv')
         genre_fp = open(os.path.join(d, bn + '_metadata_genres.tsv'), 'w')
         with open(metadata_fp, 'w') as f:
-            for k, v in tqdm(itemmap.items()):
+            for v, k in enumerate(tqdm(item_order.tolist()), 1):
                 # asin=k, index=v
                 f.write('{} {}\n'.format(v, movies_dict[k][0])) # movie
                 genre_fp.write('{} {}\n'.format(v, movies_dict[k][1])) #genre
         genre_fp.close()
 
     def preprocess_amazon_ratings(self):
-        countU = defaultdict(lambda: 0)
-        countP = defaultdict(lambda: 0)
-        total = 8898041 if not self.limit else self.limit
-
         logging.info('Reading and processing {}'.format(self.path))
-        f = open(self.dataset_fp, 'w')
-        for l in tqdm(self.parse_movielens(), total=total):
-            user, item, rating, timestamp = l.split(',')
-            f.write('{} {} {} {}\n'.format(user, item, rating, timestamp))
-
-            asin = item
-            rev = user
-            countU[rev] += 1
-            countP[asin] += 1
-        f.close()
-
-        logging.info('Creating user map dictionary')
-        usermap = dict()
-        usernum = 0
-        itemmap = dict()
-        itemnum = 0
-        User = dict()
-
-        for l in tqdm(self.parse_movielens(), total=total):
-            user, item, rating, timestamp = l.split(',')
-            asin = item
-            rev = user
-            time = timestamp
-
-        # Minimum of 5:
-            if countU[rev] < 5 or countP[asin] < 5:
-                continue
-
-            if rev in usermap:
-                userid = usermap[rev]
-            else:
-                usernum += 1
-                userid = usernum
-                usermap[rev] = userid
-                User[userid] = []
-            if asin in itemmap:
-                itemid = itemmap[asin]
-            else:
-                itemnum += 1
-                itemid = itemnum
-                itemmap[asin] = itemid
-            User[userid].append([itemid, rating, time])
-
-        logging.info('Sorting reviews for every user on time')
-        # sort reviews in User according to time
-        for userid in User.keys():
-            User[userid].sort(key=lambda x: x[2])
-
-        f = open(self.dataset_fp, 'w')
-        for user in tqdm(User.keys()):
-            for i in User[user]:
-                if self.input_context:
-                    f.write('{} {} {} {}\n'.format(user, i[0], i[1], i[2]))
-                else:
-                    f.write('{} {} {}\n'.format(user, i[0], i[2]))
-        f.close()
-
-        # product map
-        logging.info('Writing product item map')
-        d = os.path.dirname(self.dataset_fp)
-        bn = os.path.basename(self.dataset_fp)
-        metadata_fp = os.path.join(d, bn[:-4] + '_product_map.txt')
-        with open(metadata_fp, 'w') as f:
-            for k, v in tqdm(itemmap.items()):
-                f.write('{} {}\n'.format(k, v))
+        item_codes, rating_codes = {}, {}
+        item_order = self.write_k_core(self.amazon_ratings_interactions(item_codes, rating_codes), rating_codes)
+        self.write_product_map(item_codes, item_order, os.path.basename(self.dataset_fp)[:-4])
 
     def preprocess_amazon(self):
-        countU = defaultdict(lambda: 0)
-        countP = defaultdict(lambda: 0)
-        total = 8898041 if not self.limit else self.limit
-
+        # single pass over the reviews: reviewers, products and rating strings
+        # are stored as integer codes in order of first appearance
         logging.info('Reading and processing {}'.format(self.path))
-        f = open(self.dataset_fp, 'w')
-        for l in tqdm(self.parse_amazon(), total=total):
-            f.write(" ".join([l['reviewerID'], l['asin'], str(l['overall']), str(l['unixReviewTime'])]) + ' \n')
-            asin = l['asin']
-            rev = l['reviewerID']
-            time = l['unixReviewTime']
-            countU[rev] += 1
-            countP[asin] += 1
-        f.close()
-
-        logging.info('Creating user map dictionary')
-        usermap = dict()
-        usernum = 0
-        itemmap = dict()
-        itemnum = 0
-        User = dict()
-        for l in tqdm(self.parse_amazon(), total=total):
-            asin = l['asin']
-            rev = l['reviewerID']
-            rating = l['overall']
-            time = l['unixReviewTime']
-
-            # Minimum of 5:
-            if countU[rev] < 5 or countP[asin] < 5:
-                continue
-
-            if rev in usermap:
-                userid = usermap[rev]
-            else:
-                usernum += 1
-                userid = usernum
-                usermap[rev] = userid
-                User[userid] = []
-            if asin in itemmap:
-                itemid = itemmap[asin]
-            else:
-                itemnum += 1
-                itemid = itemnum
-                itemmap[asin] = itemid
-            User[userid].append([itemid, rating, time])
-
-        logging.info('Sorting reviews for every user on time')
-        # sort reviews in User according to time
-        for userid in User.keys():
-            User[userid].sort(key=lambda x: x[2])
-
-        f = open(self.dataset_fp, 'w')
-        for user in tqdm(User.keys()):
-            for i in User[user]:
-                f.write('{} {} {} {}\n'.format(user, i[0], i[1], i[2]))
-
-        f.close()
-
-        # product map
+        asin_codes, rating_codes = {}, {}
+        item_order = self.write_k_core(self.amazon_interactions(asin_codes, rating_codes), rating_codes)
+        self.write_product_map(asin_codes, item_order, os.path.basename(self.dataset_fp))
+
+    def write_k_core(self, chunks, rating_codes=None):
+        '''
+        Writes the :min_count:-core of the interaction :chunks: to :dataset_fp:,
+        sorted on (user, time). Ratings are indices into :rating_codes: if given.
+        With a :memory_limit: the chunks are spilled to disk (see
+        SpilledInteractions), the output is the same.
+
+        Returns
+        -------
+
+        item_order : np.ndarray
+            Item code of every item id, i.e. item_order[id - 1].
+        '''
+        if self.memory_limit:
+            return self.write_k_core_spilled(chunks, rating_codes)
+
+        chunks = list(chunks)
+        users, items, ratings, times = (np.concatenate(c) for c in zip(*chunks)) if chunks else \
+            (np.zeros(0, dtype=np.int64) for _ in range(4))
+
+        logging.info('Filtering the {}-core'.format(self.min_count))
+        rows, users, items, item_order = k_core_sequences(users, items, times, self.min_count)
+        rating_values = np.array(list(rating_codes), dtype=object) if rating_codes is not None else None
+        write_interactions(self.dataset_fp, users, items, ratings[rows], times[rows], rating_values=rating_values)
+        return item_order
+
+    def write_k_core_spilled(self, chunks, rating_codes=None):
+        chunk_rows = max(1, self.memory_limit * (1 << 20) // SPILL_ROW_BYTES)
+        d = os.path.dirname(os.path.abspath(self.dataset_fp))
+        with tempfile.TemporaryDirectory(prefix=os.path.basename(self.dataset_fp) + '.spill', dir=d) as directory:
+            logging.info('Spilling interactions to {} in chunks of {} rows'.format(directory, chunk_rows))
+            spilled = SpilledInteractions(chunks, directory, chunk_rows)
+
+            logging.info('Filtering the {}-core'.format(self.min_count))
+            spilled.k_core(self.min_count)
+            logging.info('Sorting {} chunks'.format(spilled.num_chunks))
+            item_order = spilled.sort()
+
+            logging.info('Merging {} chunks'.format(spilled.num_chunks))
+            rating_values = list(rating_codes) if rating_codes is not None else None
+            rows = spilled.merge()
+            with open(self.dataset_fp, 'w') as f:
+                while True:
+                    block = list(itertools.islice(rows, 1 << 16))
+                    if not block:
+                        break
+                    users, items, ratings, times = zip(*block)
+                    if rating_values is not None:
+                        ratings = [rating_values[r] for r in ratings]
+                    f.write(format_interactions(users, items, ratings, times))
+        return item_order
+
+    def write_product_map(self, item_codes, item_order, name):
+        '''
+        Writes "<name>_product_map.txt" next to :dataset_fp:, mapping the
+        original item keys to the item ids.
+        '''
         logging.info('Writing product item map')
-        d = os.path.dirname(self.dataset_fp)
-        bn = os.path.basename(self.dataset_fp)
-        metadata_fp = os.path.join(d, bn + '_product_map.txt')
+        metadata_fp = os.path.join(os.path.dirname(self.dataset_fp), name + '_product_map.txt')
+        keys = list(item_codes)
         with open(metadata_fp, 'w') as f:
-            for k, v in tqdm(itemmap.items()):
-                f.write('{} {}\n'.format(k, v))
\ No newline at end of file
+            for itemid, code in enumerate(tqdm(item_order.tolist()), 1):
+                f.write('{} {}\n'.format(keys[code], itemid))
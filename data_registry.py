@@ -0,0 +1,207 @@
+'''
+Registry of the datasets used in the experiments: where the raw source of each
+dataset is, how it is pre-processed and which files that produces.
+
+preprocess_datasets() pre-processes several datasets at once in a process pool.
+After a successful run a "<output>.stamp.json" file records the content hashes
+of the sources, the pre-processing code and parameters and the outputs; a
+dataset whose stamp still matches is skipped. Source hashes are reused while
+the size and modification time of a source are unchanged, so checking an up to
+date dataset does not re-read it.
+'''
+
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+from data_reader import DataReader
+
+TIME_LSTM_DIR = os.path.join('baselines', 'time_lstm')
+LASTFM_DIR = os.path.join(TIME_LSTM_DIR, 'data', 'music')
+LASTFM_LISTS = ['user-item.lst', 'user-item-delta-time.lst', 'user-item-accumulate-time.lst']
+
+# pre-processing parameters that change the outputs (memory_limit and the
+# number of workers only change how they are computed)
+OUTPUT_PARAMS = ['limit', 'min_count']
+
+
+class DatasetSource():
+    '''
+    A raw dataset and its pre-processing.
+
+    Arguments
+    ---------
+
+    name : str
+        Registry name, e.g. 'ml-1m'.
+    type : str
+        'amazon', 'amazon_ratings' and 'movielens' are pre-processed by
+        DataReader, 'lastfm' by the scripts of the time-LSTM baseline.
+    raw_dataset : str
+        The raw source file.
+    output : str
+        The pre-processed dataset (for DataReader types, the --output).
+    '''
+
+    def __init__(self, name, type, raw_dataset, output):
+        self.name = name
+        self.type = type
+        self.raw_dataset = raw_dataset
+        self.output = output
+
+    def sources(self):
+        if self.type == 'movielens':
+            # the metadata files are built from the movie titles next to the ratings
+            return [self.raw_dataset, os.path.join(os.path.dirname(self.raw_dataset), 'movies.csv')]
+        return [self.raw_dataset]
+
+    def outputs(self):
+        d, bn = os.path.dirname(self.output), os.path.basename(self.output)
+        if self.type == 'amazon':
+            return [self.output, self.output + '_product_map.txt']
+        if self.type == 'amazon_ratings':
+            return [self.output, os.path.join(d, bn[:-4] + '_product_map.txt')]
+        if self.type == 'movielens':
+            return [self.output, self.output + '_metadata.tsv', self.output + '_metadata_genres.tsv']
+        return ([os.path.join(LASTFM_DIR, f) for f in LASTFM_LISTS] +
+                [os.path.join(LASTFM_DIR, prefix + f) for prefix in ('tr_', 'te_') for f in LASTFM_LISTS])
+
+    def code(self):
+        if self.type == 'lastfm':
+            return [os.path.join(TIME_LSTM_DIR, 'preprocess', 'lastfm.py'),
+                    os.path.join(TIME_LSTM_DIR, 'preprocess', 'split_lastfm.py')]
+        return [os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data_reader.py')]
+
+    def stamp_path(self):
+        return self.outputs()[0] + '.stamp.json'
+
+    def run(self, limit=None, min_count=5, memory_limit=None, workers=None):
+        if self.type == 'lastfm':
+            # the scripts use paths relative to the baseline directory
+            for script in self.code():
+                subprocess.check_call([sys.executable, os.path.relpath(script, TIME_LSTM_DIR)], cwd=TIME_LSTM_DIR)
+            return
+        DataReader(self.raw_dataset, self.output, self.type, limit=limit, workers=workers,
+                   min_count=min_count, memory_limit=memory_limit).preprocess()
+
+
+REGISTRY = {}
+
+
+def register(source):
+    REGISTRY[source.name] = source
+    return source
+
+
+register(DatasetSource('Beauty', 'amazon', 'data/reviews_Beauty.json.gz', 'data/Beauty.txt'))
+register(DatasetSource('Books', 'amazon', 'data/reviews_Books_5.json.gz', 'data/Books.txt'))
+register(DatasetSource('Books-ratings', 'amazon_ratings', 'data/ratings_Books.csv', 'data/ratings_Books.txt'))
+register(DatasetSource('ml-1m', 'movielens', 'data/ml-1m/ratings.dat', 'data/ml-1m.txt'))
+register(DatasetSource('ml-20m', 'movielens', 'data/ml-20m/ratings.csv', 'data/ml-20m.txt'))
+register(DatasetSource('lastfm', 'lastfm', os.path.join(LASTFM_DIR, 'userid-timestamp-artid-artname-traid-traname.tsv'),
+                       os.path.join(LASTFM_DIR, 'user-item.lst')))
+
+
+def file_digest(fpath, known=None, chunk_bytes=1 << 24):
+    '''
+    Returns {'size', 'mtime_ns', 'sha1'} of the file at :fpath:. The hash of
+    :known: (an earlier result for the same file) is reused if the size and
+    modification time did not change.
+    '''
+    st = os.stat(fpath)
+    digest = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    if known and all(known.get(k) == v for k, v in digest.items()):
+        digest['sha1'] = known['sha1']
+        return digest
+    h = hashlib.sha1()
+    with open(fpath, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_bytes), b''):
+            h.update(block)
+    digest['sha1'] = h.hexdigest()
+    return digest
+
+
+def read_stamp(source):
+    if not os.path.exists(source.stamp_path()):
+        return None
+    with open(source.stamp_path(), 'r') as f:
+        return json.load(f)
+
+
+def build_key(source, params, stamp=None):
+    '''
+    Hash of everything the outputs of :source: depend on: the contents of its
+    sources and pre-processing code, its type and the :params:.
+    '''
+    known = stamp['files'] if stamp else {}
+    files = {fpath: file_digest(fpath, known.get(fpath)) for fpath in source.sources() + source.code()}
+    params = {k: params[k] for k in OUTPUT_PARAMS}
+    h = hashlib.sha1(json.dumps({'type': source.type, 'params': params,
+                                 'files': [files[f]['sha1'] for f in sorted(files)]}, sort_keys=True).encode())
+    return h.hexdigest(), files
+
+
+def is_up_to_date(source, params):
+    stamp = read_stamp(source)
+    if stamp is None or not all(os.path.exists(f) for f in source.outputs()):
+        return False
+    key, _ = build_key(source, params, stamp)
+    if key != stamp['key']:
+        return False
+    outputs = stamp['outputs']
+    return all(file_digest(f, outputs.get(f))['sha1'] == outputs.get(f, {}).get('sha1') for f in source.outputs())
+
+
+def write_stamp(source, params):
+    key, files = build_key(source, params, read_stamp(source))
+    stamp = {'key': key, 'params': params, 'files': files,
+             'outputs': {f: file_digest(f) for f in source.outputs()}}
+    tmp_path = source.stamp_path() + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(stamp, f, indent=2)
+    os.replace(tmp_path, source.stamp_path())
+
+
+def preprocess_dataset(name, params, workers=None, force=False):
+    '''
+    Pre-processes the registered dataset :name: unless it is up to date.
+
+    Returns
+    -------
+
+    name, status, seconds : str, str, float
+        status is 'done', 'up to date', 'missing source' or 'failed: <error>'.
+    '''
+    source = REGISTRY[name]
+    start = time.time()
+    if not all(os.path.exists(f) for f in source.sources()):
+        return name, 'missing source', 0.0
+    if not force and is_up_to_date(source, params):
+        return name, 'up to date', time.time() - start
+    try:
+        source.run(workers=workers, **params)
+        write_stamp(source, params)
+    except Exception as e:
+        logging.exception('Pre-processing {} failed'.format(name))
+        return name, 'failed: {}'.format(e), time.time() - start
+    return name, 'done', time.time() - start
+
+
+def preprocess_datasets(names, jobs=None, force=False, limit=None, min_count=5, memory_limit=None):
+    '''
+    Pre-processes the registered datasets :names: with :jobs: datasets at a
+    time (all at once by default), splitting the cores between them.
+    '''
+    params = {'limit': limit, 'min_count': min_count, 'memory_limit': memory_limit}
+    jobs = max(1, min(jobs or len(names), len(names)))
+    workers = max(1, (os.cpu_count() or 1) // jobs)
+    if jobs == 1:
+        return [preprocess_dataset(name, params, workers, force) for name in names]
+    with ProcessPoolExecutor(jobs) as pool:
+        futures = [pool.submit(preprocess_dataset, name, params, workers, force) for name in names]
+        return [future.result() for future in futures]
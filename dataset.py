@@ -0,0 +1,352 @@
+'''
+Compiled on-disk format for pre-processed datasets.
+
+The text files written by preprocess.py ("user item rating timestamp" per line)
+are parsed once into flat NumPy columns and stored next to the source file in
+a "<dataset>.cache" directory. Subsequent runs memory-map the columns instead
+of re-parsing the text file. The cache is rebuilt automatically whenever the
+size or modification time of the source file changes.
+
+The meta data of the cache also holds the percentiles of the time deltas
+(see get_delta_range in util.py) of the full histories and of the train
+partition, so they are computed once per dataset instead of once per run.
+'''
+
+import os
+import json
+import shutil
+
+import numpy as np
+
+from quantiles import QuantileSketch
+
+CACHE_VERSION = 2
+
+COLUMNS = {
+    'offsets': np.int64,    # user u owns rows offsets[u]:offsets[u + 1]
+    'item': np.int32,
+    'rating': np.float32,
+    'timestamp': np.int64,  # unix seconds
+    'hour': np.int8,        # 1..24 (UTC), as in the old TimeStamp.hour
+    'day': np.int8,         # 1..7, Monday = 1
+}
+
+HISTORY_COLUMNS = ['item', 'rating', 'timestamp', 'hour', 'day']
+
+
+def cache_path(fpath):
+    return fpath + '.cache'
+
+
+def source_signature(fpath):
+    st = os.stat(fpath)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def read_meta(fpath):
+    meta_fp = os.path.join(cache_path(fpath), 'meta.json')
+    if not os.path.exists(meta_fp):
+        return None
+    with open(meta_fp, 'r') as f:
+        return json.load(f)
+
+
+def is_stale(fpath):
+    meta = read_meta(fpath)
+    if meta is None:
+        return True
+    return meta.get('version') != CACHE_VERSION or meta.get('source') != source_signature(fpath)
+
+
+def read_interactions(fpath, chunk_bytes=1 << 26):
+    '''
+    Parses a pre-processed dataset into flat arrays, reading at most
+    :chunk_bytes: of text at a time.
+
+    Returns
+    -------
+
+    users, items, ratings, timestamps : np.ndarray
+        One entry per line of the file, in file order.
+    '''
+    chunks = []
+    with open(fpath, 'r') as f:
+        while True:
+            lines = f.readlines(chunk_bytes)
+            if not lines:
+                break
+            values = np.array(''.join(lines).split(), dtype=np.float64)
+            if values.size % 4 != 0:
+                raise ValueError('{} is not in "user item rating timestamp" format'.format(fpath))
+            chunks.append(values.reshape(-1, 4))
+
+    if chunks:
+        data = np.concatenate(chunks)
+    else:
+        data = np.zeros((0, 4), dtype=np.float64)
+    users = data[:, 0].astype(np.int64)
+    items = data[:, 1].astype(np.int32)
+    ratings = data[:, 2].astype(np.float32)
+    timestamps = data[:, 3].astype(np.int64)
+    return users, items, ratings, timestamps
+
+
+def hour_of_day(timestamps):
+    # UTC hour, shifted by one so that 0 stays free for zero padding
+    return ((timestamps // 3600) % 24 + 1).astype(np.int8)
+
+
+def day_of_week(timestamps):
+    # 1970-01-01 was a Thursday (4)
+    return ((timestamps // 86400 + 3) % 7 + 1).astype(np.int8)
+
+
+def partition_bounds(starts, ends):
+    '''
+    Returns the ends of the train and valid rows of every user, see :partition:.
+    '''
+    split = (ends - starts) >= 3
+    train_end = np.where(split, ends - 2, ends)
+    valid_end = np.where(split, ends - 1, ends)
+    return train_end, valid_end
+
+
+def timedelta_percentiles(timestamps, starts, ends, q=range(101), chunk_rows=1 << 22):
+    '''
+    Percentiles :q: of the time deltas between every interaction in the rows
+    [starts, ends) of a user and the last of them, streamed through a
+    :QuantileSketch: in blocks of users of about :chunk_rows: rows.
+    '''
+    lengths = ends - starts
+    cumulative = np.cumsum(lengths)
+    if not cumulative.size or cumulative[-1] == 0:
+        return [0.0 for _ in q]
+    cuts = np.searchsorted(cumulative, np.arange(chunk_rows, cumulative[-1], chunk_rows))
+    bounds = np.unique(np.concatenate([[0], cuts, [len(lengths)]]))
+
+    sketch = QuantileSketch()
+    for a, b in zip(bounds[:-1], bounds[1:]):
+        rows, users = UserHistory({}, starts[a:b], ends[a:b]).rows()
+        sketch.update(timestamps[ends[a:b][users] - 1] - timestamps[rows])
+    return [float(x) for x in sketch.percentiles(list(q))]
+
+
+def compile_dataset(fpath):
+    '''
+    Compiles the text dataset at :fpath: into its column cache.
+    Interactions keep their file order within each user.
+    '''
+    users, items, ratings, timestamps = read_interactions(fpath)
+
+    order = np.argsort(users, kind='stable')
+    users = users[order]
+    usernum = int(users.max()) if users.size else 0
+
+    counts = np.bincount(users, minlength=usernum + 1)
+    offsets = np.zeros(usernum + 2, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    columns = {
+        'offsets': offsets,
+        'item': items[order],
+        'rating': ratings[order],
+        'timestamp': timestamps[order],
+    }
+    columns['hour'] = hour_of_day(columns['timestamp'])
+    columns['day'] = day_of_week(columns['timestamp'])
+
+    meta = {
+        'version': CACHE_VERSION,
+        'source': source_signature(fpath),
+        'usernum': usernum,
+        'itemnum': int(items.max()) if items.size else 0,
+        'ratingnum': float(ratings.max()) if ratings.size else 0.0,
+        'num_interactions': int(items.size),
+    }
+
+    starts, ends = offsets[:-1], offsets[1:]
+    train_end, _ = partition_bounds(starts, ends)
+    meta['timedelta_percentiles'] = {
+        'history': timedelta_percentiles(columns['timestamp'], starts, ends),
+        'train': timedelta_percentiles(columns['timestamp'], starts, train_end),
+    }
+
+    # write into a scratch directory first, so that an interrupted compile never
+    # leaves a half-written cache behind
+    out_dir = cache_path(fpath)
+    tmp_dir = out_dir + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    for name, dtype in COLUMNS.items():
+        np.save(os.path.join(tmp_dir, name + '.npy'), columns[name].astype(dtype, copy=False))
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.rename(tmp_dir, out_dir)
+    return meta
+
+
+class Interactions():
+    '''
+    Memory-mapped columns of a compiled dataset.
+    '''
+
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self.path = cache_path(fpath)
+        self.meta = read_meta(fpath)
+        self.usernum = self.meta['usernum']
+        self.itemnum = self.meta['itemnum']
+        self.ratingnum = self.meta['ratingnum']
+        self.columns = {}
+        for name in COLUMNS:
+            self.columns[name] = np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+        self.offsets = self.columns['offsets']
+
+    def __len__(self):
+        return self.meta['num_interactions']
+
+    def history(self):
+        '''
+        Returns the full (unpartitioned) :UserHistory: of every user.
+        '''
+        columns = {name: self.columns[name] for name in HISTORY_COLUMNS}
+        return UserHistory(columns, np.asarray(self.offsets[:-1]), np.asarray(self.offsets[1:]),
+                           self.meta['timedelta_percentiles']['history'])
+
+
+def load_dataset(fpath):
+    '''
+    Returns the memory-mapped :Interactions: of the dataset at :fpath:,
+    compiling (or re-compiling) its cache first if needed.
+    '''
+    if is_stale(fpath):
+        compile_dataset(fpath)
+    return Interactions(fpath)
+
+
+class UserSequence():
+    '''
+    Read-only view on the interactions of a single user. Every column is
+    exposed as a NumPy slice, e.g. seq.item[-1] is the most recent item.
+    '''
+
+    def __init__(self, history, start, end):
+        self.history = history
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getattr__(self, name):
+        columns = self.__dict__['history'].columns
+        if name not in columns:
+            raise AttributeError(name)
+        return columns[name][self.start:self.end]
+
+
+class UserHistory():
+    '''
+    Interaction histories of all users in CSR form: flat column arrays (item,
+    rating, timestamp, hour, day) plus per-user [start, end) row ranges, so
+    the history of a user is a O(1) slice of every column. Train/valid/test
+    partitions are different row ranges over the same columns, so no data is
+    copied.
+
+    history[u] returns a :UserSequence: view, and len(history) is the number
+    of users, mirroring the dict of lists this replaces. Hot loops should use
+    :starts:, :ends: and :columns: directly.
+
+    Memory-mapped columns are pickled by file name, so sending a history to a
+    sampler process costs a few kilobytes and every process shares the same
+    page cache instead of holding its own copy of the data.
+
+    :timedelta_percentiles: are the precomputed percentiles 0..100 used by
+    get_delta_range, if known for these row ranges.
+    '''
+
+    def __init__(self, columns, starts, ends, timedelta_percentiles=None):
+        self.columns = columns
+        self.starts = starts
+        self.ends = ends
+        self.timedelta_percentiles = timedelta_percentiles
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+    def __getitem__(self, u):
+        return UserSequence(self, int(self.starts[u]), int(self.ends[u]))
+
+    def __getstate__(self):
+        columns = {}
+        for name, column in self.columns.items():
+            if isinstance(column, np.memmap) and column.filename is not None:
+                columns[name] = ('mmap', column.filename)
+            else:
+                columns[name] = ('array', column)
+        return {'columns': columns, 'starts': self.starts, 'ends': self.ends,
+                'timedelta_percentiles': self.timedelta_percentiles}
+
+    def __setstate__(self, state):
+        self.columns = {}
+        for name, (kind, value) in state['columns'].items():
+            if kind == 'mmap':
+                value = np.load(value, mmap_mode='r')
+            self.columns[name] = value
+        self.starts = state['starts']
+        self.ends = state['ends']
+        self.timedelta_percentiles = state.get('timedelta_percentiles')
+
+    def keys(self):
+        return range(1, len(self.starts))
+
+    def values(self):
+        for u in self.keys():
+            yield self[u]
+
+    def items(self):
+        for u in self.keys():
+            yield u, self[u]
+
+    def lengths(self):
+        return self.ends - self.starts
+
+    def rows(self):
+        '''
+        Returns the column rows of all interactions in this history together
+        with the user owning each row, without a Python loop over users.
+        '''
+        lengths = self.lengths()
+        users = np.repeat(np.arange(len(lengths)), lengths)
+        first_row = np.cumsum(lengths) - lengths
+        rows = np.arange(lengths.sum()) - first_row[users] + self.starts[users]
+        return rows, users
+
+    def nbytes(self):
+        return sum(c.nbytes for c in self.columns.values()) + self.starts.nbytes + self.ends.nbytes
+
+    def with_column(self, name, values):
+        columns = dict(self.columns)
+        columns[name] = values
+        return UserHistory(columns, self.starts, self.ends, self.timedelta_percentiles)
+
+
+def partition(data):
+    '''
+    Splits the :Interactions: into train/valid/test histories. The last
+    interaction of a user is the test item and the one before it the
+    validation item; users with fewer than 3 interactions are kept for
+    training only.
+    '''
+    history = data.history()
+    columns, starts, ends = history.columns, history.starts, history.ends
+    train_end, valid_end = partition_bounds(starts, ends)
+
+    user_train = UserHistory(columns, starts, train_end, data.meta['timedelta_percentiles']['train'])
+    user_valid = UserHistory(columns, train_end, valid_end)
+    user_test = UserHistory(columns, valid_end, ends)
+    return user_train, user_valid, user_test
@@ -5,7 +5,7 @@ import time
 import json
 
 from util import *
-from sampler import WarpSampler, sample_function
+from sampler import WarpSampler, batch_sampler, sample_function
 
 from models.cast_1 import CAST1
 from models.cast_2 import CAST2
@@ -26,19 +26,169 @@ import tensorflow as tf
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '0'
 
 MODELS = ["cast_1","cast_2", "cast_3", "cast_4", "cast_5", "cast_6", "cast_7", "cast_8", "cast_9", "sasrec", "sasrec_static"]
-
-if __name__ == '__main__':
-
-    MODEL_PATH = os.path.abspath('saved_models')
-    logger = logging.getLogger('ir2')
-    logging.basicConfig(
-        level=logging.DEBUG,
-        format="%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s",
-        handlers=[
-            logging.FileHandler("{0}/{1}.log".format('.', 'output')),
-            logging.StreamHandler()
-        ])
-
+MODEL_PATH = os.path.abspath('saved_models')
+logger = logging.getLogger('ir2')
+
+
+def build_model(args, usernum, itemnum, ratingnum, inputs=None):
+    '''
+    Builds the graph of the model :args.model: in the default graph. The model inputs
+    default to the tensors in :inputs: if given (see train_inputs).
+    '''
+    model = args.model.lower()
+    if model == "cast_1":
+        return CAST1(usernum, itemnum, ratingnum, args, inputs=inputs)
+    elif model == "cast_2":
+        return CAST2(usernum, itemnum, ratingnum, args, inputs=inputs)
+    elif model == "cast_3":
+        return CAST3(usernum, itemnum, ratingnum, args, inputs=inputs)
+    elif model == "cast_4":
+        return CAST4(usernum, itemnum, ratingnum, args, inputs=inputs)
+    elif model == "cast_5":
+        return CAST5(usernum, itemnum, ratingnum, args, inputs=inputs)
+    elif model == "cast_6":
+        return CAST6(usernum, itemnum, ratingnum, args, inputs=inputs)
+    elif model == "cast_7":
+        return CAST7(usernum, itemnum, ratingnum, args, inputs=inputs)
+    elif model == "cast_8":
+        return CAST8(usernum, itemnum, ratingnum, args, inputs=inputs)
+    elif model == "cast_9":
+        return CAST9(usernum, itemnum, ratingnum, args, inputs=inputs)
+    elif model == "sasrec":
+        return SASRec(usernum, itemnum, args, inputs=inputs)
+    elif model == "sasrec_static":
+        return SASRec(usernum, itemnum, args, static=True, inputs=inputs)
+    raise ValueError('Unknown model {}, provide model from {}'.format(args.model, MODELS))
+
+
+TRAIN_INPUTS = ['u', 'input_seq', 'pos', 'neg', 'time_seq', 'ratings', 'hours', 'days']
+
+
+def train_inputs(sampler, batch_size, seed=None, prefetch=2):
+    '''
+    tf.data pipeline over the training batches of :sampler: (a BatchSampler). The
+    batches are sampled by a parallel map on the tf.data threads, :prefetch: batches
+    ahead of the training step, instead of being fed through a feed_dict by every step.
+    Batch i is drawn with a RandomState seeded by (:seed:, i), so the batches do not
+    depend on the order in which the threads finish.
+
+    Returns
+    -------
+
+    inputs : dict
+        The next batch, one tensor per name in :TRAIN_INPUTS:, for build_model.
+    '''
+    if not seed:
+        seed = np.random.randint(2 ** 31 - 1)
+
+    def sample(i):
+        return sampler.sample(batch_size, np.random.RandomState([seed, i]))
+
+    def sample_batch(i):
+        batch = tf.numpy_function(sample, [i], (tf.int32,) * len(TRAIN_INPUTS))
+        batch[0].set_shape([batch_size])
+        for x in batch[1:]:
+            x.set_shape([batch_size, sampler.maxlen])
+        return batch
+
+    dataset = tf.data.Dataset.range(np.iinfo(np.int64).max)
+    dataset = dataset.map(sample_batch, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.prefetch(prefetch)
+    batch = tf.data.make_one_shot_iterator(dataset).get_next()
+    return dict(zip(TRAIN_INPUTS, batch))
+
+
+def train_feed_dict(model, sampler, inputs=None):
+    '''
+    Returns the feed_dict of a training step: the next batch of :sampler:, unless
+    the model reads its batches from the tf.data pipeline :inputs:.
+    '''
+    if inputs is not None:
+        return {model.is_training: True}
+    u, seq, pos, neg, timeseq, ratings_seq, hours_seq, days_seq = sampler.next_batch()
+    return {model.u: u, model.input_seq: seq, model.pos: pos,
+            model.neg: neg, model.time_seq: timeseq,
+            model.hours: hours_seq,
+            model.days: days_seq,
+            model.is_training: True}
+
+
+class TrainStepScheduler():
+    '''
+    Runs the training steps and decides what each of them fetches. Every step runs
+    train_op, loss and auc; the merged summaries are fetched every :summary_every:
+    steps (if 0, on the last step of every epoch only) and the attention weights,
+    [batch, maxlen, maxlen] tensors that training does not need, every
+    :attention_every: steps (if 0, never).
+
+    The time spent waiting for the input batch and in the session run of every step is
+    logged every :log_every: steps (if 0, by log() at the end of every epoch).
+    '''
+
+    def __init__(self, model, summary_every=0, attention_every=0, log_every=0):
+        self.model = model
+        self.summary_every = summary_every
+        self.attention_every = attention_every
+        self.log_every = log_every
+        self.step = 0
+        self.input_times = []
+        self.run_times = []
+        self.losses = []
+
+    def fetches(self, last_in_epoch=False):
+        fetches = {'auc': self.model.auc, 'loss': self.model.loss, 'train_op': self.model.train_op}
+        step = self.step + 1
+        if self.model.merged is not None:
+            if (step % self.summary_every == 0) if self.summary_every else last_in_epoch:
+                fetches['summary'] = self.model.merged
+        if self.attention_every and step % self.attention_every == 0:
+            fetches['attention_weights'] = self.model.attention_weights
+        return fetches
+
+    def run(self, sess, sampler, inputs=None, last_in_epoch=False):
+        '''
+        Runs one training step and returns the dict of fetched results.
+        '''
+        t0 = time.time()
+        feed_dict = train_feed_dict(self.model, sampler, inputs)
+        t1 = time.time()
+        results = sess.run(self.fetches(last_in_epoch), feed_dict)
+        t2 = time.time()
+
+        self.step += 1
+        self.input_times.append(t1 - t0)
+        self.run_times.append(t2 - t1)
+        self.losses.append(results['loss'])
+        if self.log_every and self.step % self.log_every == 0:
+            self.log()
+        return results
+
+    def log(self):
+        if not self.run_times:
+            return
+        run_times = np.array(self.run_times) * 1e3
+        logging.getLogger('ir2').info(
+            'step %d: loss %.4f, input %.2f ms/step, run %.2f ms/step (p50 %.2f, max %.2f) over %d steps' % (
+                self.step, np.mean(self.losses), np.mean(self.input_times) * 1e3, run_times.mean(),
+                np.percentile(run_times, 50), run_times.max(), len(run_times)))
+        self.input_times, self.run_times, self.losses = [], [], []
+
+
+def str2bool(value):
+    '''
+    Parses the value of a boolean flag, so the params.txt of a run can be replayed as --flag=False.
+    '''
+    if value.lower() in ('true', '1', 'yes'):
+        return True
+    if value.lower() in ('false', '0', 'no'):
+        return False
+    raise argparse.ArgumentTypeError('Expected a boolean, got {}'.format(value))
+
+
+def build_parser():
+    '''
+    Returns the argument parser of the training script.
+    '''
     parser = argparse.ArgumentParser()
 
     # DATASET PARAMETERS
@@ -57,7 +207,17 @@ if __name__ == '__main__':
     parser.add_argument('--lr', type=float, default=1e-3, help='Learning rate')
     parser.add_argument('--num_epochs', type=int,
                         default=201, help='Number of epochs')
+    parser.add_argument('--eval_every', type=int, default=20,
+                        help='Evaluate and save the model every N epochs (and after the last one)')
     parser.add_argument('--max_norm', type=float, default=5.0, help='--')
+    parser.add_argument('--eval_batch_size', default=256, type=int,
+                        help='Number of users scored per session run during evaluation')
+    parser.add_argument('--full_rank_k', default=10, type=int,
+                        help='Also report full-catalogue NDCG@K/HR@K for this K (0 to disable)')
+    parser.add_argument('--eval_cache', type=str2bool, nargs='?', const=True, default=False,
+                        help='Store the evaluation inputs in the dataset cache and reuse them in later runs')
+    parser.add_argument('--time_bin_cache', type=str2bool, nargs='?', const=True, default=False,
+                        help='Store the time bins of every interaction in the dataset cache and gather them while sampling')
 
     # MODEL PARAMETERS
     parser.add_argument('--hidden_units', default=50, type=int)
@@ -67,7 +227,18 @@ if __name__ == '__main__':
     parser.add_argument('--l2_emb', default=0.0, type=float)
     parser.add_argument('--bin_in_hours', default=24, type=int)
     parser.add_argument('--max_bins', default=200, type=int)
+    parser.add_argument('--neg_distribution', default='uniform', choices=['uniform', 'popularity'],
+                        help='Distribution of the training negatives (evaluation always uses uniform)')
+    parser.add_argument('--neg_alpha', default=1.0, type=float,
+                        help='Exponent of the item counts for popularity negative sampling')
     parser.add_argument('--num_context_blocks', default=2, type=int)
+    parser.add_argument('--attention_mode', default='full', choices=['full', 'local'],
+                        help='Causal self-attention over all previous positions, or over a local window only')
+    parser.add_argument('--attention_window', default=50, type=int,
+                        help='Block size of the local attention; a position sees the previous '
+                             'attention_window to 2 * attention_window - 1 positions')
+    parser.add_argument('--batched_context_towers', type=str2bool, nargs='?', const=True, default=False,
+                        help='Run the context towers of cast_8 and cast_9 as one batched tower')
 
     # MISC.
     parser.add_argument('--test_model', type=str, default=None,
@@ -77,78 +248,142 @@ if __name__ == '__main__':
     parser.add_argument('--saved_model', default='model.pt',
                         type=str, help='File to save model checkpoints')
     parser.add_argument('--seed', default=42, type=int)
-    parser.add_argument('--log_scale', type=bool, default=False)
-    parser.add_argument('--input_context', type=bool, default=False)
+    parser.add_argument('--sampler_workers', default=1, type=int,
+                        help='Number of processes sampling training batches (feed_dict input pipeline)')
+    parser.add_argument('--input_pipeline', default='feed_dict', choices=['feed_dict', 'tf_data'],
+                        help='Feed the training batches by feed_dict, or sample them in a parallel, '
+                             'prefetching tf.data pipeline')
+    parser.add_argument('--summary_every', default=0, type=int,
+                        help='Write the training summaries every N steps (0: once per epoch)')
+    parser.add_argument('--attention_every', default=0, type=int,
+                        help='Plot the mean attention weights of a training batch every N steps (0: never)')
+    parser.add_argument('--log_every', default=0, type=int,
+                        help='Log the loss and step timing every N steps (0: once per epoch)')
+    parser.add_argument('--log_scale', type=str2bool, nargs='?', const=True, default=False)
+    parser.add_argument('--input_context', type=str2bool, nargs='?', const=True, default=False)
     parser.add_argument('--model', default="cast_1", required=True,
                         help="model to use from"+str(MODELS))
     # parser.add_argument('--device', default='cuda', type=str, help='Device to run model on') #TODO: GPU
+    return parser
 
-    args = parser.parse_args()
 
-    # Check if dataset exists
-    if not os.path.exists(args.dataset):
-        logger.info('Pre-process the data first using the --preprocess flag')
-        sys.exit()
+def setup_logging():
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format="%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s",
+        handlers=[
+            logging.FileHandler("{0}/{1}.log".format('.', 'output')),
+            logging.StreamHandler()
+        ])
 
-    # Partition data
-    dataset = data_partition(args.dataset, args.log_scale)
+
+def train_and_evaluate(args, dataset):
+    '''
+    Trains the model :args.model: on :dataset: (as returned by data_partition) in a new graph
+    and session, evaluating and saving it every :args.eval_every: epochs and after the last
+    one. With :args.test_model: the saved model is only tested.
+
+    Returns
+    -------
+
+    report : dict
+        'train_dir' (None when testing), 'epochs', 'train_time' (seconds spent training,
+        without the evaluations) and the last 'valid' and 'test' results, each
+        (NDCG@10, HR@10) followed by the full-ranking (NDCG@K, HR@K) with --full_rank_k.
+    '''
     [train, valid, test, usernum, itemnum, ratingnum] = dataset
     num_batch = round(len(train) / args.batch_size)
     print('usernum', usernum, 'itemnum', itemnum)
 
-    cc = sum([len(v) for v in train.values()])
+    cc = train.lengths().sum()
     logger.info('Average sequence length: {:.2f}'.format(cc / len(train)))
 
-    # RESET GRAPH
-    if args.seed:
-        random.seed(args.seed)
-        np.random.seed(args.seed)
-        tf.reset_default_graph()
-        tf.set_random_seed(args.seed)
-
-    config = tf.ConfigProto()
-    # config.gpu_options.allow_growth = True
-    # config.allow_soft_placement = True
-
-    # SESSION
-    sess = tf.Session(config=config)
-
-    # MODEL
     if args.model.lower() not in MODELS:
-        print("provide model from", MODELS)
-        sys.exit(0)
-
-    if args.model == "cast_1":
-        model = CAST1(usernum, itemnum, ratingnum, args)
-    elif args.model == "cast_2":
-        model = CAST2(usernum, itemnum, ratingnum, args)
-    elif args.model == "cast_3":
-        model = CAST3(usernum, itemnum, ratingnum, args)
-    elif args.model == "cast_4":
-        model = CAST4(usernum, itemnum, ratingnum, args)
-    elif args.model == "cast_5":
-        model = CAST5(usernum, itemnum, ratingnum, args)
-    elif args.model == "cast_6":
-        model = CAST6(usernum, itemnum, ratingnum, args)
-    elif args.model == "cast_7":
-        model = CAST7(usernum, itemnum, ratingnum, args)
-    elif args.model == "cast_8":
-        model = CAST8(usernum, itemnum, ratingnum, args)
-    elif args.model == "cast_9":
-        model = CAST9(usernum, itemnum, ratingnum, args)
-    elif args.model == "sasrec":
-        model = SASRec(usernum, itemnum, args)
-    elif args.model == "sasrec_static":
-        model = SASRec(usernum, itemnum, args, static=True)
-
-    # SAMPLER
-    print('usernum', usernum, 'itemnum', itemnum)
-    sampler = WarpSampler(args, train, usernum, itemnum,
-                          sample_func=sample_function,
-                          batch_size=args.batch_size, maxlen=args.maxlen, n_workers=1)
-
-    sess.run(tf.global_variables_initializer())
-
+        raise ValueError('provide model from {}'.format(MODELS))
+
+    # a new graph for every run, so one process can train several models
+    with tf.Graph().as_default():
+        if args.seed:
+            random.seed(args.seed)
+            np.random.seed(args.seed)
+            tf.set_random_seed(args.seed)
+
+        config = tf.ConfigProto()
+        # config.gpu_options.allow_growth = True
+        # config.allow_soft_placement = True
+
+        # SAMPLER
+        sampler_train = train
+        if args.time_bin_cache:
+            time_bin_tables = get_time_bin_tables(args.dataset, dataset, args.bin_in_hours, args.max_bins, args.log_scale)
+            sampler_train = train.with_column('input_time_bin', time_bin_tables['train'])
+        if args.input_pipeline == 'tf_data' and not args.test_model:
+            # the batches are sampled by the tf.data pipeline instead of the sampler processes
+            sampler = None
+            inputs = train_inputs(batch_sampler(args, sampler_train, usernum, itemnum), args.batch_size, args.seed)
+        else:
+            sampler = WarpSampler(args, sampler_train, usernum, itemnum,
+                                  sample_func=sample_function,
+                                  batch_size=args.batch_size, maxlen=args.maxlen, n_workers=args.sampler_workers)
+            inputs = None
+        try:
+            # MODEL
+            model = build_model(args, usernum, itemnum, ratingnum, inputs)
+
+            # SESSION
+            with tf.Session(config=config) as sess:
+                sess.run(tf.global_variables_initializer())
+                if args.test_model:
+                    return test_saved_model(args, dataset, sess, model, sampler)
+                return train_model(args, dataset, sess, model, sampler, inputs, num_batch)
+        finally:
+            if sampler is not None:
+                sampler.close()
+
+
+def test_saved_model(args, dataset, sess, model, sampler):
+    '''
+    Restores :args.test_model: into :model: and evaluates it on the test split.
+    '''
+    report = {'train_dir': None, 'epochs': 0, 'train_time': 0.0, 'valid': None, 'test': None}
+    if not os.path.exists(args.test_model):
+        print('{} not found'.format(args.test_model))
+        return report
+
+    print('loaded saved model {}'.format(args.test_model))
+    tf.train.Saver().restore(sess, tf.train.latest_checkpoint(args.test_model))
+
+    # Start testing
+    u, seq, pos, neg, timeseq, ratings_seq, hours_seq, days_seq = sampler.next_batch()
+    auc, loss, _, summary = sess.run([model.auc, model.loss, model.train_op,
+                                                   model.merged],
+
+                                                  {model.u: u, model.input_seq: seq, model.pos: pos,
+                                                   model.neg: neg, model.time_seq: timeseq,
+                                                   model.hours: hours_seq,
+                                                   model.days: days_seq,
+                                                   model.is_training: True})
+
+    print(auc)
+    print(loss)
+
+    t_test = evaluate(model, dataset, args, sess)
+    logger.info('test (NDCG@10: %.4f, HR@10: %.4f)' %
+                (t_test[0], t_test[1]))
+    if args.full_rank_k:
+        logger.info('test full ranking (NDCG@%d: %.4f, HR@%d: %.4f)' %
+                    (args.full_rank_k, t_test[2], args.full_rank_k, t_test[3]))
+
+    with open(os.path.join(args.test_model, 'test_seq_len.txt'), 'a') as f:
+        f.write('{},{},{}\n'.format(args.test_seq_len, t_test[0], t_test[1]))
+    report['test'] = t_test
+    return report
+
+
+def train_model(args, dataset, sess, model, sampler, inputs, num_batch):
+    '''
+    Trains :model: for :args.num_epochs: epochs of :num_batch: steps in a new run directory.
+    '''
     # Set train dir
     now = datetime.now()
     TRAIN_FILES_PATH = os.path.join(
@@ -158,36 +393,6 @@ if __name__ == '__main__':
     MODEL_SAVE_PATH = os.path.join(TRAIN_FILES_PATH, 'model.ckpt')
     saver = tf.train.Saver()
 
-    if args.test_model:
-        if os.path.exists(args.test_model):
-            print('loaded saved model {}'.format(args.test_model))
-            saver.restore(sess, tf.train.latest_checkpoint(args.test_model))
-
-            # Start testing
-            u, seq, pos, neg, timeseq, ratings_seq, hours_seq, days_seq, orig_seq = sampler.next_batch()
-            auc, loss, _, summary = sess.run([model.auc, model.loss, model.train_op,
-                                                           model.merged],
-
-                                                          {model.u: u, model.input_seq: seq, model.pos: pos,
-                                                           model.neg: neg, model.time_seq: timeseq,
-                                                           model.hours: hours_seq,
-                                                           model.days: days_seq,
-                                                           model.is_training: True})
-
-            print(auc)
-            print(loss)
-
-            t_test = evaluate(model, dataset, args, sess)
-            logger.info('test (NDCG@10: %.4f, HR@10: %.4f)' %
-                        (t_test[0], t_test[1]))
-
-            with open(os.path.join(args.test_model, 'test_seq_len.txt'), 'a') as f:
-                f.write('{},{},{}\n'.format(args.test_seq_len, t_test[0], t_test[1]))
-
-        else:
-            print('{} not found'.format(args.test_model))
-        exit(0)
-
     # Check if training directory structure exists
     if not os.path.exists(TRAIN_FILES_PATH):
         os.makedirs(TRAIN_FILES_PATH)
@@ -196,34 +401,31 @@ if __name__ == '__main__':
     with open(os.path.join(TRAIN_FILES_PATH, 'params.txt'), 'w') as f:
         json.dump(args.__dict__, f, indent=2)
 
-    f = open(os.path.join(TRAIN_FILES_PATH, 'log.txt'), 'w')
     args.train_files_path = TRAIN_FILES_PATH
+    report = {'train_dir': TRAIN_FILES_PATH, 'epochs': 0, 'train_time': 0.0, 'valid': None, 'test': None}
 
     # Add TensorBoard
     writer = tf.summary.FileWriter(TRAIN_FILES_PATH, sess.graph)
 
+    scheduler = TrainStepScheduler(model, args.summary_every, args.attention_every, args.log_every)
     T = 0.0
     t0 = time.time()
-    try:
+    with open(os.path.join(TRAIN_FILES_PATH, 'log.txt'), 'w') as f:
         for epoch in range(1, args.num_epochs + 1):
             for step in tqdm(range(num_batch), total=num_batch, ncols=70, leave=False, unit='b'):
-                u, seq, pos, neg, timeseq, ratings_seq, hours_seq, days_seq, orig_seq = sampler.next_batch()
-
-                auc, loss, _, summary, attention_weights = sess.run([model.auc, model.loss, model.train_op,
-                                                               model.merged, model.attention_weights],
+                results = scheduler.run(sess, sampler, inputs, last_in_epoch=step == num_batch - 1)
 
-                                                              {model.u: u, model.input_seq: seq, model.pos: pos,
-                                                               model.neg: neg, model.time_seq: timeseq,
-                                                               model.hours: hours_seq,
-                                                               model.days: days_seq,
-                                                               model.is_training: True})
+                if 'summary' in results:
+                    writer.add_summary(results['summary'], scheduler.step if args.summary_every else epoch)
+                    writer.flush()
+                if 'attention_weights' in results:
+                    plot_attention_weights(np.mean(results['attention_weights'], axis=0), TRAIN_FILES_PATH)
 
+            if not args.log_every:
+                scheduler.log()
+            report['epochs'] = epoch
 
-            if summary is not None:
-                writer.add_summary(summary, epoch)
-                writer.flush()
-
-            if epoch % 20 == 0:
+            if epoch % args.eval_every == 0 or epoch == args.num_epochs:
                 save_path = saver.save(sess, MODEL_SAVE_PATH)
                 logger.info('Model saved in path: %s' % save_path)
                 logger.info('Evaluating')
@@ -234,9 +436,14 @@ if __name__ == '__main__':
                 logger.info('')
                 logger.info('epoch:%d, time: %f(s), valid (NDCG@10: %.4f, HR@10: %.4f), test (NDCG@10: %.4f, HR@10: %.4f)' % (
                     epoch, T, t_valid[0], t_valid[1], t_test[0], t_test[1]))
+                if args.full_rank_k:
+                    logger.info('full ranking: valid (NDCG@%d: %.4f, HR@%d: %.4f), test (NDCG@%d: %.4f, HR@%d: %.4f)' % (
+                        args.full_rank_k, t_valid[2], args.full_rank_k, t_valid[3],
+                        args.full_rank_k, t_test[2], args.full_rank_k, t_test[3]))
 
                 f.write(str(t_valid) + ' ' + str(t_test) + '\n')
                 f.flush()
+                report.update(train_time=T, valid=t_valid, test=t_test)
 
                 summary = tf.Summary()
                 summary.value.add(tag='VALID/NDCG@10',
@@ -247,15 +454,32 @@ if __name__ == '__main__':
                                   simple_value=float(t_test[0]))
                 summary.value.add(tag='TEST/HR@10',
                                   simple_value=float(t_test[1]))
+                if args.full_rank_k:
+                    for split, t in (('VALID', t_valid), ('TEST', t_test)):
+                        summary.value.add(tag='{}/FULL_NDCG@{}'.format(split, args.full_rank_k),
+                                          simple_value=float(t[2]))
+                        summary.value.add(tag='{}/FULL_HR@{}'.format(split, args.full_rank_k),
+                                          simple_value=float(t[3]))
                 writer.add_summary(summary, epoch)
                 t0 = time.time()
+    writer.close()
+    return report
+
+
+if __name__ == '__main__':
+    setup_logging()
+    args = build_parser().parse_args()
+
+    # Check if dataset exists
+    if not os.path.exists(args.dataset):
+        logger.info('Pre-process the data first using the --preprocess flag')
+        sys.exit()
 
+    # Partition data
+    dataset = data_partition(args.dataset, args.log_scale)
+    try:
+        train_and_evaluate(args, dataset)
     except Exception as e:
-        sampler.close()
-        f.close()
         logger.error(e)
         exit(1)
-
-    f.close()
-    sampler.close()
     print("Done")
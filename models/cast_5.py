@@ -5,21 +5,25 @@ from modules import *
 # Concatenation of the input-context
 # The concatenation is done AFTER the user sequence is passed through the transformer
 class CAST5():
-    def __init__(self, usernum, itemnum, ratingnum, args, reuse=None):
+    def __init__(self, usernum, itemnum, ratingnum, args, reuse=None, inputs=None):
 
         if args.seed:
             tf.set_random_seed(args.seed)
 
+        # read by multihead_attention, missing in the params.txt of older runs
+        self.attention_mode = getattr(args, 'attention_mode', 'full')
+        self.attention_window = getattr(args, 'attention_window', 50)
+
         self.is_training = tf.placeholder(tf.bool, shape=())
-        self.u = tf.placeholder(tf.int32, shape=(None))
-        self.input_seq = tf.placeholder(tf.int32, shape=(None, args.maxlen))
-        self.pos = tf.placeholder(tf.int32, shape=(None, args.maxlen))
-        self.neg = tf.placeholder(tf.int32, shape=(None, args.maxlen))
+        self.u = model_input(inputs, 'u', shape=(None))
+        self.input_seq = model_input(inputs, 'input_seq', shape=(None, args.maxlen))
+        self.pos = model_input(inputs, 'pos', shape=(None, args.maxlen))
+        self.neg = model_input(inputs, 'neg', shape=(None, args.maxlen))
 
-        self.time_seq = tf.placeholder(tf.int32, shape=(None, args.maxlen))
+        self.time_seq = model_input(inputs, 'time_seq', shape=(None, args.maxlen))
 
-        self.hours = tf.placeholder(tf.int32, shape=(None, args.maxlen))
-        self.days = tf.placeholder(tf.int32, shape=(None, args.maxlen))
+        self.hours = model_input(inputs, 'hours', shape=(None, args.maxlen))
+        self.days = model_input(inputs, 'days', shape=(None, args.maxlen))
 
         pos = self.pos
         neg = self.neg
@@ -155,11 +159,14 @@ class CAST5():
         neg_emb = tf.nn.embedding_lookup(item_emb_table, neg)
         seq_emb = tf.reshape(self.seq, [tf.shape(self.input_seq)[0] * args.maxlen, args.hidden_units])
 
-        self.test_item = tf.placeholder(tf.int32, shape=(101))
+        # candidate items per user (ground truth + 100 negatives), scored at the last position only
+        self.test_item = tf.placeholder(tf.int32, shape=(None, 101))
         test_item_emb = tf.nn.embedding_lookup(item_emb_table, self.test_item)
-        self.test_logits = tf.matmul(seq_emb, tf.transpose(test_item_emb))
-        self.test_logits = tf.reshape(self.test_logits, [tf.shape(self.input_seq)[0], args.maxlen, 101])
-        self.test_logits = self.test_logits[:, -1, :]
+        self.test_logits = tf.matmul(test_item_emb, tf.expand_dims(self.seq[:, -1, :], -1))
+        self.test_logits = tf.squeeze(self.test_logits, -1)
+
+        # top-K over the whole catalogue
+        retrieval_layer(self, item_emb_table, self.seq)
 
         # prediction layer
         self.pos_logits = tf.reduce_sum(pos_emb * seq_emb, -1)
@@ -189,7 +196,24 @@ class CAST5():
 
         self.merged = tf.summary.merge_all()
 
-    def predict(self, sess, u, seq, item_idx, timeseq=None, hours_seq=None, days_seq=None):
-        return sess.run([self.test_logits, self.attention_weights],
-                        {self.u: u, self.input_seq: seq, self.time_seq: timeseq, self.hours: hours_seq,
-                         self.days: days_seq, self.test_item: item_idx, self.is_training: False})
\ No newline at end of file
+    def feed_dict(self, u, seq, timeseq=None, hours_seq=None, days_seq=None):
+        return {self.u: u, self.input_seq: seq, self.time_seq: timeseq, self.hours: hours_seq,
+                self.days: days_seq, self.is_training: False}
+
+    def predict(self, sess, u, seq, item_idx, timeseq=None, hours_seq=None, days_seq=None, with_attention=False):
+        feed_dict = self.feed_dict(u, seq, timeseq, hours_seq, days_seq)
+        feed_dict[self.test_item] = item_idx
+        if with_attention:
+            return sess.run([self.test_logits, self.attention_weights], feed_dict)
+        return sess.run(self.test_logits, feed_dict), None
+
+    def recommend(self, sess, u, seq, k=10, timeseq=None, hours_seq=None, days_seq=None, exclude=None):
+        '''
+        Returns the ids and scores ([batch, k] each) of the :k: best items of the whole catalogue.
+        :exclude: holds (batch row, item) pairs that are never recommended.
+        '''
+        feed_dict = self.feed_dict(u, seq, timeseq, hours_seq, days_seq)
+        feed_dict[self.top_k] = k
+        if exclude is not None:
+            feed_dict[self.exclude_items] = exclude
+        return sess.run([self.top_k_items, self.top_k_scores], feed_dict)
@@ -10,12 +10,142 @@ from __future__ import print_function
 import tensorflow as tf
 import numpy as np
 import math
+import weakref
+
+# tensors shared by all layers of a graph, see graph_constant
+_graph_constants = weakref.WeakKeyDictionary()
+# numpy tables shared by all graphs of the process, see static_encoding
+_encoding_tables = {}
+
+
+def model_input(inputs, name, shape, dtype=tf.int32):
+    '''
+    Placeholder of the model input :name:. If :inputs: is given (a dict of tensors,
+    e.g. the outputs of a tf.data iterator) the placeholder defaults to inputs[name],
+    so a training step needs no feed_dict while evaluation can still feed it.
+    '''
+    if inputs is None:
+        return tf.placeholder(dtype, shape=shape)
+    return tf.placeholder_with_default(inputs[name], shape=shape)
+
+
+def graph_constant(key, build):
+    '''
+    Returns the tensor :build:() of the default graph, built on the first call for :key:
+    only and reused by later calls, e.g. by every attention block of a model.
+    '''
+    constants = _graph_constants.setdefault(tf.get_default_graph(), {})
+    if key not in constants:
+        # outside of any control flow or name scope of the caller
+        with tf.init_scope(), tf.name_scope(None):
+            constants[key] = build()
+    return constants[key]
+
+
+def causal_bias(T_q, T_k):
+    '''
+    Additive attention bias (1, T_q, T_k) that is 0 where query i may attend to key
+    j <= i and -2**32+1 for the future keys, created once per graph and length.
+    '''
+    def build():
+        tril = tf.linalg.band_part(tf.ones([T_q, T_k]), -1, 0)  # (T_q, T_k)
+        return tf.expand_dims((1.0 - tril) * (-2**32+1), 0)  # (1, T_q, T_k)
+
+    static = [tf.get_static_value(T_q), tf.get_static_value(T_k)]
+    if None in static:
+        return build()
+    T_q, T_k = int(static[0]), int(static[1])
+    return graph_constant(('causal_bias', T_q, T_k), build)
+
+
+def local_causal_bias(block_size):
+    '''
+    Additive attention bias (block_size, 2 * block_size) of blocked_causal_attention:
+    query i of a block may attend to the previous block and to keys j <= i of its own.
+    '''
+    def build():
+        allowed = tf.linalg.band_part(tf.ones([block_size, 2 * block_size]), -1, block_size)
+        return (1.0 - allowed) * (-2**32+1)
+
+    return graph_constant(('local_causal_bias', block_size), build)
+
+
+def blocked_causal_attention(Q_, K_, V_, key_masks, query_masks, num_heads, block_size,
+                             dropout_rate=0, is_training=True):
+    '''
+    Causal self-attention over a local window, in memory linear in the sequence length.
+    The (left zero-padded) sequence is split into blocks of :block_size: positions and the
+    queries of a block attend to the keys of that block (causally) and of the block before
+    it, so every position sees the previous :block_size: to 2 * :block_size: - 1 positions.
+
+    Args:
+      Q_, K_, V_: Split heads, 3d tensors with shape of [h*N, T, C/h].
+      key_masks, query_masks: 2d tensors with shape of [N, T], 0 at padding positions.
+      block_size: An int. Number of positions per block.
+
+    Returns
+      The weighted values [h*N, T, C/h] and the attention weights [h*N, T, 2 * block_size],
+      where column j is position j - block_size relative to the start of the query's block.
+    '''
+    B = block_size
+    T = tf.shape(Q_)[1]
+    num_blocks = (T + B - 1) // B
+    pad = num_blocks * B - T
+
+    def blocks(x):
+        # (h*N or N, T, ...) -> (h*N or N, num_blocks, B, ...), padded at the front
+        x = tf.pad(x, [[0, 0], [pad, 0]] + [[0, 0]] * (len(x.get_shape()) - 2))
+        return tf.reshape(x, tf.concat([[tf.shape(x)[0], num_blocks, B], tf.shape(x)[2:]], 0))
+
+    def with_previous(x):
+        # (., num_blocks, B, ...) -> (., num_blocks, 2B, ...), the previous block first
+        previous = tf.pad(x, [[0, 0], [1, 0]] + [[0, 0]] * (len(x.get_shape()) - 2))[:, :-1]
+        return tf.concat([previous, x], axis=2)
+
+    Q_b = blocks(Q_)  # (h*N, n, B, C/h)
+    K_b = with_previous(blocks(K_))  # (h*N, n, 2B, C/h)
+    V_b = with_previous(blocks(V_))  # (h*N, n, 2B, C/h)
+
+    outputs = tf.matmul(Q_b, K_b, transpose_b=True)  # (h*N, n, B, 2B)
+    outputs = outputs / (Q_.get_shape().as_list()[-1] ** 0.5)
+
+    key_bias = (1.0 - with_previous(blocks(key_masks))) * (-2**32+1)  # (N, n, 2B)
+    bias = tf.minimum(tf.expand_dims(key_bias, 2), local_causal_bias(B))  # (N, n, B, 2B)
+    N = tf.shape(key_masks)[0]
+    outputs = tf.reshape(outputs, [num_heads, N, num_blocks, B, 2 * B]) + bias  # (h, N, n, B, 2B)
+    outputs = tf.nn.softmax(outputs)
+    outputs *= tf.expand_dims(blocks(query_masks), -1)  # (h, N, n, B, 2B)
+    outputs = tf.reshape(outputs, [num_heads * N, num_blocks, B, 2 * B])  # (h*N, n, B, 2B)
+
+    outputs = tf.layers.dropout(
+        outputs, rate=dropout_rate, training=tf.convert_to_tensor(is_training))
+    attention_weights = tf.reshape(outputs, [num_heads * N, num_blocks * B, 2 * B])[:, pad:]
+
+    outputs = tf.matmul(outputs, V_b)  # (h*N, n, B, C/h)
+    outputs = tf.reshape(outputs, [num_heads * N, num_blocks * B, -1])[:, pad:]  # (h*N, T, C/h)
+    return outputs, attention_weights
+
+
+def static_encoding(name, build, *key):
+    '''
+    Returns the constant tensor of the numpy table :build:(*:key:) in the default graph.
+    The table is built once per process and the tensor once per graph (see graph_constant),
+    so every model of a process, e.g. of a sweep, reuses them.
+    '''
+    key = (name,) + key
+    if key not in _encoding_tables:
+        table = build(*key[1:])
+        table.setflags(write=False)
+        _encoding_tables[key] = table
+    return graph_constant(key, lambda: tf.constant(_encoding_tables[key]))
 
 
 def constant_timeseq_encoding(maxlen):
-    timeseq = np.array([i for i in range(maxlen, 0, -1)], dtype=np.int32) # oldest value is largest, most recent is 0
-    timeseq = tf.convert_to_tensor(timeseq.reshape(1, maxlen), dtype=tf.int32)
-    return timeseq
+    def build(maxlen, dtype):
+        # oldest value is largest, most recent is 0
+        return np.arange(maxlen, 0, -1, dtype=dtype.as_numpy_dtype).reshape(1, maxlen)
+
+    return static_encoding('constant_timeseq_encoding', build, int(maxlen), tf.int32)
 
 def timeseq_encoding(timeseq, max_interval):
     # Add one to include the zero padding, which will be sliced:
@@ -25,16 +155,14 @@ def timeseq_encoding(timeseq, max_interval):
 
 
 def positional_encoding(dim, sentence_length, dtype=tf.float32):
+    def build(dim, sentence_length, dtype):
+        # pos / 10000^(2i/dim) for every (pos, i), flattened in that order
+        encoded_vec = (np.arange(sentence_length)[:, None] / np.power(10000, 2 * np.arange(dim) / dim)).ravel()
+        encoded_vec[::2] = np.sin(encoded_vec[::2])
+        encoded_vec[1::2] = np.cos(encoded_vec[1::2])
+        return encoded_vec.reshape([sentence_length, dim]).astype(dtype.as_numpy_dtype)
 
-    encoded_vec = np.array([pos/np.power(10000, 2*i/dim)
-                            for pos in range(sentence_length) for i in range(dim)])
-
-    # encoded_vec = np.array([pos/np.power(10000, 2*i/dim)
-    #                        for i in range(dim) for pos in range(sentence_length)])
-    encoded_vec[::2] = np.sin(encoded_vec[::2])
-    encoded_vec[1::2] = np.cos(encoded_vec[1::2])
-    encoding = tf.convert_to_tensor(encoded_vec.reshape([sentence_length, dim]), dtype=dtype)
-    return encoding
+    return static_encoding('positional_encoding', build, int(dim), int(sentence_length), tf.as_dtype(dtype))
 
 # def positional_encoding(
 #         hidden_size, length, min_timescale=1.0, max_timescale=1.0e4):
@@ -164,6 +292,59 @@ def embedding(inputs,
         return outputs
 
 
+def split_heads_attention(model, Q_, K_, V_, key_masks, query_masks, num_heads, causality=False,
+                          dropout_rate=0, is_training=True):
+    '''Scaled dot-product attention of split heads, the core of multihead_attention.
+
+    Args:
+      Q_, K_, V_: Split heads, 3d tensors with shape of [h*N, T_q or T_k, C/h].
+      key_masks, query_masks: 2d tensors with shape of [N, T_k] and [N, T_q], 0 at padding positions.
+      causality: Boolean. If true, units that reference the future are masked.
+        If :model: has attention_mode 'local', causal self-attention only attends
+        to a local window (see blocked_causal_attention).
+
+    Returns
+      The weighted values [h*N, T_q, C/h] and the attention weights.
+    '''
+    if causality and getattr(model, 'attention_mode', 'full') == 'local':
+        return blocked_causal_attention(Q_, K_, V_, key_masks, query_masks, num_heads,
+                                        model.attention_window, dropout_rate, is_training)
+
+    # Multiplication
+    outputs = tf.matmul(Q_, tf.transpose(K_, [0, 2, 1]))  # (h*N, T_q, T_k)
+
+    # Scale
+    outputs = outputs / (K_.get_shape().as_list()[-1] ** 0.5)
+
+    # Key Masking and Causality = Future blinding, as one additive bias of
+    # 0 or -2**32+1 that broadcasts over the heads (and without causality,
+    # over the queries), instead of full (h*N, T_q, T_k) masks and paddings
+    bias = tf.expand_dims((1.0 - key_masks) * (-2**32+1), 1)  # (N, 1, T_k)
+    if causality:
+        # masked twice is still -2**32+1, as with the paddings it replaces
+        bias = tf.minimum(bias, causal_bias(tf.shape(Q_)[1], tf.shape(K_)[1]))  # (N, T_q, T_k)
+
+    N, T_q, T_k = tf.shape(key_masks)[0], tf.shape(outputs)[1], tf.shape(outputs)[2]
+    outputs = tf.reshape(outputs, [num_heads, N, T_q, T_k]) + bias  # (h, N, T_q, T_k)
+
+    # Activation
+    outputs = tf.nn.softmax(outputs)  # (h, N, T_q, T_k)
+
+    # Query Masking
+    outputs *= tf.expand_dims(query_masks, -1)  # broadcasting. (h, N, T_q, T_k)
+    outputs = tf.reshape(outputs, [num_heads * N, T_q, T_k])  # (h*N, T_q, T_k)
+
+    # Dropouts
+    outputs = tf.layers.dropout(
+        outputs, rate=dropout_rate, training=tf.convert_to_tensor(is_training))
+
+    attention_weights = outputs
+
+    # Weighted sum
+    outputs = tf.matmul(outputs, V_)  # ( h*N, T_q, C/h)
+    return outputs, attention_weights
+
+
 def multihead_attention(model, queries,
                         keys,
                         num_units=None,
@@ -183,6 +364,9 @@ def multihead_attention(model, queries,
       dropout_rate: A floating point number.
       is_training: Boolean. Controller of mechanism for dropout.
       causality: Boolean. If true, units that reference the future are masked. 
+        If :model: has attention_mode 'local', causal self-attention only attends
+        to a local window of model.attention_window to 2 * model.attention_window
+        positions (see blocked_causal_attention).
       num_heads: An int. Number of heads.
       scope: Optional scope for `variable_scope`.
       reuse: Boolean, whether to reuse the weights of a previous layer
@@ -212,54 +396,11 @@ def multihead_attention(model, queries,
         V_ = tf.concat(tf.split(V, num_heads, axis=2),
                        axis=0)  # (h*N, T_k, C/h)
 
-        # Multiplication
-        outputs = tf.matmul(Q_, tf.transpose(K_, [0, 2, 1]))  # (h*N, T_q, T_k)
-
-        # Scale
-        outputs = outputs / (K_.get_shape().as_list()[-1] ** 0.5)
-
-        # Key Masking
         key_masks = tf.sign(tf.abs(tf.reduce_sum(keys, axis=-1)))  # (N, T_k)
-        key_masks = tf.tile(key_masks, [num_heads, 1])  # (h*N, T_k)
-        key_masks = tf.tile(tf.expand_dims(key_masks, 1), [
-                            1, tf.shape(queries)[1], 1])  # (h*N, T_q, T_k)
-
-        paddings = tf.ones_like(outputs)*(-2**32+1)
-        outputs = tf.where(tf.equal(key_masks, 0), paddings,
-                           outputs)  # (h*N, T_q, T_k)
-
-        # Causality = Future blinding
-        if causality:
-            diag_vals = tf.ones_like(outputs[0, :, :])  # (T_q, T_k)
-            tril = tf.linalg.LinearOperatorLowerTriangular(
-                diag_vals).to_dense()  # (T_q, T_k)
-            masks = tf.tile(tf.expand_dims(tril, 0), [
-                            tf.shape(outputs)[0], 1, 1])  # (h*N, T_q, T_k)
-
-            paddings = tf.ones_like(masks)*(-2**32+1)
-            outputs = tf.where(tf.equal(masks, 0), paddings,
-                               outputs)  # (h*N, T_q, T_k)
-
-        # Activation
-        outputs = tf.nn.softmax(outputs)  # (h*N, T_q, T_k)
-        # attention_weights = outputs
-
-        # Query Masking
-        query_masks = tf.sign(
-            tf.abs(tf.reduce_sum(queries, axis=-1)))  # (N, T_q)
-        query_masks = tf.tile(query_masks, [num_heads, 1])  # (h*N, T_q)
-        query_masks = tf.tile(tf.expand_dims(
-            query_masks, -1), [1, 1, tf.shape(keys)[1]])  # (h*N, T_q, T_k)
-        outputs *= query_masks  # broadcasting. (N, T_q, C)
-
-        # Dropouts
-        outputs = tf.layers.dropout(
-            outputs, rate=dropout_rate, training=tf.convert_to_tensor(is_training))
-
-        attention_weights = outputs
-
-        # Weighted sum
-        outputs = tf.matmul(outputs, V_)  # ( h*N, T_q, C/h)
+        query_masks = tf.sign(tf.abs(tf.reduce_sum(queries, axis=-1)))  # (N, T_q)
+        outputs, attention_weights = split_heads_attention(
+            model, Q_, K_, V_, key_masks, query_masks, num_heads, causality,
+            dropout_rate, is_training)  # (h*N, T_q, C/h)
 
         # Restore shape
         outputs = tf.concat(tf.split(outputs, num_heads,
@@ -318,6 +459,117 @@ def feedforward(inputs,
     return outputs
 
 
+def batched_context_towers(model, seqs, scopes, mask, num_blocks, num_units, num_heads,
+                           dropout_rate=0, is_training=True, reuse=None):
+    '''Runs the context towers of a model (e.g. the hours and days towers of CAST8)
+    as one batched tower.
+
+    Tower s is the usual stack of :num_blocks: causal self-attention and feed forward
+    blocks over seqs[s], masked by :mask: and layer normalized at the end, with weights
+    of its own. Here the S sequences are stacked to [S, N, T, C]: the projections are
+    S-batched matmuls of the stacked weights of the towers and the attention runs over
+    the S * N sequences at once, so a block is a few large kernels instead of S times as
+    many small ones. The variables are created in the scopes and with the names of the
+    separate towers, so the two are equivalent and share checkpoints.
+
+    Args:
+      seqs: A list of S 3d tensors with shape of [N, T, C], C = num_units.
+      scopes: A list of S (tf.VariableScope, block scope) pairs, the scope a tower is
+        built in and the format of its block scopes, e.g. (scope, "hours_seq_num_blocks_%d").
+      mask: A 3d tensor with shape of [N, T, 1], 0 at padding positions.
+
+    Returns
+      A list of the S tower outputs [N, T, C] and a list of the attention weights of
+      the last block of every tower.
+    '''
+    S, C, h = len(seqs), num_units, num_heads
+    x = tf.stack(seqs)  # (S, N, T, C)
+    N, T = tf.shape(x)[1], tf.shape(x)[2]
+
+    def tower_scope(scope):
+        # re-enters the variable and name scope of a tower, not a new "scope_1"
+        return tf.variable_scope(scope, reuse=reuse, auxiliary_name_scope=False), \
+            tf.name_scope(scope.original_name_scope)
+
+    def layer_norm_variables():
+        # as created by normalize
+        with tf.variable_scope("ln"):
+            return tf.Variable(tf.zeros([C])), tf.Variable(tf.ones([C]))
+
+    def dense_variables(name, kernel_shape):
+        # as created by tf.layers.dense and tf.layers.conv1d
+        with tf.variable_scope(name):
+            return (tf.get_variable("kernel", kernel_shape, initializer=tf.glorot_uniform_initializer()),
+                    tf.get_variable("bias", kernel_shape[-1:], initializer=tf.zeros_initializer()))
+
+    def layer_norm(inputs, variables, epsilon=1e-8):
+        beta, gamma = [tf.reshape(tf.stack(v), [S, 1, 1, C]) for v in zip(*variables)]
+        mean, variance = tf.nn.moments(inputs, [-1], keep_dims=True)
+        normalized = (inputs - mean) / ((variance + epsilon) ** (.5))
+        return gamma * normalized + beta
+
+    def dense(inputs, variables, activation=None):
+        kernel, bias = [tf.stack(v) for v in zip(*variables)]
+        outputs = tf.matmul(tf.reshape(inputs, [S, -1, C]), tf.reshape(kernel, [S, C, C]))  # (S, N*T, C)
+        outputs = tf.reshape(outputs + tf.expand_dims(bias, 1), [S, N, T, C])
+        return outputs if activation is None else activation(outputs)
+
+    def split_heads(inputs):
+        # (S, N, T, C) -> (h*S*N, T, C/h), the S towers as S * N sequences
+        return tf.concat(tf.split(tf.reshape(inputs, [S * N, T, C]), h, axis=2), axis=0)
+
+    def sequence_masks(inputs):
+        return tf.reshape(tf.sign(tf.abs(tf.reduce_sum(inputs, axis=-1))), [S * N, T])
+
+    for i in range(num_blocks):
+        variables = []
+        for scope, block_scope in scopes:
+            variable_scope, name_scope = tower_scope(scope)
+            with variable_scope, name_scope, tf.variable_scope(block_scope % i):
+                tower = {"ln": layer_norm_variables()}
+                with tf.variable_scope("self_attention"):
+                    tower["Q"] = dense_variables("dense", [C, C])
+                    tower["K"] = dense_variables("dense_1", [C, C])
+                    tower["V"] = dense_variables("dense_2", [C, C])
+                tower["ff_ln"] = layer_norm_variables()
+                with tf.variable_scope("multihead_attention"):
+                    tower["ff_1"] = dense_variables("conv1d", [1, C, C])
+                    tower["ff_2"] = dense_variables("conv1d_1", [1, C, C])
+            variables.append(tower)
+        stacked = lambda name: [tower[name] for tower in variables]
+
+        # Self-attention
+        queries = layer_norm(x, stacked("ln"))
+        Q, K, V = dense(queries, stacked("Q")), dense(x, stacked("K")), dense(x, stacked("V"))
+        outputs, attention_weights = split_heads_attention(
+            model, split_heads(Q), split_heads(K), split_heads(V), sequence_masks(x),
+            sequence_masks(queries), h, True, dropout_rate, is_training)  # (h*S*N, T, C/h)
+        outputs = tf.concat(tf.split(outputs, h, axis=0), axis=2)  # (S*N, T, C)
+        x = tf.reshape(outputs, [S, N, T, C]) + queries
+
+        # Feed forward
+        inputs = layer_norm(x, stacked("ff_ln"))
+        outputs = dense(inputs, stacked("ff_1"), tf.nn.relu)
+        outputs = tf.layers.dropout(outputs, rate=dropout_rate, training=tf.convert_to_tensor(is_training))
+        outputs = dense(outputs, stacked("ff_2"))
+        outputs = tf.layers.dropout(outputs, rate=dropout_rate, training=tf.convert_to_tensor(is_training))
+        x = (outputs + inputs) * mask
+
+    variables = []
+    for scope, _ in scopes:
+        variable_scope, name_scope = tower_scope(scope)
+        with variable_scope, name_scope:
+            variables.append(layer_norm_variables())
+    x = layer_norm(x, variables)
+
+    # (h*S*N, T_q, T_k) -> S x (h*N, T_q, T_k)
+    weights_shape = tf.shape(attention_weights)
+    attention_weights = tf.reshape(attention_weights, tf.concat([[h, S, N], weights_shape[1:]], 0))
+    attention_weights = tf.transpose(attention_weights, [1, 0, 2, 3, 4])
+    attention_weights = tf.reshape(attention_weights, tf.concat([[S, h * N], weights_shape[1:]], 0))
+    return tf.unstack(x), tf.unstack(attention_weights, num=S)
+
+
 def mlp(inputs, num_units, scope="MLP", reuse=False):
     """
     Multi-Layer perceptron
@@ -333,3 +585,33 @@ def mlp(inputs, num_units, scope="MLP", reuse=False):
       h = tf.layers.dense(inputs, num_units[0], tf.nn.relu)
       h = tf.layers.dense(h, num_units[1], tf.nn.relu)
     return h
+
+
+def retrieval_layer(model, item_emb_table, seq):
+    '''Full-catalogue top-K retrieval at the last position of a sequence.
+
+    Every item is scored with one [N, C] x [C, items] matmul and only the
+    K best are kept with tf.nn.top_k, so no candidate list is needed.
+    Adds to the model:
+      query_emb: [N, C] representation at the last position, also the query
+        of an ann.IVFIndex over the item embeddings.
+      top_k: Placeholder for K (default 10).
+      exclude_items: Placeholder of (batch row, item) pairs that must not be
+        recommended, e.g. the items a user has already seen. Optional.
+      top_k_scores, top_k_items: [N, K] scores and ids of the best items.
+        The padding item 0 is never returned.
+
+    Args:
+      model: The model the placeholders and outputs are added to.
+      item_emb_table: The [items, C] item embedding table.
+      seq: A 3d tensor [N, T, C] of sequence representations.
+    '''
+    model.top_k = tf.placeholder_with_default(tf.constant(10, dtype=tf.int32), shape=())
+    model.exclude_items = tf.placeholder_with_default(tf.zeros([0, 2], dtype=tf.int32), shape=(None, 2))
+
+    model.query_emb = seq[:, -1, :]
+    logits = tf.matmul(model.query_emb, item_emb_table, transpose_b=True)  # [N, items]
+    excluded = tf.scatter_nd(model.exclude_items, tf.ones_like(model.exclude_items[:, 0]), tf.shape(logits))
+    excluded = tf.concat([tf.ones_like(excluded[:, :1]), excluded[:, 1:]], axis=1)
+    logits = tf.where(tf.greater(excluded, 0), tf.fill(tf.shape(logits), logits.dtype.min), logits)
+    model.top_k_scores, model.top_k_items = tf.nn.top_k(logits, k=model.top_k)
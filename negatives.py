@@ -0,0 +1,116 @@
+import numpy as np
+
+
+class NegativeSampler(object):
+    '''
+    Draws negative items (items a user has not interacted with) for many users at once.
+    Used both for the training batches and for the 100 candidates of the evaluation.
+
+    The sorted, de-duplicated item ids of every user are computed once. For the uniform
+    distribution a negative is drawn without rejection: a uniform rank r among the
+    itemnum - |seen| unseen items is mapped to the r-th unseen item id with a binary search
+    over the seen items. For the popularity distribution items are drawn from the global
+    (count ** alpha) distribution and the few collisions with the seen items are redrawn in bulk.
+
+    Arguments
+    ---------
+
+    history : UserHistory
+        The interactions that should be excluded (e.g. the train set).
+    itemnum : int
+        Item ids are 1..itemnum.
+    distribution : str
+        'uniform' or 'popularity'.
+    alpha : float
+        Exponent applied to the item counts for the popularity distribution.
+    '''
+
+    def __init__(self, history, itemnum, distribution='uniform', alpha=1.0):
+        if distribution not in ('uniform', 'popularity'):
+            raise ValueError('Unknown negative sampling distribution {}'.format(distribution))
+        self.itemnum = itemnum
+        self.distribution = distribution
+        self.stride = itemnum + 1
+
+        # Sorted unique items per user, as CSR
+        rows, users = history.rows()
+        items = history.columns['item'][rows]
+        keys = np.unique(users.astype(np.int64) * self.stride + items)
+        self.seen_items = (keys % self.stride).astype(np.int32)
+        counts = np.bincount(keys // self.stride, minlength=len(history.starts))
+        self.seen_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.seen_offsets[1:])
+
+        if distribution == 'popularity':
+            popularity = np.bincount(items, minlength=self.stride).astype(np.float64) ** alpha
+            popularity[0] = 0
+            self.popular = popularity > 0
+            self.cdf = np.cumsum(popularity)
+            self.cdf /= self.cdf[-1]
+
+    def seen(self, users):
+        '''
+        Returns the sorted seen items of :users: concatenated, with the batch row of
+        each item and the number of seen items per row.
+        '''
+        starts = self.seen_offsets[users]
+        lengths = self.seen_offsets[users + 1] - starts
+        rows = np.repeat(np.arange(len(users)), lengths)
+        first = np.cumsum(lengths) - lengths
+        idx = np.arange(lengths.sum()) - first[rows] + starts[rows]
+        return self.seen_items[idx], rows, lengths
+
+    def sample(self, users, num, rng=np.random):
+        '''
+        Returns a [len(users), num] int32 matrix of negatives for :users:, drawn
+        with :rng: (a np.random.RandomState, the global one by default).
+        '''
+        users = np.asarray(users)
+        if self.distribution == 'uniform':
+            return self.sample_uniform(users, num, rng)
+        return self.sample_popularity(users, num, rng)
+
+    def sample_uniform(self, users, num, rng=np.random):
+        items, rows, lengths = self.seen(users)
+
+        # gaps[j] is the number of unseen items smaller than the j-th seen item of that row;
+        # offsetting each row by row * stride lets one searchsorted cover the whole batch
+        first = np.cumsum(lengths) - lengths
+        rank_in_row = np.arange(len(items)) - first[rows]
+        gaps = rows * self.stride + (items - rank_in_row)
+
+        # uniform rank (1-based) among the unseen items of every row
+        num_unseen = self.itemnum - lengths
+        self.check_unseen(users, num_unseen)
+        rank = (rng.random_sample((len(users), num)) * num_unseen[:, None]).astype(np.int64) + 1
+        offset = (np.arange(len(users)) * self.stride)[:, None]
+        skipped = np.searchsorted(gaps, offset + rank, side='right') - first[:, None]
+        return (rank + skipped).astype(np.int32)
+
+    def sample_popularity(self, users, num, rng=np.random):
+        items, rows, _ = self.seen(users)
+        keys = rows * self.stride + items
+        offset = (np.arange(len(users)) * self.stride)[:, None]
+        # only the items with a nonzero popularity can be drawn
+        seen_popular = np.bincount(rows, weights=self.popular[items], minlength=len(users))
+        self.check_unseen(users, self.popular.sum() - seen_popular)
+
+        neg = np.searchsorted(self.cdf, rng.random_sample((len(users), num)), side='right')
+        redraw = self.is_seen(keys, offset + neg)
+        while redraw.any():
+            neg[redraw] = np.searchsorted(self.cdf, rng.random_sample(redraw.sum()), side='right')
+            redraw = self.is_seen(keys, offset + neg)
+        return neg.astype(np.int32)
+
+    @staticmethod
+    def check_unseen(users, num_unseen):
+        if (num_unseen <= 0).any():
+            raise ValueError('No negatives can be drawn for the users {}: they have seen every item'.format(
+                np.unique(users[num_unseen <= 0]).tolist()))
+
+    @staticmethod
+    def is_seen(keys, candidates):
+        if len(keys) == 0:
+            return np.zeros(candidates.shape, dtype=bool)
+        pos = np.minimum(np.searchsorted(keys, candidates), len(keys) - 1)
+        return keys[pos] == candidates
@@ -1,11 +1,14 @@
+import sys
 import logging
 import argparse
 
 from data_reader import DataReader
+import data_registry
 
-def main(raw_dataset, out_dataset, dataset_type, limit):
+def main(raw_dataset, out_dataset, dataset_type, limit, workers=None, min_count=5, memory_limit=None):
     # Start the data reader and read the dataset
-    dr = DataReader(raw_dataset, out_dataset, dataset_type, limit=limit)
+    dr = DataReader(raw_dataset, out_dataset, dataset_type, limit=limit, workers=workers, min_count=min_count,
+                    memory_limit=memory_limit)
     dr.preprocess()
 
 if __name__ == '__main__':
@@ -22,9 +25,27 @@ if __name__ == '__main__':
 
     # DATASET PARAMETERS
     parser.add_argument('--raw_dataset', help='Raw gzip dataset, Amazon Product Review data')
-    parser.add_argument('--output', required=True, help='Output file of the pre-processed dataset')
-    parser.add_argument('--type', required=True, type=str, help='Dataset type (amazon, movielens, amazon_ratings)')
+    parser.add_argument('--output', help='Output file of the pre-processed dataset')
+    parser.add_argument('--type', type=str, help='Dataset type (amazon, movielens, amazon_ratings)')
+    parser.add_argument('--datasets', nargs='+', choices=sorted(data_registry.REGISTRY) + ['all'],
+                        help='Pre-process these registered datasets instead, skipping the ones that are up to date')
+    parser.add_argument('--jobs', default=None, type=int, help='Datasets pre-processed at once (default: all)')
+    parser.add_argument('--force', action='store_true', help='Also pre-process up to date --datasets')
     parser.add_argument('--limit', default=None, type=int, help='Limit the number of datapoints')
+    parser.add_argument('--workers', default=None, type=int, help='Processes parsing the Amazon reviews (default: all cores)')
+    parser.add_argument('--min_count', default=5, type=int, help='Minimum number of interactions per user and item (k-core)')
+    parser.add_argument('--memory_limit', default=None, type=int,
+                        help='Memory (MB) for the interactions; above it they are sorted on disk next to --output')
     args = parser.parse_args()
 
-    main(args.raw_dataset, args.output, args.type, args.limit)
\ No newline at end of file
+    if args.datasets:
+        names = sorted(data_registry.REGISTRY) if 'all' in args.datasets else args.datasets
+        results = data_registry.preprocess_datasets(names, jobs=args.jobs, force=args.force, limit=args.limit,
+                                                    min_count=args.min_count, memory_limit=args.memory_limit)
+        for name, status, seconds in results:
+            logger.info('{:<16} {:<16} {:.1f}s'.format(name, status, seconds))
+        sys.exit(any(status.startswith('failed') for _, status, _ in results))
+
+    if not args.output or not args.type:
+        parser.error('--output and --type are required without --datasets')
+    main(args.raw_dataset, args.output, args.type, args.limit, args.workers, args.min_count, args.memory_limit)
\ No newline at end of file
@@ -0,0 +1,86 @@
+import numpy as np
+
+
+class QuantileSketch(object):
+    '''
+    Streaming quantile summary of a large number of values.
+
+    Up to :exact_limit: values are kept as they are and the quantiles are exact
+    (the same as np.percentile). Beyond that the values are compacted: level h
+    holds items of weight 2 ** h, and a level that grows past :capacity: items
+    is sorted and every second item (from a random offset) is promoted to the
+    next level. The rank error of a quantile is then about
+    log2(n / capacity) / capacity, while the memory stays at a few
+    :capacity: sized levels.
+
+    Arguments
+    ---------
+
+    exact_limit : int
+        Number of values up to which the quantiles are exact.
+    capacity : int
+        Items per level once the values are compacted.
+    seed : int
+        Seed of the compaction offsets, so the summary of the same values is reproducible.
+    '''
+
+    def __init__(self, exact_limit=1 << 22, capacity=1 << 14, seed=0):
+        self.exact_limit = exact_limit
+        self.capacity = capacity
+        self.rng = np.random.RandomState(seed)
+        self.levels = [[]]
+        self.n = 0
+        self.min = None
+        self.max = None
+
+    @property
+    def exact(self):
+        return self.n <= self.exact_limit
+
+    def update(self, values):
+        values = np.asarray(values).ravel()
+        if not values.size:
+            return
+        self.n += values.size
+        self.min = values.min() if self.min is None else min(self.min, values.min())
+        self.max = values.max() if self.max is None else max(self.max, values.max())
+        self.levels[0].append(values)
+        if not self.exact:
+            self.compact()
+
+    def compact(self):
+        h = 0
+        while h < len(self.levels):
+            level = np.concatenate(self.levels[h]) if self.levels[h] else np.zeros(0)
+            if level.size <= self.capacity:
+                self.levels[h] = [level]
+                h += 1
+                continue
+            level = np.sort(level)
+            # an odd item stays, the pairs are halved into the next level
+            pairs = level.size // 2 * 2
+            self.levels[h] = [level[pairs:]]
+            if h + 1 == len(self.levels):
+                self.levels.append([])
+            self.levels[h + 1].append(level[self.rng.randint(2):pairs:2])
+            h += 1
+
+    def percentiles(self, q):
+        '''
+        Returns the (approximate) percentiles :q: (0..100) of the values.
+        '''
+        q = np.asarray(q, dtype=np.float64)
+        if self.n == 0:
+            raise ValueError('No values in the quantile sketch')
+        if self.exact:
+            return np.percentile(np.concatenate(self.levels[0]), q)
+
+        values = np.concatenate([np.concatenate(level) for level in self.levels if level])
+        weights = np.concatenate([np.full(sum(len(a) for a in level), 2 ** h, dtype=np.int64)
+                                  for h, level in enumerate(self.levels) if level])
+        order = np.argsort(values, kind='stable')
+        values, cumulative = values[order], np.cumsum(weights[order])
+        idx = np.searchsorted(cumulative, q / 100.0 * (self.n - 1), side='right')
+        result = values[np.minimum(idx, len(values) - 1)].astype(np.float64)
+        # the extremes are tracked exactly
+        return np.where(q <= 0, self.min, np.where(q >= 100, self.max, result))
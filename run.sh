@@ -36,11 +36,8 @@ sh download_data.sh
 # AMAZON BOOKS
 # python3 preprocess.py --raw_dataset data/reviews_Books_5.json.gz --type amazon --output data/Books.txt
 
-# AMAZON BEAUTY
-python3 preprocess.py --raw_dataset data/reviews_Beauty.json.gz --type amazon --output data/Beauty.txt
-
-# MOVIELENS 1-M
-python3 preprocess.py --raw_dataset data/ml-1m/ratings.dat --type movielens --output data/ml-1m.txt
+# AMAZON BEAUTY, MOVIELENS 1-M (concurrently, skipped when up to date)
+python3 preprocess.py --datasets Beauty ml-1m
 
 
 ### PROGRAM ###
@@ -1,74 +1,132 @@
+'''
+Trains several model configurations on one dataset and reports their NDCG@10, HR@10
+and wall-clock time in a table.
+
+The runs share one process (--jobs 1): TensorFlow is imported and the dataset is
+loaded once, and every configuration is trained in a new graph. With --jobs N the
+configurations are trained by a pool of N processes instead, each of which opens the
+compiled dataset cache (memory-mapped) once for all the runs it does.
+
+All arguments other than those below are the arguments of main.py and apply to every
+run, e.g. the movielens runs of the cast models:
+
+    python3 run_experiments.py --dataset data/ml-20m.txt --models cast_1 cast_2 cast_3 \\
+        --maxlen 200 --bin_in_hours 48 --dropout_rate 0.2 --num_blocks 2 --seed 42
+
+--configs takes a JSON file with a list of runs instead, each a dict of main.py
+arguments (by their names in params.txt) with at least "model" and optionally a
+"name" for the table and the train_dir, e.g.
+[{"model": "cast_9"}, {"name": "cast_9_batched", "model": "cast_9", "batched_context_towers": true}]
+'''
+
+import json
+import time
 import argparse
-import subprocess
-
-parser = argparse.ArgumentParser()
-
-# DATASET PARAMETERS
-parser.add_argument('--dataset',
-                help='Location of pre-processed dataset')
-parser.add_argument('--limit', default=None, type=int,
-                help='Limit the number of datapoints')
-parser.add_argument('--maxlen', default=50, type=int,
-                help='Maximum length of user item sequence, for zero-padding')
-
-parser.add_argument('--train_dir') 
-
-# TRAIN PARAMETERS
-parser.add_argument('--batch_size', default=128,
-                type=int, help='Batch size')
-parser.add_argument('--lr', type=float, default=1e-3, help='Learning rate')
-parser.add_argument('--num_epochs', type=int,
-                default=201, help='Number of epochs')
-parser.add_argument('--max_norm', type=float, default=5.0, help='--')
-
-# MODEL PARAMETERS
-parser.add_argument('--hidden_units', default=50, type=int)
-parser.add_argument('--num_blocks', default=2, type=int)
-parser.add_argument('--num_heads', default=1, type=int)
-parser.add_argument('--dropout_rate', default=0.5, type=float)
-parser.add_argument('--l2_emb', default=0.0, type=float)
-parser.add_argument('--bin_in_hours', default=24, type=int)
-parser.add_argument('--max_bins', default=200, type=int)
-
-# MISC.
-parser.add_argument('--saved_model', default='model.pt',
-                type=str, help='File to save model checkpoints')
-parser.add_argument('--test_baseline', default=False, action='store_true')
-parser.add_argument('--seed', default=None, type=int)
-parser.add_argument('--log_scale', default=False, action='store_true')
-parser.add_argument('--input_context', default=False, action='store_true')
-parser.add_argument('--model', default="cast", 
-                help="model to use from {cast, sasrec, castsp}")
-# parser.add_argument('--device', default='cuda', type=str, help='Device to run model on') #TODO: GPU
-
-args = parser.parse_args()
-
-
-# Experiment
-
-args.dataset = 'data/ml-20m.txt'
-# args.dataset = 'data/Beauty.txt'
-for i in range(1, 8):
-    model = 'cast_{}'.format(i)
-    args.train_dir = model # + '_log'
-    args.model = model
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+from main import build_parser, setup_logging, train_and_evaluate
+from util import data_partition
+
+logger = logging.getLogger('ir2')
+
+# the datasets loaded by this process, by path
+_datasets = {}
+
+
+def load_partition(fpath):
+    if fpath not in _datasets:
+        _datasets[fpath] = data_partition(fpath)
+    return _datasets[fpath]
+
 
+def experiment_args(train_args, config):
+    '''
+    Returns the name and the main.py arguments of the run :config: (a dict of main.py
+    arguments with at least 'model'), the other arguments taken from :train_args:.
+    '''
+    config = dict(config)
+    name = config.pop('name', config['model'])
+    config.setdefault('train_dir', name)
+    args = build_parser().parse_args(train_args + ['--model', config['model'], '--train_dir', config['train_dir']])
+    unknown = sorted(set(config) - set(vars(args)))
+    if unknown:
+        raise ValueError('Unknown arguments {} in the run {}'.format(', '.join(unknown), name))
+    vars(args).update(config)
+    return name, args
+
+
+def run_experiment(train_args, config):
+    '''
+    Trains the run :config: and returns its row of the results table.
+    '''
+    name, args = experiment_args(train_args, config)
+    row = {'name': name, 'model': args.model, 'status': 'done', 'epochs': 0, 'train_time': 0.0,
+           'valid': None, 'test': None, 'train_dir': None}
+    t0 = time.time()
     try:
-        # movielens params
-        c = ['python3', 'main.py', '--dataset', args.dataset, 
-            '--train_dir', args.train_dir, '--model', args.model,
-            '--maxlen', '200', '--bin_in_hours', '48', '--dropout_rate', '0.2', 
-            '--num_blocks', '2', '--seed', '42']
-
-        # beauty params 
-        # c = ['python3', 'main.py', '--dataset', args.dataset, 
-        #     '--train_dir', args.train_dir, '--model', args.model,
-        #     '--maxlen', '50', '--bin_in_hours', '48', '--dropout_rate', '0.5', 
-        #     '--num_blocks', '2', '--seed', '42']#, '--log_scale']
-
-        subprocess.call(c)
+        row.update(train_and_evaluate(args, load_partition(args.dataset)))
     except Exception as e:
-        with open("experiment_errors.txt", "w") as f:
-            print(e)
-            f.write(str(e) + '\n')
-        pass
+        logger.exception('Run {} failed'.format(name))
+        with open('experiment_errors.txt', 'a') as f:
+            f.write('{}: {}\n'.format(name, e))
+        row['status'] = 'failed: {}'.format(e)
+    row['wall_time'] = time.time() - t0
+    return row
+
+
+def run_experiments(train_args, configs, jobs=1):
+    '''
+    Trains the runs :configs: in this process (:jobs: 1) or in a pool of :jobs: processes
+    and returns their rows of the results table, in the order of :configs:.
+    '''
+    # compiles the dataset caches (once) before the runs, so the processes of a pool only open them
+    for fpath in sorted({experiment_args(train_args, config)[1].dataset for config in configs}):
+        load_partition(fpath)
+    if jobs == 1:
+        return [run_experiment(train_args, config) for config in configs]
+    with ProcessPoolExecutor(jobs, initializer=setup_logging) as pool:
+        futures = [pool.submit(run_experiment, train_args, config) for config in configs]
+        return [future.result() for future in futures]
+
+
+def format_results(rows):
+    '''
+    Returns the results table of :rows: as text.
+    '''
+    metric = lambda result, i: '{:.4f}'.format(result[i]) if result else '-'
+    lines = ['{:<24} {:>10} {:>10} {:>10} {:>10} {:>7} {:>10} {:>10}  {}'.format(
+        'run', 'val NDCG', 'val HR', 'test NDCG', 'test HR', 'epochs', 'train (s)', 'wall (s)', 'status')]
+    for row in rows:
+        lines.append('{:<24} {:>10} {:>10} {:>10} {:>10} {:>7d} {:>10.1f} {:>10.1f}  {}'.format(
+            row['name'], metric(row['valid'], 0), metric(row['valid'], 1), metric(row['test'], 0),
+            metric(row['test'], 1), row['epochs'], row['train_time'], row['wall_time'], row['status']))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Trains several model configurations in one process or pool; '
+                                     'all other arguments are passed to the training parser of main.py')
+    parser.add_argument('--models', default=['cast_{}'.format(i) for i in range(1, 8)], nargs='+',
+                        help='Models to train, one run each with the same arguments')
+    parser.add_argument('--configs', default=None,
+                        help='JSON file with the list of runs (dicts of main.py arguments), instead of --models')
+    parser.add_argument('--jobs', default=1, type=int,
+                        help='Number of runs at a time, each in a process of its own if more than 1')
+    parser.add_argument('--results', default=None,
+                        help='Also write the results (one JSON object per run) to this file')
+    args, train_args = parser.parse_known_args()
+
+    if args.configs:
+        with open(args.configs, 'r') as f:
+            configs = json.load(f)
+    else:
+        configs = [{'model': model} for model in args.models]
+
+    setup_logging()
+    rows = run_experiments(train_args, configs, args.jobs)
+    print(format_results(rows))
+    if args.results:
+        with open(args.results, 'w') as f:
+            for row in rows:
+                f.write(json.dumps(row) + '\n')
@@ -42,8 +42,8 @@ pip3 install -r requirements.txt
 # python3 preprocess.py --raw_dataset data/ml-1m/ratings.dat --type movielens --output data/ml-1m.txt #--limit 100000
 
 # MOVIELENS 20-M
-python3 preprocess.py --raw_dataset data/ml-20m/ratings.csv --type movielens --output data/ml-20m.txt #--limit 100000
+python3 preprocess.py --datasets ml-20m #--limit 100000
 
 ### PROGRAM ###
-python3 run_experiments.py
+python3 run_experiments.py --dataset data/ml-20m.txt --maxlen 200 --bin_in_hours 48 --dropout_rate 0.2 --num_blocks 2 --seed 42
 mail_template "IR2" $SLURM_JOBID "FINISHED" "$1"
@@ -1,84 +1,152 @@
+import ctypes
 import numpy as np
 from multiprocessing import Process, Queue
+from multiprocessing.sharedctypes import RawArray
 
 import multiprocessing
 multiprocessing.set_start_method('spawn', True)
 
-from util import get_timedelta_bin, get_delta_range
-
-def random_neq(l, r, s):
-    t = np.random.randint(l, r)
-    # pick a product id that is NOT in the set of unique product ids of this sequence
-    while t in s:
-        t = np.random.randint(l, r)
-    return t
-
-def sample_function(user_train, usernum, itemnum, batch_size, maxlen, result_queue, bin_in_hours, max_bins, log_scale, min_timedelta, max_timedelta, SEED):
-    def sample():
-        # Get a random user_id, make sure it has more than x interactions (which we already checked?):
-        user = np.random.randint(1, usernum + 1)
-        while len(user_train[user]) <= 1: 
-            user = np.random.randint(1, usernum + 1)
-
-        # Create sequence / pos / negative with zero padding :maxlen:
-        seq = np.zeros([maxlen], dtype=np.int32)
-        pos = np.zeros([maxlen], dtype=np.int32)
-        neg = np.zeros([maxlen], dtype=np.int32)
-        nxt = user_train[user][-1].item
-        timeseq = np.zeros([maxlen], dtype=np.int32)
-        ratings_seq = np.zeros([maxlen], dtype=np.int32)
-        hours_seq = np.zeros([maxlen], dtype=np.int32)
-        days_seq = np.zeros([maxlen], dtype=np.int32)
-        
-        orig_seq = [0] * maxlen
-        idx = maxlen - 1
-        
-        # print('sequence', user_train[user])
-        # print('get most recent product in sequence', nxt)
-        # Sequence shape has maxlen zero padding
-        # assert seq.shape[0] == maxlen
-
-        # Get unique product ids in sequence
-        ts = set([i.item for i in user_train[user]])
-        # NOTE: Reverse sequence (ascending -> descending), except for the last interaction
-        for i in reversed(user_train[user][:-1]):
-            # print('idx', idx, 'i', i, 'nxt', nxt)
-            seq[idx] = i.item
-            ratings_seq[idx] = i.rating
-            hours_seq[idx] = i.ts.hour
-            days_seq[idx] = i.ts.day
-            orig_seq[idx] = i
-            pos[idx] = nxt
-            if nxt != 0: # TODO: What does nxt != 0 mean?
-                # print('nxt', nxt)
-                # Pick a random product id between 1 and :itemnum: NOT in the set of unique product ids of this sequence
-                neg[idx] = random_neq(1, itemnum + 1, ts)
-            nxt = i.item # nxt becomes i
-            idx -= 1
-            if idx == -1: break
-
-
-        most_recent_timestamp = orig_seq[-1].timestamp
-        for idx, s in enumerate(orig_seq):
-            if s != 0:
-                time_delta = (most_recent_timestamp - s.timestamp).total_seconds()
-                if log_scale:
-                    timeseq[idx] = get_timedelta_bin(time_delta, bin_in_hours=48, max_bins=200,
-                                                   log_scale=True, min_ts=min_timedelta, max_ts=max_timedelta)
-                else:
-                    timeseq[idx] = get_timedelta_bin(time_delta, bin_in_hours=bin_in_hours, max_bins=max_bins,
-                                                log_scale=False)
-            else:
-                timeseq[idx] = 0
-
-        return (user, seq, pos, neg, timeseq, ratings_seq, hours_seq, days_seq, orig_seq)
+from util import get_delta_range, TimeBinner
+from negatives import NegativeSampler
 
+class BatchSampler(object):
+    """
+    Builds whole training batches with array operations over the flat columns of a
+    :UserHistory:, instead of filling every row element by element.
+
+    For every sampled user the last :maxlen: + 1 interactions are gathered with one
+    fancy-indexing operation: the first :maxlen: become the input sequence, the
+    last :maxlen: the positives (next items), right-aligned and zero-padded.
+
+    If the history has an 'input_time_bin' column (the 'train' table of
+    util.get_time_bin_tables) the time bins are gathered from it as well.
+    """
+    def __init__(self, user_train, usernum, itemnum, maxlen, bin_in_hours, max_bins, log_scale, min_timedelta, max_timedelta,
+                 neg_distribution='uniform', neg_alpha=1.0):
+        self.starts = user_train.starts
+        self.ends = user_train.ends
+        self.items = user_train.columns['item']
+        self.ratings = user_train.columns['rating']
+        self.hours = user_train.columns['hour']
+        self.days = user_train.columns['day']
+        self.timestamps = user_train.columns['timestamp']
+        self.itemnum = itemnum
+        self.maxlen = maxlen
+        self.time_bins = TimeBinner(bin_in_hours, max_bins, log_scale, min_timedelta, max_timedelta)
+        self.input_time_bins = user_train.columns.get('input_time_bin')
+
+        # Only users with more than one interaction have a next item to predict
+        lengths = user_train.lengths()
+        self.eligible_users = np.flatnonzero(lengths[1:usernum + 1] > 1) + 1
+        self.positions = np.arange(maxlen)
+        self.negative_sampler = NegativeSampler(user_train, itemnum, neg_distribution, neg_alpha)
+
+    def sample(self, batch_size, rng=np.random):
+        """
+        Returns a batch of :batch_size: users, drawn with :rng: (a np.random.RandomState,
+        the global one by default). Reads the columns only, so several threads can sample at once.
+        """
+        maxlen = self.maxlen
+        users = self.eligible_users[rng.randint(len(self.eligible_users), size=batch_size)]
+        ends = self.ends[users]
+
+        # NOTE: The inputs are all interactions except the last one, the positives are the
+        # same interactions shifted by one (i.e. the next item), right-aligned in :maxlen:
+        n = np.minimum(ends - self.starts[users] - 1, maxlen)
+        valid = self.positions >= (maxlen - n)[:, None]
+        rows = (ends - 1 - maxlen)[:, None] + self.positions
+        rows = np.where(valid, rows, 0)
+
+        seq = np.where(valid, self.items[rows], 0).astype(np.int32)
+        pos = np.where(valid, self.items[rows + 1], 0).astype(np.int32)
+        ratings_seq = np.where(valid, self.ratings[rows], 0).astype(np.int32)
+        hours_seq = np.where(valid, self.hours[rows], 0).astype(np.int32)
+        days_seq = np.where(valid, self.days[rows], 0).astype(np.int32)
+
+        # Pick random product ids between 1 and :itemnum: NOT in the set of unique product ids of the sequence
+        neg = np.where(valid, self.negative_sampler.sample(users, maxlen, rng), 0).astype(np.int32)
+
+        # Time bins relative to the most recent input interaction
+        if self.input_time_bins is not None:
+            timeseq = np.where(valid, self.input_time_bins[rows], 0).astype(np.int32)
+        else:
+            most_recent_timestamp = self.timestamps[ends - 2]
+            # the padding has no interactions, so its (negative) deltas are zeroed before binning
+            time_delta = most_recent_timestamp[:, None] - self.timestamps[rows]
+            timeseq = np.where(valid, self.time_bins(np.where(valid, time_delta, 0)), 0).astype(np.int32)
+
+        return (users.astype(np.int32), seq, pos, neg, timeseq, ratings_seq, hours_seq, days_seq)
+
+
+def batch_sampler(args, User, usernum, itemnum):
+    """
+    The :BatchSampler: of the training arguments :args:, as used by the sampler processes
+    of WarpSampler and by the tf.data pipeline of main.train_inputs.
+    """
+    min_timedelta, max_timedelta = get_delta_range(User)
+    return BatchSampler(User, usernum, itemnum, args.maxlen, args.bin_in_hours, args.max_bins, args.log_scale,
+                        min_timedelta, max_timedelta, args.neg_distribution, args.neg_alpha)
+
+
+def sample_function(user_train, usernum, itemnum, batch_size, maxlen, result_queue, bin_in_hours, max_bins, log_scale, min_timedelta, max_timedelta, SEED,
+                    neg_distribution='uniform', neg_alpha=1.0):
     np.random.seed(SEED)
+    sampler = BatchSampler(user_train, usernum, itemnum, maxlen, bin_in_hours, max_bins,
+                           log_scale, min_timedelta, max_timedelta, neg_distribution, neg_alpha)
     while True:
-        one_batch = []
-        for i in range(batch_size):
-            one_batch.append(sample())
-        result_queue.put(zip(*one_batch))
+        result_queue.put(sampler.sample(batch_size))
+
+class SharedBatchQueue(object):
+    """
+    Single-producer queue of batches backed by a ring of pre-allocated shared-memory
+    int32 buffers. The producer writes a batch into a free slot and only the slot index
+    travels through a multiprocessing.Queue, so batches are never pickled.
+
+    The arrays returned by get() are views on the slot and stay valid until the next
+    call to get(), after which the slot is handed back to the producer.
+    """
+    def __init__(self, batch_size, maxlen, n_slots=10):
+        self.batch_size = batch_size
+        self.maxlen = maxlen
+        self.n_slots = n_slots
+        # Every slot holds the users [batch_size] followed by seq, pos, neg, timeseq,
+        # ratings_seq, hours_seq and days_seq, each [batch_size, maxlen]
+        self.slot_size = batch_size * (1 + 7 * maxlen)
+        self.buffer = RawArray(ctypes.c_int32, n_slots * self.slot_size)
+        self.free_slots = Queue()
+        self.ready_slots = Queue()
+        for slot in range(n_slots):
+            self.free_slots.put(slot)
+        self.current_slot = None
+        self.slots = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['slots'] = None
+        return state
+
+    def slot(self, slot):
+        if self.slots is None:
+            self.slots = np.frombuffer(self.buffer, dtype=np.int32).reshape(self.n_slots, self.slot_size)
+        users = self.slots[slot, :self.batch_size]
+        matrices = self.slots[slot, self.batch_size:].reshape(7, self.batch_size, self.maxlen)
+        return users, matrices
+
+    def put(self, batch):
+        slot = self.free_slots.get()
+        users, matrices = self.slot(slot)
+        users[:] = batch[0]
+        for i, m in enumerate(batch[1:]):
+            matrices[i] = m
+        self.ready_slots.put(slot)
+
+    def get(self):
+        if self.current_slot is not None:
+            self.free_slots.put(self.current_slot)
+        self.current_slot = self.ready_slots.get()
+        users, matrices = self.slot(self.current_slot)
+        return (users,) + tuple(matrices)
+
 
 class WarpSampler(object):
     """
@@ -100,15 +168,19 @@ class WarpSampler(object):
     The neg vector has :maxlen: items, filled at the end with 'negative' samples, i.e. randomly drawn product ids that do not exist in the current interaction data.
     """
     def __init__(self, args, User, usernum, itemnum, sample_func=sample_function, batch_size=64, maxlen=10, n_workers=1):
-        self.result_queue = Queue(maxsize=n_workers * 10)
         self.processors = []
-        
+        # One batch queue per worker, read round-robin, so that the order of the batches
+        # only depends on the seed and not on which worker happens to be faster
+        self.queues = [SharedBatchQueue(batch_size, maxlen) for _ in range(n_workers)]
+        self.next_queue = 0
+
         min_timedelta, max_timedelta = get_delta_range(User)
 
         if args.seed:
             seed = args.seed
         else:
             seed = np.random.randint(2e9)
+        worker_seeds = np.random.RandomState(seed).randint(2 ** 31 - 1, size=n_workers)
         for i in range(n_workers):
             self.processors.append(
                 Process(target=sample_func, args=(User,
@@ -116,19 +188,23 @@ class WarpSampler(object):
                                                   itemnum,
                                                   batch_size,
                                                   maxlen,
-                                                  self.result_queue,
+                                                  self.queues[i],
                                                   args.bin_in_hours,
                                                   args.max_bins,
                                                   args.log_scale,
                                                   min_timedelta,
                                                   max_timedelta,
-                                                  seed
-                                                  )))
+                                                  int(worker_seeds[i])
+                                                  ),
+                        kwargs={'neg_distribution': args.neg_distribution,
+                                'neg_alpha': args.neg_alpha}))
             self.processors[-1].daemon = True
             self.processors[-1].start()
 
     def next_batch(self):
-        return self.result_queue.get()
+        queue = self.queues[self.next_queue]
+        self.next_queue = (self.next_queue + 1) % len(self.queues)
+        return queue.get()
 
     def close(self):
         for p in self.processors:
@@ -0,0 +1,477 @@
+'''
+Inference server for trained models.
+
+A training run directory (saved_models/<dataset>/<run>/) holds the checkpoint
+and the params.txt it was trained with. Recommender rebuilds the model from
+params.txt, restores the checkpoint and freezes it into an inference-only
+graph: variables become constants, is_training is fixed to False (so dropout
+is folded away) and everything that is not needed for the top-K retrieval
+(loss, optimizer, summaries) is pruned.
+
+Requests are answered over HTTP, on a TCP port or a Unix socket:
+
+    POST /recommend {"items": [...], "timestamps": [...], "k": 10, "exclude_seen": true}
+    -> {"items": [...], "scores": [...]}
+
+where "items" is the history of a user, oldest first, with the unix time of
+every interaction in "timestamps". Concurrent requests are grouped by
+MicroBatcher, so that one session run answers up to --max_batch_size requests.
+
+For clickstreams the server also keeps the recent history and the final
+encoded state of users (UserStateCache):
+
+    POST /events {"user": "...", "items": [...], "timestamps": [...]}
+    POST /recommend {"user": "...", "k": 10}
+
+appends interactions to the history of a user and recommends from it. The
+first recommendation after new events still encodes the whole maxlen window,
+only the recommendations without new events skip the model.
+'''
+
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import threading
+import socketserver
+from collections import OrderedDict
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+import tensorflow as tf
+
+from main import build_model
+from ann import ITEM_EMBEDDINGS
+from dataset import hour_of_day, day_of_week
+from util import data_partition, get_delta_range, TimeBinner
+
+
+class Recommender():
+    '''
+    Inference-only model of a training run.
+
+    Arguments
+    ---------
+
+    run_dir : str
+        Training run directory containing params.txt and the checkpoints.
+    checkpoint : str
+        Checkpoint prefix to restore, the latest checkpoint of :run_dir: by default.
+    state_cache_bytes : int
+        Memory budget of the :UserStateCache: of the histories and states of
+        users, for requests that name a user instead of sending the items.
+        No cache if 0.
+    '''
+
+    # inputs of the frozen graph, by attribute of the model
+    INPUTS = ['input_seq', 'time_seq', 'hours', 'days', 'top_k', 'exclude_items']
+    OUTPUTS = ['top_k_items', 'top_k_scores']
+
+    def __init__(self, run_dir, checkpoint=None, state_cache_bytes=0):
+        with open(os.path.join(run_dir, 'params.txt'), 'r') as f:
+            self.args = argparse.Namespace(**json.load(f))
+        if checkpoint is None:
+            checkpoint = tf.train.latest_checkpoint(run_dir)
+        if checkpoint is None:
+            raise ValueError('No checkpoint found in {}'.format(run_dir))
+
+        # usernum and ratingnum are not used by the models, the number of items is
+        # read from the embedding table so that the dataset is not needed
+        self.itemnum = tf.train.load_checkpoint(checkpoint).get_variable_to_shape_map()[ITEM_EMBEDDINGS][0] - 1
+        self.maxlen = self.args.maxlen
+        self.cache = UserStateCache(self.maxlen, state_cache_bytes) if state_cache_bytes else None
+
+        min_timedelta, max_timedelta = None, None
+        if self.args.log_scale:
+            train = data_partition(self.args.dataset)[0]
+            min_timedelta, max_timedelta = get_delta_range(train)
+        self.time_binner = TimeBinner(self.args.bin_in_hours, self.args.max_bins, self.args.log_scale,
+                                      min_timedelta, max_timedelta)
+
+        train_graph = tf.Graph()
+        with train_graph.as_default():
+            model = build_model(self.args, 0, self.itemnum, 0)
+            with tf.Session(graph=train_graph) as sess:
+                tf.train.Saver().restore(sess, checkpoint)
+                graph_def = tf.graph_util.convert_variables_to_constants(
+                    sess, train_graph.as_graph_def(), [getattr(model, name).op.name for name in self.OUTPUTS])
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, input_map={model.is_training.name: tf.constant(False)}, name='')
+        self.inputs = {}
+        for name in self.INPUTS:
+            # SASRec does not use the time inputs, they are pruned from its graph
+            tensor_name = getattr(model, name).name
+            if tensor_name.split(':')[0] in [op.name for op in self.graph.get_operations()]:
+                self.inputs[name] = self.graph.get_tensor_by_name(tensor_name)
+        self.outputs = [self.graph.get_tensor_by_name(getattr(model, name).name) for name in self.OUTPUTS]
+        # the top-K can also be computed from a fed (cached) state instead of the inputs
+        self.query_emb = self.graph.get_tensor_by_name(model.query_emb.name)
+        self.sess = tf.Session(graph=self.graph)
+
+    def encode(self, items, timestamps=None):
+        '''
+        Returns the right-aligned model inputs (seq, timeseq, hours_seq, days_seq)
+        of the last :maxlen: interactions of a history. Without timestamps the
+        time inputs are left zero.
+        '''
+        seq = np.zeros(self.maxlen, dtype=np.int32)
+        timeseq = np.zeros(self.maxlen, dtype=np.int32)
+        hours_seq = np.zeros(self.maxlen, dtype=np.int32)
+        days_seq = np.zeros(self.maxlen, dtype=np.int32)
+
+        items = np.asarray(items, dtype=np.int64)
+        if len(items) and (items.min() < 1 or items.max() > self.itemnum):
+            raise ValueError('Item ids must be in 1..{}'.format(self.itemnum))
+        items = items[-self.maxlen:]
+        n = len(items)
+        if n == 0:
+            return seq, timeseq, hours_seq, days_seq
+        seq[-n:] = items
+        if timestamps is not None:
+            timestamps = np.asarray(timestamps, dtype=np.int64)[-self.maxlen:]
+            if len(timestamps) != n:
+                raise ValueError('items and timestamps differ in length')
+            # time bins relative to the most recent interaction
+            timeseq[-n:] = self.time_binner(timestamps[-1] - timestamps)
+            hours_seq[-n:] = hour_of_day(timestamps)
+            days_seq[-n:] = day_of_week(timestamps)
+        return seq, timeseq, hours_seq, days_seq
+
+    def history(self, request):
+        '''
+        Returns (items, timestamps, cached) of a request: the items it contains, or
+        the cached history of its user. :cached: is (user, version, state), or None
+        for requests that contain their items.
+        '''
+        if 'items' in request:
+            return request['items'], request.get('timestamps'), None
+        if self.cache is None:
+            raise ValueError('"items" must be a list of item ids')
+        user = str(request['user'])
+        items, timestamps, version, state = self.cache.get(user)
+        return items, timestamps, (user, version, state)
+
+    def recommend(self, requests):
+        '''
+        Answers a batch of requests (dicts as posted to /recommend) and returns a
+        list of (item ids, scores). If no request has a cached state, this is one
+        session run. Otherwise the missing states are computed first, and the
+        top-K of all requests is computed from the states.
+        '''
+        if not requests:
+            return []
+        histories = [self.history(r) for r in requests]
+        ks = [min(int(r.get('k', 10)), self.itemnum) for r in requests]
+
+        exclude = [np.stack([np.full(len(items), row), items], axis=1)
+                   for row, (r, (items, _, _)) in enumerate(zip(requests, histories))
+                   if r.get('exclude_seen', True) and len(items)]
+        exclude = np.concatenate(exclude).astype(np.int32) if exclude else np.zeros([0, 2], dtype=np.int32)
+        top_k_feed = {self.inputs['top_k']: max(ks), self.inputs['exclude_items']: exclude}
+
+        stale = [row for row, (_, _, cached) in enumerate(histories) if cached is None or cached[2] is None]
+        if stale:
+            inputs = [self.encode(histories[row][0], histories[row][1]) for row in stale]
+            seq, timeseq, hours_seq, days_seq = [np.stack(x) for x in zip(*inputs)]
+            feed_dict = {self.inputs[name]: value for name, value in
+                         [('input_seq', seq), ('time_seq', timeseq), ('hours', hours_seq), ('days', days_seq)]
+                         if name in self.inputs}
+
+        if len(stale) == len(requests):
+            feed_dict.update(top_k_feed)
+            states, items, scores = self.sess.run([self.query_emb] + self.outputs, feed_dict)
+        else:
+            states = np.zeros([len(requests), self.query_emb.shape[-1]], dtype=np.float32)
+            for row, (_, _, cached) in enumerate(histories):
+                if cached is not None and cached[2] is not None:
+                    states[row] = cached[2]
+            if stale:
+                states[stale] = self.sess.run(self.query_emb, feed_dict)
+            top_k_feed[self.query_emb] = states
+            items, scores = self.sess.run(self.outputs, top_k_feed)
+
+        for row in stale:
+            if histories[row][2] is not None:
+                user, version, _ = histories[row][2]
+                self.cache.set_state(user, version, states[row])
+        # with fewer than k unseen items, the excluded items come last with the lowest score
+        results = []
+        for row, k in enumerate(ks):
+            keep = scores[row, :k] > np.finfo(scores.dtype).min
+            results.append((items[row, :k][keep].tolist(), scores[row, :k][keep].tolist()))
+        return results
+
+
+class UserStateCache():
+    '''
+    LRU cache of the last :maxlen: interactions of users and of their final
+    encoded state, the last-position representation (model.query_emb).
+
+    This is not an incremental encoder: the per-layer keys and values are not
+    cached, and the first recommendation after new events encodes the whole
+    window through every attention block, at the same O(maxlen^2) cost as a
+    stateless request. They can not be reused, since the positions of the inputs
+    are right-aligned and their time bins relative to the most recent
+    interaction, so a new event changes the inputs at every position. New events
+    only extend the history and invalidate the state: a burst of events costs
+    one forward pass, and recommendations without new events skip the model and
+    only score the catalogue against the cached state.
+
+    The least recently used users are evicted once the cache holds more than
+    :max_bytes:.
+    '''
+
+    # rough size of an entry besides its arrays
+    ENTRY_OVERHEAD = 512
+
+    def __init__(self, maxlen, max_bytes=256 << 20):
+        self.maxlen = maxlen
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def entry_size(entry):
+        return (UserStateCache.ENTRY_OVERHEAD + entry['items'].nbytes +
+                sum(entry[name].nbytes for name in ('timestamps', 'state') if entry[name] is not None))
+
+    def add_events(self, user, items, timestamps=None):
+        '''
+        Appends interactions (oldest first) to the history of :user:.
+        '''
+        items = np.asarray(items, dtype=np.int32)
+        if timestamps is not None:
+            timestamps = np.asarray(timestamps, dtype=np.int64)
+            if len(timestamps) != len(items):
+                raise ValueError('items and timestamps differ in length')
+        user = str(user)
+        with self.lock:
+            entry = self.entries.pop(user, None)
+            if entry is None:
+                entry = {'items': items[:0], 'timestamps': timestamps[:0] if timestamps is not None else None,
+                         'version': 0, 'state': None}
+            else:
+                self.nbytes -= self.entry_size(entry)
+                if (entry['timestamps'] is None) != (timestamps is None):
+                    self.entries[user] = entry
+                    self.nbytes += self.entry_size(entry)
+                    raise ValueError('Send the timestamps of either all or no events of user {}'.format(user))
+
+            # arrays are replaced, never modified, so readers can keep references
+            entry['items'] = np.concatenate([entry['items'], items])[-self.maxlen:]
+            if timestamps is not None:
+                entry['timestamps'] = np.concatenate([entry['timestamps'], timestamps])[-self.maxlen:]
+            entry['version'] += 1
+            entry['state'] = None
+
+            self.entries[user] = entry
+            self.nbytes += self.entry_size(entry)
+            self.evict()
+
+    def evict(self):
+        # called with the lock held; the most recently used user is kept, even if it alone exceeds max_bytes
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= self.entry_size(evicted)
+
+    def get(self, user):
+        '''
+        Returns (items, timestamps, version, state) of :user:, state is None
+        if it has to be recomputed.
+        '''
+        with self.lock:
+            entry = self.entries.get(user)
+            if entry is None:
+                raise ValueError('Unknown user {}, send its events first'.format(user))
+            self.entries.move_to_end(user)
+            return entry['items'], entry['timestamps'], entry['version'], entry['state']
+
+    def set_state(self, user, version, state):
+        '''
+        Stores the state computed from :version: of the history of :user:,
+        unless events arrived in the meantime.
+        '''
+        with self.lock:
+            entry = self.entries.get(user)
+            if entry is None or entry['version'] != version:
+                return
+            self.nbytes -= self.entry_size(entry)
+            entry['state'] = np.array(state, dtype=np.float32)
+            self.nbytes += self.entry_size(entry)
+            self.evict()
+
+
+class MicroBatcher():
+    '''
+    Groups concurrent requests into batches. A worker thread waits for a
+    request, takes along the requests queued in the meantime and those
+    arriving within :max_wait_ms:, and answers up to :max_batch_size:
+    requests with one call to :recommender.recommend:. Under load batches
+    form while the previous batch runs, so no waiting is needed by default.
+    '''
+
+    def __init__(self, recommender, max_batch_size=64, max_wait_ms=0.0):
+        self.recommender = recommender
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, request):
+        '''
+        Blocks until :request: is answered, returns (item ids, scores).
+        '''
+        pending = {'request': request, 'done': threading.Event()}
+        self.requests.put(pending)
+        pending['done'].wait()
+        if 'error' in pending:
+            raise pending['error']
+        return pending['result']
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.time() + self.max_wait
+            # requests queued while the previous batch ran are always taken along
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self.requests.get(timeout=max(deadline - time.time(), 0)))
+                except queue.Empty:
+                    break
+
+            try:
+                results = self.recommender.recommend([pending['request'] for pending in batch])
+                for pending, result in zip(batch, results):
+                    pending['result'] = result
+            except Exception:
+                # answer the requests one by one, so that one invalid request does not fail the batch
+                for pending in batch:
+                    try:
+                        pending['result'] = self.recommender.recommend([pending['request']])[0]
+                    except Exception as e:
+                        pending['error'] = e
+            for pending in batch:
+                pending['done'].set()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    # keep connections open between requests, and send responses right away
+    # instead of waiting for the client to acknowledge the headers (Nagle)
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path not in ('/recommend', '/events'):
+            self.send_json(404, {'error': 'not found'})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            if self.path == '/events':
+                if self.server.batcher.recommender.cache is None:
+                    raise ValueError('the user state cache is disabled')
+                if not isinstance(request.get('items'), list) or 'user' not in request:
+                    raise ValueError('events need a "user" and a list of "items"')
+                self.server.batcher.recommender.encode(request['items'])  # validates the item ids
+                self.server.batcher.recommender.cache.add_events(request['user'], request['items'],
+                                                                 request.get('timestamps'))
+                self.send_json(200, {'user': request['user'], 'events': len(request['items'])})
+                return
+            if not isinstance(request.get('items'), list) and 'user' not in request:
+                raise ValueError('"items" must be a list of item ids')
+            items, scores = self.server.batcher.submit(request)
+        except (ValueError, TypeError, KeyError) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+            return
+        self.send_json(200, {'items': items, 'scores': scores})
+
+    def send_json(self, status, body):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixRequestHandler(RequestHandler):
+    # TCP_NODELAY does not apply to Unix sockets
+    disable_nagle_algorithm = False
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return 'unix'
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(batcher, host='127.0.0.1', port=8080, unix_socket=None):
+    '''
+    Returns an HTTP server answering requests with :batcher:, on :unix_socket:
+    if given, on :host:::port: otherwise.
+    '''
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = ThreadingUnixHTTPServer(unix_socket, UnixRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.batcher = batcher
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve recommendations of a trained model')
+    parser.add_argument('--train_dir', required=True,
+                        help='Training run directory (saved_models/<dataset>/<run>) with params.txt')
+    parser.add_argument('--checkpoint', default=None, help='Checkpoint prefix, the latest one by default')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=8080, type=int)
+    parser.add_argument('--unix_socket', default=None, help='Listen on this Unix socket instead of a TCP port')
+    parser.add_argument('--max_batch_size', default=64, type=int,
+                        help='Maximum number of requests answered by one session run')
+    parser.add_argument('--max_wait_ms', default=0.0, type=float,
+                        help='Time to wait for more requests before running a batch')
+    parser.add_argument('--state_cache_mb', default=256, type=int,
+                        help='Memory budget of the cached user histories and states (0 disables /events)')
+    args = parser.parse_args()
+
+    if not os.path.exists(os.path.join(args.train_dir, 'params.txt')):
+        print('{} has no params.txt'.format(args.train_dir))
+        sys.exit(1)
+
+    recommender = Recommender(args.train_dir, args.checkpoint, args.state_cache_mb << 20)
+    batcher = MicroBatcher(recommender, args.max_batch_size, args.max_wait_ms)
+    server = make_server(batcher, args.host, args.port, args.unix_socket)
+    print('serving {} ({} items) on {}'.format(recommender.args.model, recommender.itemnum,
+                                               args.unix_socket or '{}:{}'.format(args.host, args.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -1,7 +1,40 @@
+import os
+import gzip
+import json
+import time
+import threading
+import pickle
+import argparse
+import tempfile
 import unittest
+from datetime import datetime, timezone
+
+import numpy as np
+import tensorflow as tf
 
 from preprocess import main as preprocess
+import dataset
+import data_reader
+import data_registry
+import ann
 import util
+import main
+import modules
+import serve
+import run_experiments
+from sampler import BatchSampler, batch_sampler
+from negatives import NegativeSampler
+from quantiles import QuantileSketch
+
+TOY_DATASET = ('1 3 5.0 978300019\n1 1 4.0 978300760\n1 2 3.0 978301968\n'
+               '1 4 5.0 978302109\n2 2 2.0 978298413\n')
+
+
+def write_toy_dataset(d):
+    dataset_path = os.path.join(d, 'toy.txt')
+    with open(dataset_path, 'w') as f:
+        f.write(TOY_DATASET)
+    return dataset_path
 
 
 class CAST(unittest.TestCase):
@@ -20,6 +53,92 @@ class CAST(unittest.TestCase):
                 self.assertEqual(timestamp, 978300019)
                 break
 
+    def test_preprocess_amazon(self):
+        """
+        Test the Amazon review pre-processing on JSON and Python-literal lines
+        """
+        reviews = []
+        for i in range(5):
+            for user, asin in (('A', 'p1'), ('B', 'p2'), ('A', 'p2'), ('B', 'p1')):
+                reviews.append({'reviewerID': user, 'asin': asin, 'overall': 5.0,
+                                'unixReviewTime': 1000 - i, 'reviewText': "it's \"fine\""})
+        reviews.append({'reviewerID': 'C', 'asin': 'p3', 'overall': 1.0, 'unixReviewTime': 5})
+        with tempfile.TemporaryDirectory() as d:
+            raw_path = os.path.join(d, 'reviews.json.gz')
+            with gzip.open(raw_path, 'wb') as g:
+                for i, r in enumerate(reviews):
+                    g.write(((json.dumps(r) if i % 2 else repr(r)) + '\n').encode())
+            out_path = os.path.join(d, 'Books.txt')
+            preprocess(raw_path, out_path, 'amazon', limit=None, workers=2)
+
+            with open(out_path, 'r') as f:
+                lines = f.read().splitlines()
+            # user C and item p3 are dropped, users are sorted on time
+            self.assertEqual(len(lines), 20)
+            self.assertEqual(lines[:3], ['1 1 5.0 996', '1 2 5.0 996', '1 1 5.0 997'])
+            with open(out_path + '_product_map.txt', 'r') as f:
+                self.assertEqual(f.read(), 'p1 1\np2 2\n')
+
+    def test_k_core(self):
+        """
+        Test whether filtering is repeated until every user and item has k interactions
+        """
+        # removing user 2 drops item 2 below k, which in turn drops user 3
+        users = np.array([0, 0, 1, 1, 2, 3, 3])
+        items = np.array([0, 1, 0, 1, 2, 2, 0])
+        keep = data_reader.k_core(users, items, k=2)
+        self.assertEqual(list(np.flatnonzero(keep)), [0, 1, 2, 3])
+
+        rows, users, items, item_codes = data_reader.k_core_sequences(
+            np.array([5, 3, 5, 3]), np.array([7, 7, 8, 8]), np.array([2, 1, 1, 1]), k=1)
+        # ids in order of first appearance, rows sorted on (user, time)
+        self.assertEqual(list(rows), [2, 0, 1, 3])
+        self.assertEqual(list(users), [1, 1, 2, 2])
+        self.assertEqual(list(items), [2, 1, 1, 2])
+        self.assertEqual(list(item_codes), [7, 8])
+
+    def test_spilled_interactions(self):
+        """
+        Test whether the out-of-core k-core and merge sort match the in-memory path
+        """
+        rng = np.random.RandomState(0)
+        users, items = rng.randint(0, 40, 500), rng.exponential(8, 500).astype(np.int64)
+        ratings, times = rng.randint(0, 5, 500), rng.randint(0, 10, 500)
+        # the 8-core needs several rounds of filtering (385 of 500 interactions are kept)
+        rows, out_users, out_items, item_codes = data_reader.k_core_sequences(users, items, times, k=8)
+
+        with tempfile.TemporaryDirectory() as d:
+            chunks = [(users[i:i + 50], items[i:i + 50], ratings[i:i + 50], times[i:i + 50]) for i in range(0, 500, 50)]
+            spilled = data_reader.SpilledInteractions(chunks, d, chunk_rows=120)
+            self.assertEqual(spilled.num_chunks, 4)
+            spilled.k_core(k=8)
+            self.assertEqual(list(spilled.sort()), list(item_codes))
+            merged = list(spilled.merge())
+        self.assertEqual(merged, list(zip(out_users, out_items, ratings[rows], times[rows])))
+
+    def test_data_registry(self):
+        """
+        Test whether registered datasets are pre-processed once and again when a source changes
+        """
+        with tempfile.TemporaryDirectory() as d:
+            raw_path = os.path.join(d, 'ratings.csv')
+            with open(raw_path, 'w') as f:
+                for u in range(1, 4):
+                    for i in range(1, 6):
+                        f.write('U{},B{},5.0,{}\n'.format(u, i, 1000 + i))
+            data_registry.register(data_registry.DatasetSource('test', 'amazon_ratings', raw_path, os.path.join(d, 'test.txt')))
+            try:
+                run = lambda: data_registry.preprocess_datasets(['test'], min_count=3)[0][1]
+                self.assertEqual(run(), 'done')
+                self.assertEqual(run(), 'up to date')
+                with open(raw_path, 'a') as f:
+                    f.write('U1,B1,1.0,2000\n')
+                self.assertEqual(run(), 'done')
+                with open(os.path.join(d, 'test.txt'), 'r') as f:
+                    self.assertEqual(len(f.readlines()), 16)
+            finally:
+                del data_registry.REGISTRY['test']
+
     def test_data_partition(self):
         dataset_path = 'data/ml-1m.txt'
 
@@ -51,10 +170,511 @@ class CAST(unittest.TestCase):
 
         # Test delta_time
         User = util.add_time_bin(User, log_scale=True)
-        self.assertEqual(User[1][0].time_bin, 147)
+        User_bins = util.add_time_bin(User, log_scale=True)
+        self.assertEqual(User_bins[1].time_bin[0], 147)
+
+        User_bins = util.add_time_bin(User, log_scale=False)
+        self.assertEqual(User_bins[1].time_bin[0], 3)
+
+    def test_quantile_sketch(self):
+        """
+        Test whether the quantile sketch is exact on small data, close on large data and precomputed per dataset
+        """
+        values = np.random.RandomState(0).lognormal(10, 2, size=100000).astype(np.int64)
+        q = [0, 10, 50, 90, 100]
+        for exact_limit in [10 ** 6, 1000]:
+            sketch = QuantileSketch(exact_limit=exact_limit, capacity=2048)
+            for chunk in np.array_split(values, 7):
+                sketch.update(chunk)
+            self.assertEqual(sketch.exact, exact_limit > len(values))
+            percentiles = sketch.percentiles(q)
+            if sketch.exact:
+                self.assertEqual(percentiles.tolist(), np.percentile(values, q).tolist())
+            else:
+                ranks = np.searchsorted(np.sort(values), percentiles) / len(values)
+                self.assertLess(np.abs(ranks - np.array(q) / 100).max(), 0.01)
+                self.assertEqual((percentiles[0], percentiles[-1]), (values.min(), values.max()))
+
+        with tempfile.TemporaryDirectory() as d:
+            train = util.data_partition(write_toy_dataset(d))[0]
+            self.assertIsNotNone(train.timedelta_percentiles)
+            computed = util.get_delta_range(dataset.UserHistory(train.columns, train.starts, train.ends), 90)
+            self.assertEqual(util.get_delta_range(train), computed)
+            # train deltas are 741 and 0 for user 1 and 0 for user 2
+            self.assertEqual(util.get_delta_range(train, 100), (0.0, 741.0))
+            self.assertEqual(util.get_delta_range(train, 50), (0.0, 0.0))
+
+    def test_time_binner(self):
+        """
+        Test whether the array time bins match get_timedelta_bin on both scales
+        """
+        deltas = np.array([[0, 1, 3599, 3600, 172799], [172800, 10 ** 6, 58896613, 10 ** 9, 7]])
+        for log_scale, bin_in_hours, max_bins in [(False, 48, 200), (False, 1.5, 10), (True, 48, 200), (True, 48, 50)]:
+            time_binner = util.TimeBinner(bin_in_hours, max_bins, log_scale, 0, 58896613)
+            expected = [[util.get_timedelta_bin(float(t), bin_in_hours, max_bins, log_scale, 0, 58896613) for t in row]
+                        for row in deltas]
+            self.assertEqual(time_binner(deltas).tolist(), expected)
+
+    def test_dataset_cache(self):
+        """
+        Test whether the compiled dataset matches the text file and is rebuilt when the file changes
+        """
+        with tempfile.TemporaryDirectory() as d:
+            dataset_path = write_toy_dataset(d)
+            [train, valid, test, usernum, itemnum, ratingnum] = util.data_partition(dataset_path)
+            self.assertEqual((usernum, itemnum, ratingnum), (2, 4, 5.0))
+            self.assertEqual(list(train[1].item), [3, 1])
+            self.assertEqual(list(valid[1].item), [2])
+            self.assertEqual(list(test[1].item), [4])
+            self.assertEqual(list(train[2].item), [2])
+            self.assertEqual((len(valid[2]), len(test[2])), (0, 0))
+
+            # hour and day match the datetime based TimeStamp conversion
+            for t, hour, day in zip(train[1].timestamp, train[1].hour, train[1].day):
+                date = datetime.fromtimestamp(int(t), timezone.utc)
+                self.assertEqual(hour, date.hour + 1)
+                self.assertEqual(day, date.isoweekday())
+
+            # memory-mapped histories are pickled by reference
+            rows, users = train.rows()
+            self.assertEqual(list(users), [1, 1, 2])
+            self.assertEqual(list(train.columns['item'][rows]), [3, 1, 2])
+            copied = pickle.loads(pickle.dumps(train))
+            self.assertIsInstance(copied.columns['item'], np.memmap)
+            self.assertEqual(list(copied[1].item), [3, 1])
+
+            self.assertFalse(dataset.is_stale(dataset_path))
+            time.sleep(0.01)
+            with open(dataset_path, 'a') as f:
+                f.write('3 1 1.0 978302109\n')
+            self.assertTrue(dataset.is_stale(dataset_path))
+            [train, _, _, usernum, _, _] = util.data_partition(dataset_path)
+            self.assertEqual(usernum, 3)
+            self.assertEqual(list(train[3].item), [1])
+
+    def test_batch_sampler(self):
+        """
+        Test whether sampled batches are right-aligned and shifted by one between seq and pos
+        """
+        with tempfile.TemporaryDirectory() as d:
+            [train, _, _, usernum, itemnum, _] = util.data_partition(write_toy_dataset(d))
+            sampler = BatchSampler(train, usernum, itemnum, maxlen=3, bin_in_hours=1, max_bins=200,
+                                   log_scale=False, min_timedelta=0, max_timedelta=0)
+            u, seq, pos, neg, timeseq, ratings_seq, hours_seq, days_seq = sampler.sample(4)
+
+            # user 2 has a single training interaction, so only user 1 can be sampled
+            self.assertEqual(list(u), [1, 1, 1, 1])
+            self.assertEqual(list(seq[0]), [0, 0, 3])
+            self.assertEqual(list(pos[0]), [0, 0, 1])
+            self.assertEqual(list(ratings_seq[0]), [0, 0, 5])
+            self.assertEqual(list(timeseq[0]), [0, 0, 0])
+            self.assertTrue(((neg == 0) | (neg == 2) | (neg == 4)).all())
+            self.assertTrue((neg[:, -1] > 0).all())
+            self.assertEqual(seq.dtype, np.int32)
+
+    def test_train_inputs(self):
+        """
+        Test whether the tf.data pipeline yields the batches of the sampler, in order and reproducibly
+        """
+        rng = np.random.RandomState(0)
+        with tempfile.TemporaryDirectory() as d:
+            dataset_path = os.path.join(d, 'random.txt')
+            with open(dataset_path, 'w') as f:
+                for u in range(1, 21):
+                    for t in np.sort(rng.randint(0, 10 ** 7, size=rng.randint(2, 12))):
+                        f.write('{} {} 5.0 {}\n'.format(u, rng.randint(1, 30), t))
+            [train, _, _, usernum, itemnum, _] = util.data_partition(dataset_path)
+            args = main.build_parser().parse_args(['--dataset', dataset_path, '--train_dir', 'toy', '--model', 'cast_1',
+                                                   '--maxlen', '6'])
+            sampler = batch_sampler(args, train, usernum, itemnum)
+            with tf.Graph().as_default():
+                inputs = main.train_inputs(sampler, 8, seed=3)
+                with tf.Session() as sess:
+                    batches = [sess.run([inputs[name] for name in main.TRAIN_INPUTS]) for _ in range(5)]
+        for i, batch in enumerate(batches):
+            expected = sampler.sample(8, np.random.RandomState([3, i]))
+            self.assertEqual([x.tolist() for x in batch], [x.tolist() for x in expected])
+        self.assertEqual(batches[1][1].shape, (8, 6))
+
+    def test_time_bin_tables(self):
+        """
+        Test whether gathering from the stored time bin tables matches binning the time deltas
+        """
+        rng = np.random.RandomState(0)
+        with tempfile.TemporaryDirectory() as d:
+            dataset_path = os.path.join(d, 'random.txt')
+            with open(dataset_path, 'w') as f:
+                for u in range(1, 21):
+                    times = np.sort(rng.randint(0, 10 ** 7, size=rng.randint(1, 12)))
+                    for t in times:
+                        f.write('{} {} 5.0 {}\n'.format(u, rng.randint(1, 30), t))
+            data = util.data_partition(dataset_path)
+            train = data[0]
+            # the padded positions must not be binned (log of negative deltas)
+            with np.errstate(invalid='raise'):
+                for log_scale in [False, True]:
+                    min_timedelta, max_timedelta = util.get_delta_range(train) if log_scale else (0, 0)
+                    tables = util.get_time_bin_tables(dataset_path, data, 6, 50, log_scale)
+                    self.assertIsInstance(tables['train'], np.memmap)
+
+                    np.random.seed(1)
+                    expected = BatchSampler(train, data[3], data[4], 5, 6, 50, log_scale, min_timedelta,
+                                            max_timedelta).sample(64)[4]
+                    np.random.seed(1)
+                    gathered = BatchSampler(train.with_column('input_time_bin', tables['train']), data[3], data[4], 5, 6,
+                                            50, log_scale, min_timedelta, max_timedelta).sample(64)[4]
+                    self.assertEqual(gathered.tolist(), expected.tolist())
+
+                    for split in ['valid', 'test']:
+                        expected = util.build_eval_inputs(data, split, 5, 6, 50, log_scale, 42)
+                        gathered = util.build_eval_inputs(data, split, 5, 6, 50, log_scale, 42, tables[split])
+                        self.assertEqual(gathered.timeseq.tolist(), expected.timeseq.tolist())
+            self.assertEqual(len([f for f in os.listdir(dataset.cache_path(dataset_path))
+                                  if f.startswith('time_bins_')]), 2)
+
+    def test_negative_sampler(self):
+        """
+        Test whether negatives never contain items of the user's history, for both distributions
+        """
+        with tempfile.TemporaryDirectory() as d:
+            [train, _, _, _, itemnum, _] = util.data_partition(write_toy_dataset(d))
+            users = np.array([1, 2, 1])
+            for distribution in ['uniform', 'popularity']:
+                negatives = NegativeSampler(train, itemnum, distribution).sample(users, 50)
+                self.assertEqual(negatives.shape, (3, 50))
+                for row, u in zip(negatives, users):
+                    self.assertFalse(set(row.tolist()) & set(train[u].item.tolist()))
+                    self.assertTrue(((row >= 1) & (row <= itemnum)).all())
+
+    def test_negative_sampler_exhausted(self):
+        """
+        Test whether users that have seen every item raise instead of getting seen items (or no result)
+        """
+        with tempfile.TemporaryDirectory() as d:
+            dataset_path = os.path.join(d, 'seen_all.txt')
+            with open(dataset_path, 'w') as f:
+                # user 1 trains on all 3 items, user 2 on item 1 only
+                for u, items in [(1, [1, 2, 3, 1, 2]), (2, [1, 2, 3])]:
+                    for t, i in enumerate(items):
+                        f.write('{} {} 5.0 {}\n'.format(u, i, 978300000 + t))
+            [train, _, _, _, itemnum, _] = util.data_partition(dataset_path)
+            for distribution in ['uniform', 'popularity']:
+                sampler = NegativeSampler(train, itemnum, distribution)
+                self.assertFalse(set(sampler.sample(np.array([2]), 20).tolist()[0]) & {1})
+                with self.assertRaises(ValueError):
+                    sampler.sample(np.array([2, 1]), 20)
+
+    def test_eval_inputs(self):
+        """
+        Test whether the evaluation inputs are right-aligned, fixed across calls and cached on disk
+        """
+        with tempfile.TemporaryDirectory() as d:
+            dataset_path = write_toy_dataset(d)
+            data = util.data_partition(dataset_path)
+            args = argparse.Namespace(dataset=dataset_path, maxlen=3, bin_in_hours=1, max_bins=200,
+                                      log_scale=False, seed=42, eval_cache=True)
+
+            inputs = util.get_eval_inputs(data, args, 'test')
+            # only user 1 has valid/test items; the valid item is the most recent test input
+            self.assertEqual(list(inputs.users), [1])
+            self.assertEqual(list(inputs.seq[0]), [3, 1, 2])
+            self.assertEqual(inputs.candidates.shape, (1, 101))
+            self.assertEqual(inputs.candidates[0, 0], 4)
+            self.assertTrue(np.isin(inputs.candidates[0, 1:], [2, 4]).all())
+            self.assertIs(util.get_eval_inputs(data, args, 'test'), inputs)
+
+            valid_inputs = util.get_eval_inputs(data, args, 'valid')
+            self.assertEqual(list(valid_inputs.seq[0]), [0, 3, 1])
+            self.assertEqual(valid_inputs.candidates[0, 0], 2)
+
+            util._eval_inputs.clear()
+            self.assertEqual(len([f for f in os.listdir(dataset.cache_path(dataset_path)) if f.startswith('eval_')]), 2)
+            reloaded = util.get_eval_inputs(data, args, 'test')
+            self.assertEqual(reloaded.candidates.tolist(), inputs.candidates.tolist())
+
+            _, seq, _, _, _, _, exclude = next(reloaded.batches(1, test_seq_len=1))
+            self.assertEqual(list(seq[0]), [0, 0, 2])
+            # the train items of user 1 are excluded from the full ranking
+            self.assertEqual(exclude.tolist(), [[0, 1], [0, 3]])
+            self.assertEqual(list(reloaded.seq[0]), [3, 1, 2])
+
+    def test_ann_index(self):
+        """
+        Test whether the IVF index is exact when probing all clusters and survives a save/load
+        """
+        rng = np.random.RandomState(0)
+        item_emb = rng.randn(501, 8).astype(np.float32)
+        queries = rng.randn(20, 8).astype(np.float32)
+        index = ann.IVFIndex.build(item_emb, nlist=10)
+        self.assertEqual(len(index), 500)
+        self.assertEqual(sorted(index.item_ids.tolist()), list(range(1, 501)))
+
+        exact_ids, exact_scores = ann.exact_top_k(item_emb, queries, k=5)
+        ids, scores = index.search(queries, k=5, nprobe=10)
+        self.assertEqual(ids.tolist(), exact_ids.tolist())
+        self.assertTrue(np.allclose(scores, exact_scores, atol=1e-5))
+
+        with tempfile.TemporaryDirectory() as d:
+            index.save(os.path.join(d, 'index.npz'))
+            loaded = ann.IVFIndex.load(os.path.join(d, 'index.npz'))
+            self.assertEqual(loaded.search(queries, k=5, nprobe=2)[0].tolist(),
+                             index.search(queries, k=5, nprobe=2)[0].tolist())
+
+    def test_retrieval_layer(self):
+        """
+        Test whether the full-catalogue top-K matches a brute-force ranking without the excluded items
+        """
+        rng = np.random.RandomState(0)
+        item_emb = rng.randn(30, 8).astype(np.float32)
+        seq = rng.randn(4, 3, 8).astype(np.float32)
+        # (batch row, item) pairs, with a duplicate and a row without exclusions
+        exclude = np.array([[0, 5], [0, 7], [0, 5], [2, 1], [3, 29]], dtype=np.int32)
+
+        logits = seq[:, -1].dot(item_emb.T)
+        logits[:, 0] = -np.inf
+        logits[exclude[:, 0], exclude[:, 1]] = -np.inf
+        expected_items = np.argsort(-logits, axis=1, kind='stable')[:, :5]
 
-        User = util.add_time_bin(User, log_scale=False)
-        self.assertEqual(User[1][0].time_bin, 3)
+        with tf.Graph().as_default():
+            model = argparse.Namespace()
+            modules.retrieval_layer(model, tf.constant(item_emb), tf.constant(seq))
+            with tf.Session() as sess:
+                items, scores = sess.run([model.top_k_items, model.top_k_scores],
+                                         {model.top_k: 5, model.exclude_items: exclude})
+                all_items = sess.run(model.top_k_items, {model.top_k: 29})
+        self.assertEqual(items.tolist(), expected_items.tolist())
+        self.assertTrue(np.allclose(scores, np.take_along_axis(logits, expected_items, axis=1), atol=1e-5))
+        # without exclusions every item but the padding item 0 is ranked
+        self.assertEqual(sorted(all_items[1].tolist()), list(range(1, 30)))
+
+    def test_local_attention(self):
+        """
+        Test the blocked causal attention against a NumPy reference and against full attention for a long window
+        """
+        rng = np.random.RandomState(0)
+        num_heads, N, T, d = 2, 3, 11, 4
+        Q, K, V = [rng.randn(num_heads * N, T, d).astype(np.float32) for _ in range(3)]
+        # left padding of 0, 4 and 10 positions
+        masks = (np.arange(T)[None, :] >= np.array([[0], [4], [10]])).astype(np.float32)
+
+        def reference(block_size):
+            # query t sees the keys j <= t of its block and of the previous one (blocks start after the front padding)
+            pad = -T % block_size
+            outputs = np.zeros_like(Q)
+            for i in range(num_heads * N):
+                for t in np.flatnonzero(masks[i % N]):
+                    start = max((t + pad) // block_size * block_size - block_size - pad, 0)
+                    keys = [j for j in range(start, t + 1) if masks[i % N, j]]
+                    logits = Q[i, t].dot(K[i, keys].T) / d ** 0.5
+                    weights = np.exp(logits - logits.max())
+                    outputs[i, t] = (weights / weights.sum()).dot(V[i, keys])
+            return outputs
+
+        def attention(mode, block_size):
+            with tf.Graph().as_default():
+                model = argparse.Namespace(attention_mode=mode, attention_window=block_size)
+                outputs, weights = modules.split_heads_attention(
+                    model, tf.constant(Q), tf.constant(K), tf.constant(V), tf.constant(masks), tf.constant(masks),
+                    num_heads, causality=True, is_training=False)
+                with tf.Session() as sess:
+                    return sess.run([outputs, weights])
+
+        for block_size in [1, 3, 4, 11]:
+            outputs, weights = attention('local', block_size)
+            self.assertEqual(weights.shape, (num_heads * N, T, 2 * block_size))
+            self.assertTrue(np.allclose(outputs, reference(block_size), atol=1e-5))
+        # a window at least as long as the sequence is full causal attention
+        for block_size in [11, 16]:
+            self.assertTrue(np.allclose(attention('local', block_size)[0], attention('full', None)[0], atol=1e-5))
+
+    def test_batched_context_towers(self):
+        """
+        Test whether the batched context towers have the variables of the separate towers and restore their checkpoints
+        """
+        rng = np.random.RandomState(0)
+        seq = rng.randint(1, 31, (4, 12))
+        seq[:, :5] = 0
+        context = lambda high: np.where(seq > 0, rng.randint(1, high, seq.shape), 0)
+        batch = [np.arange(4), seq, np.roll(seq, -1, axis=1), context(31), context(50), context(25), context(8)]
+
+        def run(model_name, batched, checkpoint, save):
+            args = main.build_parser().parse_args(
+                ['--dataset', 'toy.txt', '--train_dir', 'toy', '--model', model_name, '--maxlen', '12',
+                 '--hidden_units', '8', '--batched_context_towers={}'.format(batched)])
+            with tf.Graph().as_default():
+                tf.set_random_seed(0)
+                model = main.build_model(args, 5, 30, 5)
+                saver = tf.train.Saver()
+                placeholders = [model.u, model.input_seq, model.pos, model.neg, model.time_seq, model.hours, model.days]
+                with tf.Session() as sess:
+                    if save:
+                        sess.run(tf.global_variables_initializer())
+                        saver.save(sess, checkpoint)
+                    else:
+                        saver.restore(sess, checkpoint)
+                    feed_dict = dict(zip(placeholders, batch))
+                    feed_dict[model.is_training] = False
+                    variables = sorted((v.name, v.shape.as_list()) for v in tf.global_variables())
+                    return variables, sess.run(model.loss, feed_dict)
+
+        with tempfile.TemporaryDirectory() as d:
+            for model_name in ['cast_8', 'cast_9']:
+                # checkpoints of either mode restore into the other
+                for batched in [False, True]:
+                    checkpoint = os.path.join(d, '{}_{}'.format(model_name, batched))
+                    variables, loss = run(model_name, batched, checkpoint, save=True)
+                    restored_variables, restored_loss = run(model_name, not batched, checkpoint, save=False)
+                    self.assertEqual(restored_variables, variables)
+                    self.assertAlmostEqual(restored_loss, loss, places=5)
+
+    def test_recommender(self):
+        """
+        Test whether the frozen graph of a run recommends as the model does, without the seen items
+        """
+        args = main.build_parser().parse_args(['--dataset', 'toy.txt', '--train_dir', 'toy', '--model', 'cast_1',
+                                               '--maxlen', '5', '--hidden_units', '8'])
+        history = {'items': [1, 2, 3], 'timestamps': [978300019, 978300760, 978301968]}
+        with tempfile.TemporaryDirectory() as d:
+            with open(os.path.join(d, 'params.txt'), 'w') as f:
+                json.dump(vars(args), f)
+            with tf.Graph().as_default():
+                model = main.build_model(args, 5, 6, 5)
+                with tf.Session() as sess:
+                    sess.run(tf.global_variables_initializer())
+                    tf.train.Saver().save(sess, os.path.join(d, 'model.ckpt'))
+
+                    recommender = serve.Recommender(d)
+                    seq, timeseq, hours_seq, days_seq = [x[None] for x in recommender.encode(**history)]
+                    expected_items, expected_scores = model.recommend(sess, np.zeros(1), seq, 4, timeseq,
+                                                                      hours_seq, days_seq)
+
+            self.assertEqual(recommender.recommend([]), [])
+            items, scores = recommender.recommend([dict(history, k=4, exclude_seen=False)])[0]
+            self.assertEqual(items, expected_items[0].tolist())
+            self.assertTrue(np.allclose(scores, expected_scores[0], atol=1e-5))
+            # only 3 of the 6 items are unseen
+            items, scores = recommender.recommend([dict(history, k=10)])[0]
+            self.assertEqual(sorted(items), [4, 5, 6])
+            self.assertEqual(len(scores), 3)
+
+    def test_micro_batcher(self):
+        """
+        Test whether concurrent requests are answered in batches of at most max_batch_size, each with its own result
+        """
+        class StubRecommender():
+            def __init__(self):
+                self.batch_sizes = []
+
+            def recommend(self, requests):
+                self.batch_sizes.append(len(requests))
+                time.sleep(0.005)
+                if any(request['id'] < 0 for request in requests):
+                    raise ValueError('invalid request')
+                return [([request['id']], [float(request['id'])]) for request in requests]
+
+        recommender = StubRecommender()
+        batcher = serve.MicroBatcher(recommender, max_batch_size=4, max_wait_ms=5)
+        results, errors = {}, {}
+
+        def submit(i):
+            try:
+                results[i] = batcher.submit({'id': i})
+            except ValueError as e:
+                errors[i] = e
+
+        threads = [threading.Thread(target=submit, args=(i,)) for i in list(range(30)) + [-1]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, {i: ([i], [float(i)]) for i in range(30)})
+        # the invalid request fails alone, the rest of its batch is answered one by one
+        self.assertEqual(list(errors), [-1])
+        self.assertLessEqual(max(recommender.batch_sizes), 4)
+        self.assertGreater(max(recommender.batch_sizes), 1)
+
+    def test_user_state_cache(self):
+        """
+        Test the LRU eviction, the size accounting and the invalidation of the user state cache
+        """
+        cache = serve.UserStateCache(maxlen=3, max_bytes=3 * (serve.UserStateCache.ENTRY_OVERHEAD + 12))
+        total_size = lambda: sum(cache.entry_size(entry) for entry in cache.entries.values())
+        for user in ['a', 'b', 'c']:
+            cache.add_events(user, [1, 2, 3, 4])
+        self.assertEqual(cache.get('a')[0].tolist(), [2, 3, 4])
+        self.assertEqual(cache.nbytes, total_size())
+
+        # 'a' was used last, so 'b' is evicted first
+        cache.add_events('d', [5])
+        self.assertEqual(list(cache.entries), ['c', 'a', 'd'])
+        self.assertEqual(cache.nbytes, total_size())
+        with self.assertRaises(ValueError):
+            cache.get('b')
+
+        # a state computed before new events arrived is not stored
+        _, _, version, state = cache.get('a')
+        self.assertIsNone(state)
+        cache.add_events('a', [6])
+        cache.set_state('a', version, np.ones(4))
+        self.assertIsNone(cache.get('a')[3])
+        _, _, version, _ = cache.get('a')
+        cache.set_state('a', version, np.ones(4))
+        self.assertEqual(cache.get('a')[3].tolist(), [1, 1, 1, 1])
+        # the state is counted and evicts the least recently used user
+        self.assertEqual(list(cache.entries), ['d', 'a'])
+        self.assertEqual(cache.nbytes, total_size())
+        # new events invalidate the state
+        cache.add_events('a', [7])
+        self.assertEqual(cache.get('a')[0].tolist(), [4, 6, 7])
+        self.assertIsNone(cache.get('a')[3])
+        self.assertEqual(cache.nbytes, total_size())
+
+    def test_experiment_args(self):
+        """
+        Test whether the runs of run_experiments.py combine the shared arguments with their own
+        """
+        train_args = ['--dataset', 'data/toy.txt', '--maxlen', '200', '--dropout_rate', '0.2']
+        name, args = run_experiments.experiment_args(train_args, {'model': 'cast_1'})
+        self.assertEqual((name, args.model, args.train_dir, args.maxlen), ('cast_1', 'cast_1', 'cast_1', 200))
+
+        config = {'name': 'cast_9_batched', 'model': 'cast_9', 'batched_context_towers': True, 'dropout_rate': 0.5}
+        name, args = run_experiments.experiment_args(train_args, config)
+        self.assertEqual((name, args.train_dir), ('cast_9_batched', 'cast_9_batched'))
+        self.assertEqual((args.batched_context_towers, args.dropout_rate, args.maxlen), (True, 0.5, 200))
+        self.assertEqual(run_experiments.experiment_args(train_args, dict(config, train_dir='run'))[1].train_dir, 'run')
+        # the config of the caller is left as it is
+        self.assertEqual(sorted(config), ['batched_context_towers', 'dropout_rate', 'model', 'name'])
+
+        with self.assertRaises(ValueError):
+            run_experiments.experiment_args(train_args, {'model': 'cast_1', 'dropout': 0.2})
+
+    def test_format_results(self):
+        """
+        Test whether failed runs are reported in the results table without metrics
+        """
+        rows = [{'name': 'cast_1', 'status': 'done', 'epochs': 20, 'train_time': 12.34, 'wall_time': 15.0,
+                 'valid': (0.51234, 0.75), 'test': (0.5, 0.7)},
+                {'name': 'cast_x', 'status': 'failed: Unknown model cast_x', 'epochs': 0, 'train_time': 0.0,
+                 'wall_time': 0.1, 'valid': None, 'test': None}]
+        lines = run_experiments.format_results(rows).splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[1].split(), ['cast_1', '0.5123', '0.7500', '0.5000', '0.7000', '20', '12.3', '15.0', 'done'])
+        self.assertEqual(lines[2].split(), ['cast_x', '-', '-', '-', '-', '0', '0.0', '0.1', 'failed:', 'Unknown',
+                                            'model', 'cast_x'])
+
+    def test_params_replay(self):
+        """
+        Test whether the params.txt of a run replays as --key=value arguments (as test_model.py does)
+        """
+        parser = main.build_parser()
+        for flags in [[], ['--eval_cache', '--time_bin_cache', '--batched_context_towers', '--log_scale']]:
+            args = parser.parse_args(['--dataset', 'data/toy.txt', '--train_dir', 'toy', '--model', 'cast_9'] + flags)
+            params = json.loads(json.dumps(vars(args)))
+            replayed = parser.parse_args(['--{}={}'.format(k, v) for k, v in params.items()
+                                          if k not in ['test_model', 'test_seq_len']])
+            self.assertEqual(vars(replayed), vars(args))
+        self.assertFalse(parser.parse_args(['--dataset', 'd', '--train_dir', 't', '--model', 'cast_1',
+                                            '--log_scale', 'False']).log_scale)
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
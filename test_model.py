@@ -16,6 +16,8 @@ for p in ['saved_models/ml-1m.txt/sasrec_baseline_10-19-2019-21-23-42']:
         cmd = ['python3', 'main.py']
 
         for k, v in params.items():
+            if k in ['test_model', 'test_seq_len', 'limit', 'test_baseline']:
+                continue
             cmd.append('--{}={}'.format(k,v))
 
         cmd.append('--test_model={}'.format(p))
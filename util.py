@@ -1,6 +1,8 @@
 import sys
 import os
-import copy
+import json
+import shutil
+import hashlib
 import random
 import numpy as np
 import math
@@ -8,41 +10,12 @@ from tqdm import tqdm
 from collections import defaultdict
 from datetime import datetime, timezone, timedelta
 
+from dataset import load_dataset, partition, cache_path, source_signature, timedelta_percentiles, UserHistory
+from negatives import NegativeSampler
+
 import seaborn as sns
 import matplotlib.pyplot as plt
 
-dayDict = {
-	"Monday":1,
-	"Tuesday":2,
-	"Wednesday":3,
-	"Thursday":4,
-	"Friday":5,
-	"Saturday":6,
-	"Sunday":7
-}
-
-class TimeStamp():
-
-    def __init__(self, timestamp):
-        self.day = dayDict[timestamp.strftime("%A")]
-        self.hour = int(timestamp.strftime("%H")) + 1
-        # self.date = timestamp.strftime("%c")
-
-
-class UserItems():
-
-    # TODO: Days ago relative to first date!
-    def __init__(self, item, rating, timestamp):
-        self.item = item
-        self.rating = rating
-        self.timestamp_raw = timestamp
-        self.timestamp = datetime.fromtimestamp(
-            timestamp).astimezone(timezone.utc)
-            
-        self.ts = TimeStamp(self.timestamp)
-        self.day = self.ts.day
-
-
 def plot_attention_weights(attention_weights, path):
     plt.figure(dpi=300)
     plt.imshow(attention_weights, cmap='hot', interpolation='nearest')
@@ -52,6 +25,7 @@ def plot_attention_weights(attention_weights, path):
     plt.title("Attention weights")
     # plt.show()
     plt.savefig(os.path.join(path, 'attention_weights.svg'), format='svg')
+    plt.close()
 
 
 def get_bin_size(min_ts, max_ts, max_bins):
@@ -120,13 +94,117 @@ def get_timedelta_bin(ts, bin_in_hours=48, max_bins=200, log_scale=False, min_ts
     return time_bin
 
 
+class TimeBinner():
+    '''
+    Array version of :get_timedelta_bin: for time deltas in whole seconds (any
+    shape), with the bin size computed once per dataset instead of per element.
+    The bins are exactly those of get_timedelta_bin.
+
+    Arguments
+    ---------
+
+    bin_in_hours, max_bins, log_scale :
+        As in get_timedelta_bin.
+    min_timedelta, max_timedelta : float
+        Range of the log scale (see get_delta_range), only used if :log_scale:.
+    '''
+
+    def __init__(self, bin_in_hours=48, max_bins=200, log_scale=False, min_timedelta=None, max_timedelta=None):
+        self.bin_in_hours = bin_in_hours
+        self.max_bins = max_bins
+        self.log_scale = log_scale
+        if log_scale:
+            self.bin_size = get_bin_size(min_timedelta + 1, max_timedelta + 1, max_bins)
+        # ts // 3600 // bin_in_hours == ts // (3600 * bin_in_hours) for whole hours, in integers
+        self.bin_seconds = 3600 * int(bin_in_hours) if float(bin_in_hours).is_integer() else None
+
+    def __call__(self, time_delta):
+        time_delta = np.asarray(time_delta)
+        if self.log_scale:
+            time_bin = np.floor(np.log(time_delta + 1.0) / self.bin_size)
+        elif self.bin_seconds is not None and time_delta.dtype.kind in 'iu':
+            time_bin = time_delta // self.bin_seconds
+        else:
+            time_bin = np.floor(time_delta // 3600 / self.bin_in_hours)
+        return np.minimum(time_bin, self.max_bins).astype(np.int32)
+
+
+def build_time_bin_tables(dataset, bin_in_hours, max_bins, log_scale):
+    '''
+    Per-interaction time bins of a partitioned dataset, relative to the three
+    reference points of training and evaluation:
+
+    'train': the last training input (the reference of BatchSampler),
+    'valid': the last train interaction (the inputs of the validation),
+    'test': the validation interaction (the inputs of the test).
+
+    Every table is indexed by column row, like the dataset columns; rows that are
+    not an input for that reference are 0.
+    '''
+    [train, valid, _, _, _, _] = dataset
+    min_timedelta, max_timedelta = get_delta_range(train) if log_scale else (None, None)
+    time_binner = TimeBinner(bin_in_hours, max_bins, log_scale, min_timedelta, max_timedelta)
+    timestamps = train.columns['timestamp']
+    dtype = np.int16 if max_bins < 2 ** 15 else np.int32
+
+    tables = {}
+    for name, inputs, reference in [('train', train, train.ends - 2),
+                                    ('valid', train, train.ends - 1),
+                                    ('test', UserHistory(train.columns, train.starts, valid.ends), valid.ends - 1)]:
+        rows, users = inputs.rows()
+        reference = reference[users]
+        keep = (reference >= inputs.starts[users]) & (rows <= reference)
+        table = np.zeros(len(timestamps), dtype=dtype)
+        table[rows[keep]] = time_binner(timestamps[reference[keep]] - timestamps[rows[keep]])
+        tables[name] = table
+    return tables
+
+
+def get_time_bin_tables(fpath, dataset, bin_in_hours, max_bins, log_scale):
+    '''
+    Returns the memory-mapped :build_time_bin_tables: of the dataset at :fpath:,
+    stored in its cache directory on first use. Tables of other bin parameters
+    are kept next to it, so switching parameters between runs only computes the
+    missing tables; they are discarded together with the cache when the dataset
+    changes.
+    '''
+    [train, _, _, _, _, _] = dataset
+    params = {
+        'bin_in_hours': bin_in_hours,
+        'max_bins': max_bins,
+        'log_scale': bool(log_scale),
+        'delta_range': [float(x) for x in get_delta_range(train)] if log_scale else None,
+    }
+    digest = hashlib.md5(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+    path = os.path.join(cache_path(fpath), 'time_bins_{}'.format(digest))
+    names = ['train', 'valid', 'test']
+
+    if not os.path.exists(path):
+        tables = build_time_bin_tables(dataset, bin_in_hours, max_bins, log_scale)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        os.makedirs(tmp_path)
+        for name in names:
+            np.save(os.path.join(tmp_path, name + '.npy'), tables[name])
+        with open(os.path.join(tmp_path, 'params.json'), 'w') as f:
+            json.dump(params, f, indent=2)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # built concurrently by another run
+            shutil.rmtree(tmp_path)
+    return {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in names}
+
+
 def get_delta_range(User, max_percentile=90):
     '''
     Function to determine the maximum and minimum time deltas present in the data in seconds.
+    The time delta of an interaction is measured up to the last interaction of its user.
+    For the histories of a compiled dataset the percentiles are looked up in its meta data,
+    otherwise they are streamed through a QuantileSketch (exact up to 4M interactions).
 
     Arguments
     ---------
-    User : User object
+    User : UserHistory
         Contains all sequences for all users.
 
     max_percentile : int
@@ -146,59 +224,32 @@ def get_delta_range(User, max_percentile=90):
         interactions in a sequence, at the specified max percentile.
     '''
 
-    all_timedeltas = []
-    for _, sequences in User.items():
-        ts = sequences[-1].timestamp
-        for u in sequences:
-            # get time difference with last-known observations
-            delta_ts = (ts - u.timestamp).total_seconds()
-            all_timedeltas.append(delta_ts)
-
-    all_timedeltas = np.array(all_timedeltas)
-    max_timedelta = np.percentile(all_timedeltas, 90)
-    min_timedelta = np.amin(all_timedeltas)
+    percentiles = User.timedelta_percentiles
+    if percentiles is not None and float(max_percentile).is_integer() and 0 <= max_percentile <= 100:
+        # computed when the dataset was compiled
+        return percentiles[0], percentiles[int(max_percentile)]
+
+    min_timedelta, max_timedelta = timedelta_percentiles(User.columns['timestamp'], User.starts, User.ends,
+                                                         [0, max_percentile])
     return min_timedelta, max_timedelta
 
 
 def get_users(fpath):
-    usernum = 0
-    itemnum = 0
-    ratingnum = 0
-    f = open(fpath, 'r')
-    User = defaultdict(list)
-    for line in f:
-        u, i, r, t = line.rstrip().split(' ')
-        u = int(u)
-        i = int(i)
-        r = float(r)
-        t = int(t)
-        usernum = max(u, usernum)
-        itemnum = max(i, itemnum)
-        ratingnum = max(r, ratingnum)
-
-        to_add = UserItems(i, r, t)
-        User[u].append(to_add)
-    f.close()
-    return User, usernum, itemnum, ratingnum
+    data = load_dataset(fpath)
+    return data.history(), data.usernum, data.itemnum, data.ratingnum
 
 
 def add_time_bin(User, log_scale, bin_in_hours=48, max_bins=200):
     # if positional embedding is calculated on the basis of a log scale get min and max timediff
-    if log_scale:
-        min_timedelta, max_timedelta = get_delta_range(User)
-
-    for _, sequences in User.items():
-        most_recent_timestamp = sequences[-1].timestamp
-        for s in sequences:
-            time_delta = (most_recent_timestamp - s.timestamp).total_seconds()
+    min_timedelta, max_timedelta = get_delta_range(User) if log_scale else (None, None)
+    time_binner = TimeBinner(bin_in_hours, max_bins, log_scale, min_timedelta, max_timedelta)
 
-            if log_scale:
-                s.time_bin = get_timedelta_bin(time_delta, max_bins=max_bins,
-                                               log_scale=True, min_ts=min_timedelta, max_ts=max_timedelta)
-            else:
-                s.time_bin = get_timedelta_bin(time_delta, bin_in_hours=bin_in_hours, max_bins=max_bins,
-                                               log_scale=False)
-    return User
+    # bins relative to the most recent interaction of every user
+    rows, users = User.rows()
+    timestamps = User.columns['timestamp']
+    time_bins = np.zeros(len(User.columns['item']), dtype=np.int32)
+    time_bins[rows] = time_binner(timestamps[User.ends[users] - 1] - timestamps[rows])
+    return User.with_column('time_bin', time_bins)
 
 
 def data_partition(fpath, log_scale=False):
@@ -206,225 +257,281 @@ def data_partition(fpath, log_scale=False):
     Temporarily taken from https://github.com/kang205/SASRec/blob/master/util.py
     '''
 
-    user_train = {}
-    user_valid = {}
-    user_test = {}
-    User, usernum, itemnum, ratingnum = get_users(fpath)
+    data = load_dataset(fpath)
 
     # Partition data into three parts: train, valid, test.
-    for user in User:
-        nfeedback = len(User[user])
-        if nfeedback < 3:
-            user_train[user] = User[user]
-            user_valid[user] = []
-            user_test[user] = []
+    user_train, user_valid, user_test = partition(data)
+    return [user_train, user_valid, user_test, data.usernum, data.itemnum, data.ratingnum]
+
+
+EVAL_NEGATIVES = 100
+EVAL_MAX_USERS = 10000
+
+
+class EvalInputs():
+    '''
+    Fixed inputs of the evaluation of one split ('valid' or 'test'): the right-aligned
+    input sequences of every evaluated user and their candidate items, the ground truth
+    in the first column followed by :EVAL_NEGATIVES: items the user has not interacted with.
+    The train items of user k (except the ground truth) are
+    seen_items[seen_offsets[k]:seen_offsets[k + 1]], they are excluded from the full ranking.
+    '''
+
+    FIELDS = ['users', 'seq', 'candidates', 'timeseq', 'hours_seq', 'days_seq', 'seen_items', 'seen_offsets']
+
+    def __init__(self, users, seq, candidates, timeseq, hours_seq, days_seq, seen_items, seen_offsets):
+        self.users = users
+        self.seq = seq
+        self.candidates = candidates
+        self.timeseq = timeseq
+        self.hours_seq = hours_seq
+        self.days_seq = days_seq
+        self.seen_items = seen_items
+        self.seen_offsets = seen_offsets
+
+    def __len__(self):
+        return len(self.users)
+
+    @property
+    def maxlen(self):
+        return self.seq.shape[1]
+
+    @property
+    def positions(self):
+        return np.arange(self.maxlen)
+
+    def batches(self, batch_size, test_seq_len=None):
+        '''
+        Yields (u, seq, item_idx, timeseq, hours_seq, days_seq, exclude) batches of :batch_size:
+        users, where :exclude: holds the (batch row, item) pairs of the seen items.
+        With :test_seq_len: only the most recent :test_seq_len: inputs are kept.
+        '''
+        for start in range(0, len(self), batch_size):
+            end = min(start + batch_size, len(self))
+            u, seq, item_idx, timeseq, hours_seq, days_seq = [getattr(self, name)[start:end]
+                                                              for name in self.FIELDS[:6]]
+            first, last = self.seen_offsets[start], self.seen_offsets[end]
+            rows = np.repeat(np.arange(end - start, dtype=np.int32), np.diff(self.seen_offsets[start:end + 1]))
+            exclude = np.stack([rows, self.seen_items[first:last]], axis=1)
+            if test_seq_len:
+                # mask copies, the inputs are reused by later evaluations
+                seq, timeseq, hours_seq, days_seq = [np.where(self.positions >= self.maxlen - test_seq_len, x, 0)
+                                                     for x in (seq, timeseq, hours_seq, days_seq)]
+            yield u, seq, item_idx, timeseq, hours_seq, days_seq, exclude
+
+    def save(self, fpath):
+        tmp_fpath = fpath + '.tmp.npz'
+        np.savez(tmp_fpath, **{name: getattr(self, name) for name in self.FIELDS})
+        os.replace(tmp_fpath, fpath)
+
+    @classmethod
+    def load(cls, fpath):
+        with np.load(fpath) as arrays:
+            return cls(**{name: arrays[name] for name in cls.FIELDS})
+
+
+def build_eval_inputs(dataset, split, maxlen, bin_in_hours, max_bins, log_scale, seed, time_bin_table=None):
+    '''
+    Builds the :EvalInputs: of :split:. For the test split the validation item is the
+    most recent input, preceded by the train items; for the valid split the inputs are
+    the train items. At most :EVAL_MAX_USERS: users are evaluated. The time bins are
+    gathered from :time_bin_table: (the :split: table of get_time_bin_tables) if given.
+
+    The users and negatives are drawn with :seed:, leaving the global random state untouched.
+    '''
+    [train, valid, test, usernum, itemnum, _] = dataset
+    target = test if split == 'test' else valid
+    input_ends = valid.ends if split == 'test' else train.ends
+
+    state = np.random.get_state()
+    np.random.seed(seed)
+    try:
+        if usernum > EVAL_MAX_USERS:
+            users = np.sort(np.random.choice(np.arange(1, usernum + 1), EVAL_MAX_USERS, replace=False))
         else:
-            user_train[user] = User[user][:-2]
-            user_valid[user] = []
-            user_valid[user].append(User[user][-2])
-            user_test[user] = []
-            user_test[user].append(User[user][-1])
-    return [user_train, user_valid, user_test, usernum, itemnum, ratingnum]
+            users = np.arange(1, usernum + 1)
+        users = users[(train.lengths()[users] >= 1) & (target.lengths()[users] >= 1)]
+        negative_sampler = NegativeSampler(train, itemnum)
+        negatives = negative_sampler.sample(users, EVAL_NEGATIVES)
+    finally:
+        np.random.set_state(state)
+
+    # the last :maxlen: inputs of every user, right-aligned and zero-padded
+    columns = train.columns
+    ends = input_ends[users]
+    n = np.minimum(ends - train.starts[users], maxlen)
+    positions = np.arange(maxlen)
+    mask = positions >= (maxlen - n)[:, None]
+    rows = np.where(mask, (ends - maxlen)[:, None] + positions, 0)
+
+    seq = np.where(mask, columns['item'][rows], 0).astype(np.int32)
+    hours_seq = np.where(mask, columns['hour'][rows], 0).astype(np.int32)
+    days_seq = np.where(mask, columns['day'][rows], 0).astype(np.int32)
+
+    # time bins relative to the most recent input
+    if time_bin_table is not None:
+        timeseq = np.where(mask, time_bin_table[rows], 0).astype(np.int32)
+    else:
+        min_timedelta, max_timedelta = get_delta_range(train) if log_scale else (None, None)
+        time_binner = TimeBinner(bin_in_hours, max_bins, log_scale, min_timedelta, max_timedelta)
+        # the padding has no interactions, so its (negative) deltas are zeroed before binning
+        time_delta = columns['timestamp'][ends - 1][:, None] - columns['timestamp'][rows]
+        timeseq = np.where(mask, time_binner(np.where(mask, time_delta, 0)), 0).astype(np.int32)
 
+    candidates = np.concatenate([columns['item'][target.starts[users]][:, None], negatives], axis=1)
 
-def evaluate(model, dataset, args, sess):
+    # the ground truth is never excluded, even if the user has seen it before
+    seen_items, rows, _ = negative_sampler.seen(users)
+    keep = seen_items != candidates[rows, 0]
+    seen_offsets = np.zeros(len(users) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows[keep], minlength=len(users)), out=seen_offsets[1:])
+
+    return EvalInputs(users.astype(np.int32), seq, candidates.astype(np.int32), timeseq, hours_seq, days_seq,
+                      seen_items[keep].astype(np.int32), seen_offsets)
 
-    [train, valid, test, usernum, itemnum, ratingnum] = copy.deepcopy(dataset)
-    
-    min_timedelta, max_timedelta = get_delta_range(train)
 
-    NDCG = 0.0
-    HT = 0.0
-    valid_user = 0.0
-    attn_weights = []
+# evaluation inputs built in this process, so that every epoch scores the same candidates
+_eval_inputs = {}
 
-    if usernum > 10000:
-        users = random.sample(range(1, usernum + 1), 10000)
+
+def get_eval_inputs(dataset, args, split):
+    '''
+    Returns the :EvalInputs: of :split:, building them on first use. With --eval_cache
+    they are also stored in the dataset cache directory and reused by later runs with
+    the same parameters; they are discarded together with the cache when the dataset changes.
+    '''
+    params = {
+        'split': split,
+        'maxlen': args.maxlen,
+        'bin_in_hours': args.bin_in_hours,
+        'max_bins': args.max_bins,
+        'log_scale': bool(args.log_scale),
+        'seed': args.seed,
+        'negatives': EVAL_NEGATIVES,
+        'max_users': EVAL_MAX_USERS,
+    }
+    digest = hashlib.md5(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+    key = (os.path.abspath(args.dataset), json.dumps(source_signature(args.dataset)), digest)
+    if key in _eval_inputs:
+        return _eval_inputs[key]
+
+    fpath = None
+    if getattr(args, 'eval_cache', False):
+        fpath = os.path.join(cache_path(args.dataset), 'eval_{}_{}.npz'.format(split, digest))
+
+    if fpath is not None and os.path.exists(fpath):
+        inputs = EvalInputs.load(fpath)
     else:
-        users = range(1, usernum + 1)
-    for u in tqdm(users):
-        if len(train[u]) < 1 or len(test[u]) < 1:
-            continue
-
-        seq = np.zeros([args.maxlen], dtype=np.int32)
-        orig_seq = [0] * args.maxlen
-        timeseq = np.zeros([args.maxlen], dtype=np.int32)
-        hours_seq = np.zeros([args.maxlen], dtype=np.int32)
-        days_seq = np.zeros([args.maxlen], dtype=np.int32)
-
-        idx = args.maxlen - 1
-        seq[idx] = valid[u][0].item
-        orig_seq[idx] = valid[u][0]
-        hours_seq[idx] = valid[u][0].ts.hour
-        days_seq[idx] = valid[u][0].ts.day
-
-        valid_to_test_delta = (
-            test[u][0].timestamp - valid[u][0].timestamp).total_seconds()
-        timeseq[idx] = get_timedelta_bin(
-            valid_to_test_delta, bin_in_hours=args.bin_in_hours, max_bins=args.max_bins, log_scale=False)
-        idx -= 1
-        for i in reversed(train[u]):
-            seq[idx] = i.item
-            orig_seq[idx] = i
-            hours_seq[idx] = i.ts.hour
-            days_seq[idx] = i.ts.day
-            idx -= 1
-            if idx == -1:
-                break
-
-        # Get the timestamps between the most recent timestamp and the item's timestamp, and calculate its bin
-        most_recent_timestamp = orig_seq[-1].timestamp
-        for idx, s in enumerate(orig_seq):
-            if s != 0:
-                time_delta = (most_recent_timestamp -
-                            s.timestamp).total_seconds()
-
-                if args.log_scale:
-                    timeseq[idx] = get_timedelta_bin(time_delta, bin_in_hours=args.bin_in_hours, max_bins=args.max_bins,
-                                                   log_scale=True, min_ts=min_timedelta, max_ts=max_timedelta)
-                else:
-                    timeseq[idx] = get_timedelta_bin(time_delta, bin_in_hours=args.bin_in_hours, max_bins=args.max_bins,
-                                                    log_scale=False)
-            else:
-                timeseq[idx] = 0
-
-        rated = set([i.item for i in train[u]])
-        rated.add(0)
-        item_idx = [test[u][0].item]
-        for _ in range(100):
-            t = np.random.randint(1, itemnum + 1)
-            while t in rated:
-                t = np.random.randint(1, itemnum + 1)
-            item_idx.append(t)
-        
-        if args.test_model:
-
-            if not args.test_seq_len:
-                raise Exception('test_seq_len is not provided')
-             
-            max_seq_len = args.maxlen
-            test_seq_len = args.test_seq_len
-
-            # If test sequence length is larger than max, then set it equal to (sanity check)
-            if test_seq_len > max_seq_len:
-                test_seq_len = max_seq_len
-
-            seq[:-test_seq_len] = 0
-            timeseq[:-test_seq_len] = 0
-            hours_seq[:-test_seq_len] = 0
-            days_seq[:-test_seq_len] = 0
-
-        predictions, attention_weights = model.predict(sess, [u], [seq], item_idx, timeseq=[timeseq], hours_seq=[hours_seq], days_seq=[days_seq])
-        predictions = -predictions
-        predictions = predictions[0]
-
-        rank = predictions.argsort().argsort()[0]
-
-        valid_user += 1
-
-        if rank < 10:
-            NDCG += 1 / np.log2(rank + 2)
-            HT += 1
-
-        if args.test_model: 
-            attention_weights = attention_weights[0]
-            attn_weights.append(attention_weights)
-        
+        time_bin_table = None
+        if getattr(args, 'time_bin_cache', False):
+            time_bin_table = get_time_bin_tables(args.dataset, dataset, args.bin_in_hours, args.max_bins,
+                                                 args.log_scale)[split]
+        inputs = build_eval_inputs(dataset, split, args.maxlen, args.bin_in_hours, args.max_bins,
+                                   args.log_scale, args.seed, time_bin_table)
+        if fpath is not None:
+            inputs.save(fpath)
+    _eval_inputs[key] = inputs
+    return inputs
+
+
+def get_test_seq_len(args):
+    '''
+    Number of most recent inputs kept when testing a saved model, None otherwise.
+    '''
+    if not args.test_model:
+        return None
+    if not args.test_seq_len:
+        raise Exception('test_seq_len is not provided')
+    # If test sequence length is larger than max, then set it equal to (sanity check)
+    return min(args.test_seq_len, args.maxlen)
+
+
+class RankingEvaluator():
+    '''
+    Scores batches of evaluated users with one sess.run per batch. The first
+    candidate of every row is the ground truth, the metrics are NDCG@10 and
+    HR@10 of its rank among the candidates.
+
+    With :full_rank_k: the same run also retrieves the top :full_rank_k: items
+    of the whole catalogue (seen items excluded), which gives the full-ranking
+    NDCG@K and HR@K of the ground truth.
+    '''
+
+    def __init__(self, model, sess, with_attention=False, full_rank_k=0):
+        self.model = model
+        self.sess = sess
+        self.with_attention = with_attention
+        self.full_rank_k = full_rank_k
+        self.NDCG = 0.0
+        self.HT = 0.0
+        self.full_NDCG = 0.0
+        self.full_HT = 0.0
+        self.valid_user = 0.0
+        self.attention_sum = 0.0
+
+    def add(self, u, seq, item_idx, timeseq, hours_seq, days_seq, exclude=None):
+        feed_dict = self.model.feed_dict(u, seq, timeseq, hours_seq, days_seq)
+        feed_dict[self.model.test_item] = item_idx
+        fetches = {'predictions': self.model.test_logits}
+        if self.with_attention:
+            fetches['attention_weights'] = self.model.attention_weights
+        if self.full_rank_k:
+            feed_dict[self.model.top_k] = self.full_rank_k
+            if exclude is not None:
+                feed_dict[self.model.exclude_items] = exclude
+            fetches['top_k_items'] = self.model.top_k_items
+        results = self.sess.run(fetches, feed_dict)
+
+        # rank of the ground truth (first candidate) when sorting by descending score
+        predictions = results['predictions']
+        rank = (-predictions).argsort(axis=1).argsort(axis=1)[:, 0]
+        hit = rank < 10
+
+        self.valid_user += len(rank)
+        self.NDCG += np.sum(1 / np.log2(rank[hit] + 2))
+        self.HT += np.sum(hit)
+
+        if self.full_rank_k:
+            # position of the ground truth among the retrieved items, if retrieved at all
+            found = results['top_k_items'] == np.asarray(item_idx)[:, :1]
+            full_rank = found.argmax(axis=1)[found.any(axis=1)]
+            self.full_NDCG += np.sum(1 / np.log2(full_rank + 2))
+            self.full_HT += len(full_rank)
+
+        if self.with_attention:
+            # the first len(u) entries hold the first attention head of every user
+            self.attention_sum += np.sum(results['attention_weights'][:len(u)], axis=0)
+
+    def result(self):
+        '''
+        Returns (NDCG@10, HR@10), followed by the full-ranking (NDCG@K, HR@K) with :full_rank_k:.
+        '''
+        result = (self.NDCG / self.valid_user, self.HT / self.valid_user)
+        if self.full_rank_k:
+            result += (self.full_NDCG / self.valid_user, self.full_HT / self.valid_user)
+        return result
+
+    def mean_attention(self):
+        return self.attention_sum / self.valid_user
+
+
+def evaluate(model, dataset, args, sess):
+    inputs = get_eval_inputs(dataset, args, 'test')
+    evaluator = RankingEvaluator(model, sess, with_attention=bool(args.test_model),
+                                 full_rank_k=getattr(args, 'full_rank_k', 0))
+    for batch in tqdm(inputs.batches(args.eval_batch_size, get_test_seq_len(args))):
+        evaluator.add(*batch)
 
     if args.test_model:
-        avg_attn_weights = np.mean(np.array(attn_weights), axis=0)
-        plot_attention_weights(avg_attn_weights, args.test_model)
+        plot_attention_weights(evaluator.mean_attention(), args.test_model)
     # else:
     #     plot_attention_weights(avg_attn_weights, args.train_files_path)
-    return NDCG / valid_user, HT / valid_user
+    return evaluator.result()
 
 
 def evaluate_valid(model, dataset, args, sess):
-    [train, valid, _, usernum, itemnum, ratingnum] = copy.deepcopy(dataset)
-
-    min_timedelta, max_timedelta = get_delta_range(train)
-
-    NDCG = 0.0
-    valid_user = 0.0
-    HT = 0.0
-    if usernum > 10000:
-        users = random.sample(list(range(1, usernum + 1)), 10000)
-    else:
-        users = list(range(1, usernum + 1))
-    for u in tqdm(users):
-        if len(train[u]) < 1 or len(valid[u]) < 1:
-            continue
-
-        seq = np.zeros([args.maxlen], dtype=np.int32)
-        hours_seq = np.zeros([args.maxlen], dtype=np.int32)
-        days_seq = np.zeros([args.maxlen], dtype=np.int32)
-        orig_seq = [0] * args.maxlen
-        # for test data, the most recent item is always in the 0 bin
-        timeseq = np.zeros([args.maxlen], dtype=np.int32)
-        idx = args.maxlen - 1
-        for i in reversed(train[u]):
-            seq[idx] = i.item
-            orig_seq[idx] = i
-            hours_seq[idx] = i.ts.hour
-            days_seq[idx] = i.ts.day
-            idx -= 1
-            if idx == -1:
-                break
-
-        most_recent_timestamp = orig_seq[-1].timestamp
-        for idx, s in enumerate(orig_seq):
-            if s != 0:
-                time_delta = (most_recent_timestamp -
-                              s.timestamp).total_seconds()
-
-                if args.log_scale:
-                    timeseq[idx] = get_timedelta_bin(time_delta, bin_in_hours=args.bin_in_hours, max_bins=args.max_bins,
-                                                   log_scale=True, min_ts=min_timedelta, max_ts=max_timedelta)
-                else:
-                    timeseq[idx] = get_timedelta_bin(time_delta, bin_in_hours=args.bin_in_hours, max_bins=args.max_bins,
-                                                log_scale=False)
-            else:
-                timeseq[idx] = 0
-
-        rated = set([i.item for i in train[u]])
-        rated.add(0)
-        item_idx = [valid[u][0].item]
-        for _ in range(100):
-            t = np.random.randint(1, itemnum + 1)
-            while t in rated:
-                t = np.random.randint(1, itemnum + 1)
-            item_idx.append(t)
-
-        if args.test_model:
-
-            if not args.test_seq_len:
-                raise Exception('test_seq_len is not provided')
-             
-            max_seq_len = args.maxlen
-            test_seq_len = args.test_seq_len
-
-            # If test sequence length is larger than max, then set it equal to (sanity check)
-            if test_seq_len > max_seq_len:
-                test_seq_len = max_seq_len
-
-            seq[:-test_seq_len] = 0
-            timeseq[:-test_seq_len] = 0
-            hours_seq[:-test_seq_len] = 0
-            days_seq[:-test_seq_len] = 0
-
-
-
-        predictions, attention_weights = model.predict(sess, [u], [seq], item_idx, timeseq=[timeseq], hours_seq=[hours_seq], days_seq=[days_seq])
-        predictions = -predictions
-        predictions = predictions[0]
-
-        rank = predictions.argsort().argsort()[0]
-
-        valid_user += 1
-
-        if rank < 10:
-            NDCG += 1 / np.log2(rank + 2)
-            HT += 1
-
-
-    return NDCG / valid_user, HT / valid_user
+    inputs = get_eval_inputs(dataset, args, 'valid')
+    evaluator = RankingEvaluator(model, sess, full_rank_k=getattr(args, 'full_rank_k', 0))
+    for batch in tqdm(inputs.batches(args.eval_batch_size, get_test_seq_len(args))):
+        evaluator.add(*batch)
+    return evaluator.result()